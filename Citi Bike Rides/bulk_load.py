@@ -0,0 +1,206 @@
+'''  CITI BIKE RENTAL - Bulk load backends '''
+
+# `DataFrame.to_sql` sends parameterised INSERTs, which is the slowest stage of the load.
+# With the `copy` backend, each DataFrame is streamed to Postgres with `COPY ... FROM STDIN`,
+# serialised through an in-memory buffer (no intermediate csv file on disk).
+# SQLite has no COPY: the `copy` backend falls back to `to_sql` there, so the loader can be run locally.
+
+
+## Import libraries
+import pandas as pd
+import numpy as np
+import io
+import csv
+import time
+import argparse
+import contextlib
+import sqlalchemy
+
+
+## Parameters
+BACKENDS = ['to_sql', 'copy']
+
+
+""" Writing a table """
+## `to_sql` insertion method streaming the rows through COPY
+def copy_insert(table, con, keys, data_iter):
+    """
+    Used as the `method` of `DataFrame.to_sql` (see the pandas documentation on insertion methods).
+
+    Parameters:
+        table (SQLTable): pandas table being written
+        con (Connection): sqlalchemy connection to a Postgres database
+        keys (list): column names
+        data_iter (iterable): rows to write
+
+    Returns:
+        None
+    """
+
+    # Serialise the rows in memory (missing values are written as empty fields, i.e. NULL). Integer
+    # columns with missing values are floats in pandas, and COPY rejects `1964.0` for an integer.
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows([int(value) if isinstance(value, float) and value.is_integer() else value
+                                  for value in row] for row in data_iter)
+    buffer.seek(0)
+
+    columns = ', '.join('"' + key + '"' for key in keys)
+    table_name = table.name if table.schema is None else table.schema + '.' + table.name
+
+    with con.connection.cursor() as cur:
+        cur.copy_expert('COPY ' + table_name + ' (' + columns + ') FROM STDIN WITH (FORMAT csv)', buffer)
+
+
+## Append a DataFrame to a table with the selected backend
+def write_table(df, table, con, backend='to_sql'):
+    """
+    Parameters:
+        df (DataFrame): rows to append
+        table (str): name of the destination table
+        con (Connection): sqlalchemy connection to the database
+        backend (str): `to_sql` (parameterised INSERTs) or `copy` (Postgres COPY, `to_sql` on other databases)
+
+    Returns:
+        None
+    """
+
+    if backend not in BACKENDS:
+        raise ValueError("Unknown backend '" + str(backend) + "', expected one of " + str(BACKENDS))
+
+    if backend == 'copy' and con.dialect.name == 'postgresql':
+        # A single COPY per DataFrame -- the loader already bounds the size of each chunk
+        df.to_sql(table, con, if_exists='append', index=False, method=copy_insert)
+    else:
+        df.to_sql(table, con, if_exists='append', index=False, chunksize=10000)
+
+
+""" Deferred constraints """
+## Drop the foreign keys and indexes of a table during the load, and rebuild them afterwards
+@contextlib.contextmanager
+def deferred_constraints(engine, table='rides'):
+    """
+    Checking the foreign keys and maintaining the indexes row by row is slower than validating
+    and building them once at the end. The primary key is kept. Nothing is done on SQLite, which
+    doesn't enforce foreign keys by default.
+
+    Parameters:
+        engine (Engine): sqlalchemy engine of the database
+        table (str): name of the table being loaded
+
+    Returns:
+        None
+    """
+
+    if engine.dialect.name != 'postgresql':
+        yield
+        return
+
+    with engine.begin() as con:
+        foreign_keys = con.execute(sqlalchemy.text(
+            "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+            "WHERE conrelid = CAST(:table AS regclass) AND contype = 'f'"), {'table': table}).fetchall()
+        indexes = con.execute(sqlalchemy.text(
+            "SELECT indexname, indexdef FROM pg_indexes WHERE tablename = :table AND indexname NOT IN "
+            "(SELECT conname FROM pg_constraint WHERE conrelid = CAST(:table AS regclass))"), {'table': table}).fetchall()
+
+        for name, _ in foreign_keys:
+            con.execute(sqlalchemy.text('ALTER TABLE ' + table + ' DROP CONSTRAINT "' + name + '"'))
+        for name, _ in indexes:
+            con.execute(sqlalchemy.text('DROP INDEX "' + name + '"'))
+
+    try:
+        yield
+    finally:
+        # Rebuilt even if the load failed, so the schema is always left as it was (skipping the
+        # indexes and foreign keys created again in the meantime)
+        with engine.begin() as con:
+            existing_indexes = set(con.execute(sqlalchemy.text(
+                'SELECT indexname FROM pg_indexes WHERE tablename = :table'), {'table': table}).scalars())
+            existing_keys = set(con.execute(sqlalchemy.text(
+                'SELECT conname FROM pg_constraint WHERE conrelid = CAST(:table AS regclass)'), {'table': table}).scalars())
+
+            # The definition of an index of a partitioned table is `ON ONLY` the parent, which
+            # wouldn't build it on the partitions
+            for name, definition in indexes:
+                if name not in existing_indexes:
+                    con.execute(sqlalchemy.text(definition.replace(' ON ONLY ', ' ON ', 1)))
+            for name, definition in foreign_keys:
+                if name not in existing_keys:
+                    con.execute(sqlalchemy.text('ALTER TABLE ' + table + ' ADD CONSTRAINT "' + name + '" ' + definition))
+
+
+""" Benchmark """
+## Synthetic rides, with the same columns and dtypes as the `rides` table
+def make_rides(n_rows, seed=0):
+    """
+    Parameters:
+        n_rows (int): number of rides
+        seed (int): seed of the random generator
+
+    Returns:
+        df_rides (DataFrame): synthetic rides
+    """
+
+    rng = np.random.default_rng(seed)
+    start_time = pd.Timestamp('2016-01-01') + pd.to_timedelta(rng.integers(0, 366*24*3600, n_rows), unit='s')
+    trip_duration = rng.integers(60, 3*3600, n_rows)
+
+    df_rides = pd.DataFrame({'id': np.arange(n_rows),
+                             'date_key': (start_time.year*10000 + start_time.month*100 + start_time.day).values,
+                             'trip_duration': trip_duration,
+                             'trip_duration_min': np.round(trip_duration/60, 1),
+                             'trip_duration_hrs': np.round(trip_duration/3600, 1),
+                             'start_time': start_time,
+                             'stop_time': start_time + pd.to_timedelta(trip_duration, unit='s'),
+                             'start_station_id': rng.integers(3183, 3281, n_rows),
+                             'end_station_id': rng.integers(3183, 3281, n_rows),
+                             'bike_id': rng.integers(14500, 29300, n_rows),
+                             'valid_duration': True,
+                             'trip_demo': rng.integers(0, 156, n_rows)})
+
+    return(df_rides)
+
+
+## Compare the rows/sec of each backend
+def benchmark(engine, n_rows=100000, table='rides_benchmark'):
+    """
+    The rides are written to a scratch table, dropped at the end.
+
+    Parameters:
+        engine (Engine): sqlalchemy engine of the database
+        n_rows (int): number of rides written per backend
+        table (str): name of the scratch table
+
+    Returns:
+        results (DataFrame): seconds and rows/sec per backend
+    """
+
+    df_rides = make_rides(n_rows)
+    results = []
+
+    for backend in BACKENDS:
+        with engine.begin() as con:
+            df_rides.head(0).to_sql(table, con, if_exists='replace', index=False)
+
+        start = time.perf_counter()
+        with engine.begin() as con:
+            write_table(df_rides, table, con, backend)
+        seconds = time.perf_counter() - start
+
+        results.append({'backend': backend, 'rows': n_rows, 'seconds': round(seconds, 3),
+                        'rows_per_sec': round(n_rows / seconds)})
+
+    with engine.begin() as con:
+        con.execute(sqlalchemy.text('DROP TABLE ' + table))
+
+    return(pd.DataFrame(results))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Benchmark the bulk load backends')
+    parser.add_argument('--db-url', default='sqlite://', help='sqlalchemy url of the database')
+    parser.add_argument('--rows', type=int, default=100000, help='number of rides written per backend')
+    args = parser.parse_args()
+
+    print(benchmark(sqlalchemy.create_engine(args.db_url), args.rows).to_string(index=False))
@@ -0,0 +1,31 @@
+--- pre-aggregated rollups of `rides`, refreshed by the loader as new rides are appended (see rollups.py)
+--- and read by the `daily_counts`, `hourly_summary` and `trip_demographics` views
+
+--- daily ride counts
+CREATE TABLE IF NOT EXISTS daily_rollup (
+	date_key integer PRIMARY KEY,
+	ride_totals bigint,
+	subscriber_rides bigint,
+	customer_rides bigint,
+	unknown_rides bigint,
+	late_return bigint
+);
+
+--- ride counts per day and start hour
+CREATE TABLE IF NOT EXISTS hourly_rollup (
+	date_key integer,
+	start_hour integer,
+	ride_totals bigint,
+	PRIMARY KEY (date_key, start_hour)
+);
+
+--- ride counts per demographic
+CREATE TABLE IF NOT EXISTS demographic_rollup (
+	trip_demo integer PRIMARY KEY,
+	ride_totals bigint
+);
+
+--- indexes supporting the date and demographic filters/joins on `rides`
+CREATE INDEX IF NOT EXISTS rides_date_key_idx ON rides (date_key);
+CREATE INDEX IF NOT EXISTS rides_trip_demo_idx ON rides (trip_demo);
+CREATE INDEX IF NOT EXISTS rides_start_time_idx ON rides (start_time);
@@ -43,8 +43,10 @@ create table weather (
 );
 
 
+--- partitioned by month on `date_key`: one `rides_YYYYMM` partition per monthly trip file,
+--- created by the loader (see partitions.py)
 create table rides (
-	id integer PRIMARY KEY,
+	id integer,
 	date_key integer,
 	trip_duration integer,
 	trip_duration_min real,
@@ -59,5 +61,15 @@ create table rides (
 	FOREIGN KEY(date_key) REFERENCES date_dim(date_key),
 	FOREIGN KEY(start_station_id) REFERENCES stations(id),
 	FOREIGN KEY(end_station_id) REFERENCES stations(id),
-	FOREIGN KEY(trip_demo) REFERENCES trip_demo(id)
-);
\ No newline at end of file
+	FOREIGN KEY(trip_demo) REFERENCES trip_demo(id),
+	PRIMARY KEY (id, date_key)
+) PARTITION BY RANGE (date_key);
+
+create table load_log (
+	file_name varchar(50) PRIMARY KEY,
+	n_rides integer,
+	loaded_at timestamp,
+	min_birth_year real,
+	min_row integer,
+	outlier_removed boolean
+);
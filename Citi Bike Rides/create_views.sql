@@ -1,5 +1,7 @@
+--- views version 2 -- see queries.py for the changes, and to time the views on synthetic data
 
 --- create a table with various daily ride counts
+--- (read from `daily_rollup`, maintained by the loader -- see create_rollups.sql and rollups.py)
 CREATE VIEW daily_counts AS
 SELECT date_dim.date_key,
     date_dim.full_date,
@@ -7,15 +9,13 @@ SELECT date_dim.date_key,
     date_dim.day,
     date_dim.day_name,
     date_dim.weekend,
-    count(rides.id) AS ride_totals,
-    count(trip_demo.user_type) filter (where trip_demo.user_type = 'Subscriber') as subscriber_rides,
-    count(trip_demo.user_type) filter (where trip_demo.user_type = 'Customer') AS customer_rides,
-    count(trip_demo.user_type) filter (where trip_demo.user_type = 'Unknown')  unknown_rides,
-    count(rides.valid_duration) filter (where not rides.valid_duration) AS late_return
-   FROM rides
-     RIGHT JOIN date_dim ON rides.date_key = date_dim.date_key
-     LEFT JOIN trip_demo ON rides.trip_demo = trip_demo.id
-  GROUP BY date_dim.date_key
+    coalesce(daily_rollup.ride_totals, 0) AS ride_totals,
+    coalesce(daily_rollup.subscriber_rides, 0) AS subscriber_rides,
+    coalesce(daily_rollup.customer_rides, 0) AS customer_rides,
+    coalesce(daily_rollup.unknown_rides, 0) AS unknown_rides,
+    coalesce(daily_rollup.late_return, 0) AS late_return
+   FROM date_dim
+     LEFT JOIN daily_rollup ON daily_rollup.date_key = date_dim.date_key
   ORDER BY date_dim.date_key;
 
  --- create a table with daily daily_data
@@ -66,23 +66,24 @@ SELECT date_dim.date_key,
   GROUP BY date_dim.month, date_dim.month_name
   ORDER BY date_dim.month;
 
+--- partial index on the rides returned after the limit (a small fraction of `rides`), used by `late_return`
+CREATE INDEX IF NOT EXISTS rides_late_return_idx ON rides (date_key) WHERE NOT valid_duration;
+
 --- create a view to help analyze rides returned after the limit
 CREATE VIEW late_return AS
 SELECT date_dim.full_date,
    rides.id,
    rides.trip_duration_hrs,
    rides.bike_id,
-   ( SELECT stations.station_name
-          FROM stations
-         WHERE rides.start_station_id = stations.id) AS start_location,
-   ( SELECT stations.station_name
-          FROM stations
-         WHERE rides.end_station_id = stations.id) AS end_location,
+   start_station.station_name AS start_location,
+   end_station.station_name AS end_location,
    trip_demo.user_type
   FROM rides
     JOIN date_dim ON rides.date_key = date_dim.date_key
     JOIN trip_demo ON rides.trip_demo = trip_demo.id
- WHERE rides.valid_duration = False;
+    LEFT JOIN stations start_station ON rides.start_station_id = start_station.id
+    LEFT JOIN stations end_station ON rides.end_station_id = end_station.id
+ WHERE NOT rides.valid_duration;
 
 
 --- examples of queries analysts could run on this database
@@ -97,21 +98,21 @@ SELECT date_dim.full_date,
   GROUP BY daily.day_name
   ORDER BY (round(avg(daily.ride_totals))) DESC;
 
---- create an hourly summary
+--- create an hourly summary (read from `hourly_rollup`)
 CREATE VIEW hourly_summary AS
-SELECT EXTRACT(hour FROM rides.start_time) AS start_hour,
-    count(*) AS ride_totals
-   FROM rides
-  GROUP BY (EXTRACT(hour FROM rides.start_time))
-  ORDER BY (count(*)) DESC;
+SELECT CAST(hourly_rollup.start_hour AS numeric) AS start_hour,
+    CAST(sum(hourly_rollup.ride_totals) AS bigint) AS ride_totals
+   FROM hourly_rollup
+  GROUP BY hourly_rollup.start_hour
+  ORDER BY (sum(hourly_rollup.ride_totals)) DESC;
 
---- create a demographics summary
+--- create a demographics summary (read from `demographic_rollup`)
 CREATE VIEW trip_demographics AS
-SELECT count(rides.id) AS total_rides,
+SELECT CAST(sum(demographic_rollup.ride_totals) AS bigint) AS total_rides,
    trip_demo.age,
    trip_demo.gender,
    trip_demo.user_type
-  FROM rides
-    JOIN trip_demo ON rides.trip_demo = trip_demo.id
+  FROM demographic_rollup
+    JOIN trip_demo ON demographic_rollup.trip_demo = trip_demo.id
  GROUP BY trip_demo.age, trip_demo.gender, trip_demo.user_type
  ORDER BY trip_demo.user_type, trip_demo.gender, trip_demo.age;
\ No newline at end of file
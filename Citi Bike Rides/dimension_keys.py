@@ -0,0 +1,144 @@
+'''  CITI BIKE RENTAL - Dimension keys '''
+
+# Dimension keys are assigned by factorising the key columns (one hash pass, no merge), so the
+# rides keep their order and need no re-sort. The code tables (one row per key) are saved to
+# `keys/`, so later loads reuse the same keys.
+
+
+## Import libraries
+import pandas as pd
+import numpy as np
+import os
+
+
+## Parameters
+KEYS_DIR = 'keys'
+
+# Key columns and attributes of each dimension (the attributes are taken from the first row seen)
+DEMOGRAPHIC_KEY_COLS = ['user_type','birth_year','gender']
+DEMOGRAPHIC_DTYPES = {'id':'int64','user_type':'object','birth_year':'float64','gender':'int64','age':'float64'}
+STATION_DTYPES = {'id':'int64','station_name':'object','latitude':'float64','longitude':'float64'}
+
+
+""" Key assignment """
+## Assign integer keys to the rows of a chunk, extending the code table with the new tuples
+def assign_keys(df, key_cols, code_table, key='id'):
+    """
+    Known tuples keep their key, new tuples get the next keys in order of first appearance.
+    Missing values are valid key values (e.g. an unknown birth year).
+
+    Parameters:
+        df (DataFrame): chunk with the key columns (and the attributes of the code table)
+        key_cols (list): columns identifying a dimension row
+        code_table (DataFrame): known dimension rows, with their `key` column
+        key (str): name of the key column of the code table
+
+    Returns:
+        keys (ndarray): key of each row of `df`, in the same order
+        code_table (DataFrame): updated code table
+        new_rows (DataFrame): dimension rows first seen in this chunk
+    """
+
+    # Factorise the known tuples followed by the chunk: the known tuples get the first codes
+    n_known = len(code_table)
+    combined = pd.concat([code_table[key_cols], df[key_cols]], ignore_index=True)
+    codes = combined.groupby(key_cols, sort=False, dropna=False).ngroup().values
+    chunk_codes = codes[n_known:]
+
+    # Map the codes to keys (new keys follow the largest known key)
+    n_codes = 0 if len(codes) == 0 else codes.max() + 1
+    next_key = 0 if n_known == 0 else int(code_table[key].max()) + 1
+    key_of_code = np.concatenate([code_table[key].values.astype('int64'),
+                                  np.arange(next_key, next_key + n_codes - n_known, dtype='int64')])
+    keys = key_of_code[chunk_codes]
+
+    # First row of each new tuple (codes are given in order of first appearance)
+    new_codes, first_rows = np.unique(chunk_codes, return_index=True)
+    first_rows = first_rows[new_codes >= n_known]
+    new_rows = df.iloc[first_rows][[col for col in code_table.columns if col != key]].reset_index(drop=True)
+    new_rows.insert(0, key, keys[first_rows])
+
+    code_table = pd.concat([code_table, new_rows], ignore_index=True)
+
+    return(keys, code_table, new_rows)
+
+
+## Find the stations of a chunk that aren't in the code table yet
+def find_new_stations(df, code_table):
+    """
+    Stations are keyed on their own id, so there is no key to assign: only the new ids are kept.
+
+    Parameters:
+        df (DataFrame): cleaned chunk of trips
+        code_table (DataFrame): known stations
+
+    Returns:
+        code_table (DataFrame): updated code table
+        new_stations (DataFrame): stations first seen in this chunk
+    """
+
+    starts = df[['start_station_id','start_station_name','start_station_latitude','start_station_longitude']]
+    ends = df[['end_station_id','end_station_name','end_station_latitude','end_station_longitude']]
+
+    # Rename columns so both start and end dataframes have the same column names
+    starts.columns = list(STATION_DTYPES)
+    ends.columns = list(STATION_DTYPES)
+
+    chunk_stations = pd.concat([starts,ends]).drop_duplicates(subset='id')
+    new_stations = chunk_stations[~chunk_stations['id'].isin(code_table['id'])].reset_index(drop=True)
+
+    code_table = pd.concat([code_table, new_stations], ignore_index=True)
+
+    return(code_table, new_stations)
+
+
+""" Code tables """
+## Empty code table with the right dtypes
+def empty_code_table(dtypes):
+    """
+    Parameters:
+        dtypes (dict): columns and dtypes of the code table
+
+    Returns:
+        code_table (DataFrame): empty code table
+    """
+
+    return(pd.DataFrame(columns=list(dtypes)).astype(dtypes))
+
+
+## Read a saved code table
+def load_code_table(name, dtypes, keys_dir=KEYS_DIR):
+    """
+    Parameters:
+        name (str): name of the dimension (e.g. `trip_demo`)
+        dtypes (dict): columns and dtypes of the code table
+        keys_dir (str): folder of the code tables
+
+    Returns:
+        code_table (DataFrame): saved code table (None if it hasn't been saved yet)
+    """
+
+    path = os.path.join(keys_dir, name + '.csv')
+    if not os.path.exists(path):
+        return(None)
+    return(pd.read_csv(path, dtype=dtypes)[list(dtypes)])
+
+
+## Save a code table
+def save_code_table(code_table, name, keys_dir=KEYS_DIR):
+    """
+    Written to a temporary file first, so a code table is never left half written.
+
+    Parameters:
+        code_table (DataFrame): code table to save
+        name (str): name of the dimension (e.g. `trip_demo`)
+        keys_dir (str): folder of the code tables
+
+    Returns:
+        None
+    """
+
+    os.makedirs(keys_dir, exist_ok=True)
+    path = os.path.join(keys_dir, name + '.csv')
+    code_table.to_csv(path + '.tmp', index=False)
+    os.replace(path + '.tmp', path)
@@ -0,0 +1,147 @@
+'''  CITI BIKE RENTAL - Monthly partitions of the rides '''
+
+# On Postgres, `rides` is range-partitioned by month on `date_key` (`create_tables.sql`), with one
+# partition per monthly trip file (`rides_YYYYMM`, created by the loader). Each file is written
+# straight into its partition, date-filtered queries only scan the months they need, and a month
+# is reloaded by loading it into a new table swapped with the old partition in one transaction.
+# On SQLite (or an unpartitioned `rides`), the same calls write to `rides` and a reload deletes
+# the month first, in the same transaction.
+
+
+## Import libraries
+import contextlib
+import sqlalchemy
+
+from rollups import create_rollups, remove_rollups
+
+
+""" Months """
+## Date keys bounding a month
+def month_bounds(month):
+    """
+    Parameters:
+        month (str): YYYYMM month, e.g. `201603`
+
+    Returns:
+        first_date_key (int): first day of the month, e.g. 20160301
+        next_date_key (int): first day of the next month, e.g. 20160401 (the exclusive bound of the partition)
+    """
+
+    year, month_number = divmod(int(month), 100)
+    if month_number == 12:
+        year, month_number = year + 1, 0
+
+    return(int(month) * 100 + 1, (year * 100 + month_number + 1) * 100 + 1)
+
+
+## Name of the partition of a month
+def partition_name(month, table='rides'):
+    """
+    Parameters:
+        month (str): YYYYMM month
+        table (str): partitioned table
+
+    Returns:
+        name (str): e.g. `rides_201603`
+    """
+
+    return(table + '_' + str(month))
+
+
+## Whether a table is partitioned
+def is_partitioned(con, table='rides'):
+    """
+    Parameters:
+        con (Connection): sqlalchemy connection to the database
+        table (str): name of the table
+
+    Returns:
+        partitioned (bool): True if the table is a partitioned Postgres table
+    """
+
+    if con.dialect.name != 'postgresql' or not sqlalchemy.inspect(con).has_table(table):
+        return(False)
+
+    return(con.execute(sqlalchemy.text(
+        'SELECT count(*) FROM pg_partitioned_table WHERE partrelid = CAST(:table AS regclass)'),
+        {'table': table}).scalar() > 0)
+
+
+""" Partitions """
+## Create the partition of a month (if it doesn't exist)
+def ensure_partition(con, month, table='rides'):
+    """
+    Parameters:
+        con (Connection): sqlalchemy connection to a Postgres database with a partitioned `table`
+        month (str): YYYYMM month
+        table (str): partitioned table
+
+    Returns:
+        name (str): name of the partition
+    """
+
+    first_date_key, next_date_key = month_bounds(month)
+    name = partition_name(month, table)
+    con.execute(sqlalchemy.text('CREATE TABLE IF NOT EXISTS ' + name + ' PARTITION OF ' + table
+                                + ' FOR VALUES FROM (' + str(first_date_key) + ') TO (' + str(next_date_key) + ')'))
+
+    return(name)
+
+
+## Table to write the rides of a month into, swapped with the current rides of the month if `replace`
+@contextlib.contextmanager
+def month_partition(con, month, replace=False, table='rides'):
+    """
+    Use inside the transaction loading the month:
+        with month_partition(con, '201603', replace=True) as target:
+            write_table(df_rides, target, con)
+
+    On a partitioned table, the rides are written to the partition of the month, or when replacing,
+    to a new table checked against the month's range. That table is then attached in place of
+    the old partition (detached and dropped), so readers see either the old or the new month.
+    Otherwise the rides are written to `table`, after the rides of the month are deleted when replacing.
+    The rides being replaced are removed from the rollups (the caller adds the new ones).
+
+    Parameters:
+        con (Connection): sqlalchemy connection to the "Citi Bike Rental" database
+        month (str): YYYYMM month of the rides
+        replace (bool): replace the rides already loaded for the month
+        table (str): rides table
+
+    Returns:
+        target (str): name of the table to write the rides into
+    """
+
+    first_date_key, next_date_key = month_bounds(month)
+    partitioned = is_partitioned(con, table)
+
+    if replace:
+        create_rollups(con, indexes=False)
+        remove_rollups(con, first_date_key, next_date_key - 1)
+
+    if not partitioned:
+        if replace and sqlalchemy.inspect(con).has_table(table):
+            con.execute(sqlalchemy.text('DELETE FROM ' + table + ' WHERE date_key >= :first AND date_key < :next'),
+                        {'first': first_date_key, 'next': next_date_key})
+        yield table
+        return
+
+    name = ensure_partition(con, month, table)
+    if not replace:
+        yield name
+        return
+
+    # The check constraint lets ATTACH skip the scan validating the rows of the new table
+    new_name = name + '_new'
+    month_check = 'date_key >= ' + str(first_date_key) + ' AND date_key < ' + str(next_date_key)
+    con.execute(sqlalchemy.text('CREATE TABLE ' + new_name + ' (LIKE ' + table + ' INCLUDING DEFAULTS INCLUDING CONSTRAINTS)'))
+    con.execute(sqlalchemy.text('ALTER TABLE ' + new_name + ' ADD CONSTRAINT ' + new_name + '_month CHECK (' + month_check + ')'))
+
+    yield new_name
+
+    con.execute(sqlalchemy.text('ALTER TABLE ' + table + ' DETACH PARTITION ' + name))
+    con.execute(sqlalchemy.text('DROP TABLE ' + name))
+    con.execute(sqlalchemy.text('ALTER TABLE ' + new_name + ' RENAME TO ' + name))
+    con.execute(sqlalchemy.text('ALTER TABLE ' + table + ' ATTACH PARTITION ' + name
+                                + ' FOR VALUES FROM (' + str(first_date_key) + ') TO (' + str(next_date_key) + ')'))
+    con.execute(sqlalchemy.text('ALTER TABLE ' + name + ' DROP CONSTRAINT ' + new_name + '_month'))
@@ -0,0 +1,263 @@
+'''  CITI BIKE RENTAL - Analytical queries '''
+
+# The analytical SQL lives in `create_views.sql`; this module reads it as named, versioned views
+# and times them. `python queries.py` builds a synthetic database of configurable size (an empty
+# scratch database, in memory by default), creates the views, and reports the plan and latency
+# of each one, so a regression shows up before the views are deployed.
+#
+# Views versions:
+#     1 - original views
+#     2 - `daily_counts`, `hourly_summary` and `trip_demographics` read the rollups (see rollups.py),
+#         `late_return` resolves the stations with joins instead of two correlated subqueries per
+#         row, and the late returns are read through a partial index (`rides_late_return_idx`)
+
+
+## Import libraries
+import pandas as pd
+import numpy as np
+import os
+import re
+import time
+import argparse
+import sqlalchemy
+
+from bulk_load import make_rides
+from transforms import build_date_dim
+from rollups import create_rollups, rebuild_rollups
+from partitions import ensure_partition
+
+
+## Parameters
+VIEWS_VERSION = 2
+VIEWS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'create_views.sql')
+TABLES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'create_tables.sql')
+
+# Previous definitions of the views changed in the current version, timed next to them
+PREVIOUS_VIEWS = {
+    'late_return': """
+        SELECT date_dim.full_date, rides.id, rides.trip_duration_hrs, rides.bike_id,
+            ( SELECT stations.station_name FROM stations WHERE rides.start_station_id = stations.id) AS start_location,
+            ( SELECT stations.station_name FROM stations WHERE rides.end_station_id = stations.id) AS end_location,
+            trip_demo.user_type
+          FROM rides
+            JOIN date_dim ON rides.date_key = date_dim.date_key
+            JOIN trip_demo ON rides.trip_demo = trip_demo.id
+         WHERE rides.valid_duration = False""",
+}
+
+
+""" Views """
+## Read the statements of a SQL file (comment lines are dropped)
+def read_statements(path):
+    """
+    Parameters:
+        path (str): path of the SQL file
+
+    Returns:
+        statements (list): SQL statements, in file order
+    """
+
+    with open(path) as f:
+        statements = f.read().split(';')
+
+    statements = ['\n'.join(line for line in statement.splitlines() if not line.strip().startswith('---'))
+                  for statement in statements]
+
+    return([statement.strip() for statement in statements if statement.strip()])
+
+
+## Read the indexes and views of `create_views.sql`
+def read_views(path=VIEWS_FILE):
+    """
+    Parameters:
+        path (str): path of the views file
+
+    Returns:
+        indexes (list): `CREATE INDEX` statements
+        views (dict): view name -> query, in file order (a view only depends on the views before it)
+    """
+
+    indexes, views = [], {}
+    for statement in read_statements(path):
+        match = re.match(r'CREATE VIEW (\w+) AS\s+(.*)', statement, re.DOTALL | re.IGNORECASE)
+        if match is not None:
+            views[match.group(1)] = match.group(2)
+        elif re.match(r'CREATE INDEX', statement, re.IGNORECASE):
+            indexes.append(statement)
+        else:
+            raise ValueError('Unexpected statement in ' + path + ': ' + statement[:50])
+
+    return(indexes, views)
+
+
+## Create (or replace) the indexes and views
+def create_views(con, path=VIEWS_FILE, replace=False):
+    """
+    Parameters:
+        con (Connection): sqlalchemy connection to the "Citi Bike Rental" database
+        path (str): path of the views file
+        replace (bool): drop the existing views first
+
+    Returns:
+        None
+    """
+
+    indexes, views = read_views(path)
+
+    if replace:
+        # Dependent views first
+        for view in reversed(list(views)):
+            con.execute(sqlalchemy.text('DROP VIEW IF EXISTS ' + view))
+
+    for statement in indexes:
+        con.execute(sqlalchemy.text(statement))
+    for view, query in views.items():
+        con.execute(sqlalchemy.text('CREATE VIEW ' + view + ' AS ' + query))
+
+
+""" Synthetic dataset """
+## Fill an empty database with synthetic tables, rollups and views
+def make_synthetic_db(engine, n_rides, late_share=0.001, seed=0):
+    """
+    The rides come from `bulk_load.make_rides` (98 stations, 156 demographics over 2016), with a
+    share of them returned after the 24h limit.
+
+    Parameters:
+        engine (Engine): sqlalchemy engine of an empty scratch database
+        n_rides (int): number of rides
+        late_share (float): share of the rides returned after the limit
+        seed (int): seed of the random generator
+
+    Returns:
+        None
+    """
+
+    if sqlalchemy.inspect(engine).has_table('rides'):
+        raise ValueError('The database already has a rides table: the synthetic dataset needs an empty scratch database')
+
+    rng = np.random.default_rng(seed)
+
+    df_date = build_date_dim()[['date_key','full_date','month','day','month_name','day_name','weekend']]
+
+    station_ids = np.arange(3183, 3281)
+    df_stations = pd.DataFrame({'id': station_ids,
+                                'station_name': ['Station ' + str(i) for i in station_ids],
+                                'latitude': 40.7 + rng.random(len(station_ids)) / 10,
+                                'longitude': -74.1 + rng.random(len(station_ids)) / 10})
+
+    df_demo = pd.DataFrame({'id': np.arange(156),
+                            'user_type': np.array(['Subscriber','Customer','Unknown'])[np.arange(156) % 3],
+                            'gender': np.arange(156) // 3 % 3,
+                            'birth_year': 1940 + np.arange(156) // 9})
+    df_demo['age'] = 2016 - df_demo['birth_year']
+
+    df_weather = pd.DataFrame({'id': np.arange(len(df_date)),
+                               'rec_date': df_date['full_date'],
+                               'avg_wind': rng.random(len(df_date)) * 10,
+                               'prcp': np.where(rng.random(len(df_date)) < 0.3, rng.random(len(df_date)), 0),
+                               'snowfall': np.where(rng.random(len(df_date)) < 0.05, rng.random(len(df_date)) * 5, 0),
+                               'snow_depth': 0.0,
+                               't_avg': rng.integers(20, 90, len(df_date)),
+                               'date_key': df_date['date_key']})
+    df_weather['t_max'] = df_weather['t_avg'] + 8
+    df_weather['t_min'] = df_weather['t_avg'] - 8
+    df_weather['rain'] = df_weather['prcp'] > 0
+    df_weather['snow'] = df_weather['snowfall'] > 0
+
+    # Rides returned after the limit
+    df_rides = make_rides(n_rides, seed)
+    late = rng.random(n_rides) < late_share
+    df_rides.loc[late, 'trip_duration'] = rng.integers(25*3600, 72*3600, late.sum())
+    df_rides['trip_duration_min'] = np.round(df_rides['trip_duration'] / 60, 1)
+    df_rides['trip_duration_hrs'] = np.round(df_rides['trip_duration'] / 3600, 1)
+    df_rides['stop_time'] = df_rides['start_time'] + pd.to_timedelta(df_rides['trip_duration'], unit='s')
+    df_rides['valid_duration'] = ~(df_rides['trip_duration_hrs'] > 24)
+
+    with engine.begin() as con:
+        for statement in read_statements(TABLES_FILE):
+            # SQLite has no declarative partitioning: `rides` is a single table there
+            if con.dialect.name != 'postgresql':
+                statement = re.sub(r'\s*PARTITION BY RANGE \(\w+\)', '', statement)
+            con.execute(sqlalchemy.text(statement))
+
+        if con.dialect.name == 'postgresql':
+            for month in sorted(set(df_rides['date_key'] // 100)):
+                ensure_partition(con, str(month))
+
+        for df, table in [(df_date,'date_dim'), (df_stations,'stations'), (df_demo,'trip_demo'),
+                          (df_weather,'weather'), (df_rides,'rides')]:
+            df.to_sql(table, con, if_exists='append', index=False, chunksize=10000)
+
+        create_rollups(con)
+        rebuild_rollups(con)
+        create_views(con)
+
+
+""" Runner """
+## Plan of a query, as reported by the database
+def explain(con, query):
+    """
+    Parameters:
+        con (Connection): sqlalchemy connection to the database
+        query (str): query to explain
+
+    Returns:
+        plan (str): executed plan on Postgres (with timings and buffers), query plan on SQLite
+    """
+
+    if con.dialect.name == 'postgresql':
+        rows = con.execute(sqlalchemy.text('EXPLAIN (ANALYZE, BUFFERS) ' + query)).fetchall()
+        return('\n'.join(row[0] for row in rows))
+
+    rows = con.execute(sqlalchemy.text('EXPLAIN QUERY PLAN ' + query)).fetchall()
+    return('\n'.join(row[-1] for row in rows))
+
+
+## Time every view (and the previous definitions of the changed ones)
+def run_views(engine, repeat=5):
+    """
+    Parameters:
+        engine (Engine): sqlalchemy engine of a database with the views
+        repeat (int): number of runs per query (the median is kept)
+
+    Returns:
+        results (DataFrame): version, rows, median latency (ms) and plan of each query
+    """
+
+    _, views = read_views()
+    queries = [(view, VIEWS_VERSION, 'SELECT * FROM ' + view) for view in views]
+    queries += [(view, VIEWS_VERSION - 1, query) for view, query in PREVIOUS_VIEWS.items()]
+
+    results = []
+    with engine.connect() as con:
+        for view, version, query in queries:
+            runs = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                n_rows = len(con.execute(sqlalchemy.text(query)).fetchall())
+                runs.append((time.perf_counter() - start) * 1000)
+
+            results.append({'view': view, 'version': version, 'rows': n_rows,
+                            'median_ms': round(pd.Series(runs).median(), 2), 'plan': explain(con, query)})
+
+    return(pd.DataFrame(results))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Time the views on a synthetic dataset')
+    parser.add_argument('--db-url', default='sqlite://', help='sqlalchemy url of an empty scratch database')
+    parser.add_argument('--rides', type=int, default=100000, help='number of synthetic rides')
+    parser.add_argument('--repeat', type=int, default=5, help='number of runs per view')
+    parser.add_argument('--plans', action='store_true', help='print the plan of each view')
+    args = parser.parse_args()
+
+    engine = sqlalchemy.create_engine(args.db_url)
+    make_synthetic_db(engine, args.rides)
+    results = run_views(engine, args.repeat)
+
+    print('Views version ' + str(VIEWS_VERSION) + ', ' + str(args.rides) + ' synthetic rides')
+    print(results.drop(columns='plan').to_string(index=False))
+    if args.plans:
+        for row in results.itertuples():
+            print('\n--- ' + row.view + ' (version ' + str(row.version) + ')\n' + row.plan)
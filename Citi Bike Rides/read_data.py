@@ -0,0 +1,219 @@
+'''  CITI BIKE RENTAL - Reading the raw data '''
+
+# Readers of the raw monthly trip files and of the weather file, shared by the loader and the
+# staging layer.
+
+
+## Import libraries
+import pandas as pd
+import os
+import re
+
+from transforms import transform_trips, add_weather_flags
+
+
+## Parameters
+DATA_DIR = 'data'
+WEATHER_FILE = 'newark_airport_2016.csv'
+CHUNKSIZE = 50000
+
+# Explicit dtypes for the raw trip files, so every chunk is parsed the same way (no type inference)
+TRIP_DTYPES = {'Trip Duration': 'int64',
+               'Start Time': 'object',
+               'Stop Time': 'object',
+               'Start Station ID': 'int64',
+               'Start Station Name': 'object',
+               'Start Station Latitude': 'float64',
+               'Start Station Longitude': 'float64',
+               'End Station ID': 'int64',
+               'End Station Name': 'object',
+               'End Station Latitude': 'float64',
+               'End Station Longitude': 'float64',
+               'Bike ID': 'int64',
+               'User Type': 'object',
+               'Birth Year': 'float64',   # float, as some birth years are missing
+               'Gender': 'int64'}
+TRIP_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Text columns of the cleaned trips
+TEXT_COLS = ['start_station_name','end_station_name','user_type']
+
+
+""" Trip data """
+## List the monthly trip files, in order
+def list_trip_files(data_dir=DATA_DIR):
+    """
+    Parameters:
+        data_dir (str): folder containing the monthly `JC-*.csv` trip files
+
+    Returns:
+        files (list): sorted paths of the monthly trip files
+    """
+
+    return([os.path.join(data_dir, file) for file in sorted(os.listdir(data_dir)) if file.startswith('JC')])
+
+
+## Month (YYYYMM) of a monthly trip file
+def month_of(path):
+    """
+    Parameters:
+        path (str): path of a `JC-YYYYMM-*` trip file
+
+    Returns:
+        month (str): YYYYMM partition of the file
+    """
+
+    match = re.match(r'JC-(\d{6})', os.path.basename(path))
+    if match is None:
+        raise ValueError("Can't find the month of trip file " + path)
+    return(match.group(1))
+
+
+## Read a monthly trip file in chunks
+def read_trip_chunks(path, chunksize=CHUNKSIZE):
+    """
+    Parameters:
+        path (str): path of a monthly trip file
+        chunksize (int): number of rows per chunk
+
+    Returns:
+        chunks (generator): DataFrames of at most `chunksize` rows, with formatted column names
+    """
+
+    for chunk in pd.read_csv(path, dtype=TRIP_DTYPES, chunksize=chunksize):
+        # Change Start/Stop times to datatime format
+        chunk['Start Time'] = pd.to_datetime(chunk['Start Time'], format=TRIP_TIME_FORMAT)
+        chunk['Stop Time'] = pd.to_datetime(chunk['Stop Time'], format=TRIP_TIME_FORMAT)
+
+        # Reformat column names
+        chunk.columns = [x.replace(' ','_').lower() for x in chunk.columns]
+        yield chunk
+
+
+## Read and clean a monthly trip file in chunks
+def read_clean_trip_chunks(path, chunksize=CHUNKSIZE):
+    """
+    Parameters:
+        path (str): path of a monthly trip file
+        chunksize (int): number of rows per chunk
+
+    Returns:
+        chunks (generator): cleaned DataFrames of at most `chunksize` rows (see `transforms.transform_trips`)
+    """
+
+    for chunk in read_trip_chunks(path, chunksize):
+        yield transform_trips(chunk)
+
+
+## Birth years of a trip file (raw csv or staged parquet), in chunks
+def read_birth_years(path, chunksize=CHUNKSIZE):
+    """
+    Parameters:
+        path (str): path of a monthly trip file, or of its staged parquet file
+        chunksize (int): number of rows per chunk (csv only, the parquet column is read at once)
+
+    Returns:
+        chunks (generator): Series of birth years
+    """
+
+    if path.endswith('.parquet'):
+        yield pd.read_parquet(path, columns=['birth_year'])['birth_year']
+    else:
+        for chunk in pd.read_csv(path, usecols=['Birth Year'], dtype=TRIP_DTYPES, chunksize=chunksize):
+            yield chunk['Birth Year']
+
+
+## Oldest birth year of a trip file
+def birth_year_summary(path, chunksize=CHUNKSIZE):
+    """
+    Parameters:
+        path (str): path of a monthly trip file, or of its staged parquet file
+        chunksize (int): number of rows per chunk
+
+    Returns:
+        min_birth_year (float): oldest birth year of the file (None if no birth year is known)
+        min_row (int): position of its first occurrence in the file
+        n_rows (int): number of rows of the file
+    """
+
+    min_birth_year, min_row, n_rows = None, None, 0
+    for chunk in read_birth_years(path, chunksize):
+        birth_years = chunk.reset_index(drop=True)
+        if birth_years.notna().any():
+            idx = birth_years.idxmin()
+            if min_birth_year is None or birth_years[idx] < min_birth_year:
+                min_birth_year, min_row = birth_years[idx], n_rows + idx
+        n_rows += len(chunk)
+
+    return(min_birth_year, min_row, n_rows)
+
+
+## Find the age outlier (oldest rider) across all the files
+def find_age_outlier(summaries):
+    """
+    The outlier is the first occurrence of the oldest birth year, in file order, as when all the
+    files are read at once -- whichever of them have already been loaded.
+
+    Parameters:
+        summaries (dict): file name -> (oldest birth year, position of its first occurrence) of each file
+            (see `birth_year_summary`)
+
+    Returns:
+        outlier (tuple): file name and position in the file of the outlier (None if no birth year is known)
+    """
+
+    known = [(min_birth_year, file_name, min_row) for file_name, (min_birth_year, min_row) in summaries.items()
+             if min_birth_year is not None and not pd.isna(min_birth_year)]
+    if len(known) == 0:
+        return(None)
+
+    _, file_name, min_row = min(known)
+    return((file_name, int(min_row)))
+
+
+## Read and clean a whole trip file (run in a worker process by the parallel loader)
+def read_clean_file(path, chunksize=CHUNKSIZE):
+    """
+    Parameters:
+        path (str): path of a monthly trip file, or of its staged parquet file
+        chunksize (int): number of rows per chunk (csv only)
+
+    Returns:
+        df (DataFrame): cleaned trips of the file, with the text columns as categories
+    """
+
+    if path.endswith('.parquet'):
+        df = pd.read_parquet(path)
+    else:
+        df = pd.concat(read_clean_trip_chunks(path, chunksize), ignore_index=True)
+
+    # Categories are much smaller than python strings to send back to the parent process
+    for col in TEXT_COLS:
+        df[col] = df[col].astype('category')
+
+    return(df)
+
+
+""" Weather data """
+## Weather table
+def build_weather(path):
+    """
+    Parameters:
+        path (str): path of the Newark airport weather file
+
+    Returns:
+        df_weather (DataFrame): cleaned weather table
+    """
+
+    df_weather = pd.read_csv(path)
+
+    # Delete columns we don't need
+    df_weather.drop(["STATION","NAME","PGTM","TSUN","WDF2","WDF5","WSF2","WSF5"], axis=1, inplace=True)
+
+    # Change DATE to datatime format
+    df_weather['DATE'] = pd.to_datetime(df_weather['DATE'],yearfirst=True)
+
+    # Rename and add useful columns:
+    df_weather.columns = ['rec_date','avg_wind','prcp','snowfall','snow_depth','t_avg','t_max','t_min']
+
+    return(add_weather_flags(df_weather))
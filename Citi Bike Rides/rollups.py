@@ -0,0 +1,253 @@
+'''  CITI BIKE RENTAL - Rollups '''
+
+# The reporting views used to rescan and join the whole `rides` table on every query. The daily,
+# hourly and demographic counts are now kept in rollup tables (`create_rollups.sql`), refreshed
+# incrementally by the loader for each range of new rides, and read by the views.
+# `python rollups.py --rebuild` backfills the rollups of an existing database, and
+# `python rollups.py --benchmark` compares the latency of the views with the previous raw queries.
+
+
+## Import libraries
+import pandas as pd
+import os
+import time
+import argparse
+import sqlalchemy
+
+
+## Parameters
+ROLLUPS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'create_rollups.sql')
+ROLLUP_TABLES = ['daily_rollup', 'hourly_rollup', 'demographic_rollup']
+
+# Start hour of a ride, per database
+START_HOUR = {'postgresql': 'CAST(EXTRACT(hour FROM rides.start_time) AS integer)',
+              'sqlite': "CAST(strftime('%H', rides.start_time) AS integer)"}
+
+
+""" Refresh queries """
+# Counts of the rides with an id in [first_id, last_id], added to the existing counts
+# (the date range lets Postgres prune the `rides` partitions to the month being loaded), read from
+# the table they were written to (the new partition of a reloaded month is attached to `rides` later)
+DAILY_REFRESH = """
+INSERT INTO daily_rollup (date_key, ride_totals, subscriber_rides, customer_rides, unknown_rides, late_return)
+SELECT rides.date_key,
+    count(rides.id),
+    sum(CASE WHEN trip_demo.user_type = 'Subscriber' THEN 1 ELSE 0 END),
+    sum(CASE WHEN trip_demo.user_type = 'Customer' THEN 1 ELSE 0 END),
+    sum(CASE WHEN trip_demo.user_type = 'Unknown' THEN 1 ELSE 0 END),
+    sum(CASE WHEN NOT rides.valid_duration THEN 1 ELSE 0 END)
+  FROM {table} AS rides
+    LEFT JOIN trip_demo ON rides.trip_demo = trip_demo.id
+ WHERE rides.id BETWEEN :first_id AND :last_id
+   AND rides.date_key BETWEEN :first_date_key AND :last_date_key
+ GROUP BY rides.date_key
+ON CONFLICT (date_key) DO UPDATE SET
+    ride_totals = daily_rollup.ride_totals + excluded.ride_totals,
+    subscriber_rides = daily_rollup.subscriber_rides + excluded.subscriber_rides,
+    customer_rides = daily_rollup.customer_rides + excluded.customer_rides,
+    unknown_rides = daily_rollup.unknown_rides + excluded.unknown_rides,
+    late_return = daily_rollup.late_return + excluded.late_return
+"""
+
+HOURLY_REFRESH = """
+INSERT INTO hourly_rollup (date_key, start_hour, ride_totals)
+SELECT rides.date_key,
+    {start_hour},
+    count(*)
+  FROM {table} AS rides
+ WHERE rides.id BETWEEN :first_id AND :last_id
+   AND rides.date_key BETWEEN :first_date_key AND :last_date_key
+ GROUP BY rides.date_key, {start_hour}
+ON CONFLICT (date_key, start_hour) DO UPDATE SET
+    ride_totals = hourly_rollup.ride_totals + excluded.ride_totals
+"""
+
+DEMOGRAPHIC_REFRESH = """
+INSERT INTO demographic_rollup (trip_demo, ride_totals)
+SELECT rides.trip_demo,
+    count(rides.id)
+  FROM {table} AS rides
+ WHERE rides.id BETWEEN :first_id AND :last_id
+   AND rides.date_key BETWEEN :first_date_key AND :last_date_key
+ GROUP BY rides.trip_demo
+ON CONFLICT (trip_demo) DO UPDATE SET
+    ride_totals = demographic_rollup.ride_totals + excluded.ride_totals
+"""
+
+# Counts of the rides of a date range, removed before the range is replaced (the daily and hourly
+# rollups are keyed on the date, so their rows are deleted, and the demographics left without rides too)
+DEMOGRAPHIC_REMOVE = """
+UPDATE demographic_rollup SET ride_totals = ride_totals -
+    (SELECT count(*)
+       FROM rides
+      WHERE rides.trip_demo = demographic_rollup.trip_demo
+        AND rides.date_key BETWEEN :first_date_key AND :last_date_key)
+"""
+
+
+""" Rollup maintenance """
+## Create the rollup tables and the supporting indexes on `rides` (if they don't exist)
+def create_rollups(con, indexes=True):
+    """
+    Parameters:
+        con (Connection): sqlalchemy connection to the "Citi Bike Rental" database
+        indexes (bool): also create the indexes on `rides` (not while its indexes are dropped for a bulk load)
+
+    Returns:
+        None
+    """
+
+    with open(ROLLUPS_FILE) as f:
+        statements = [statement.strip() for statement in f.read().split(';')]
+
+    for statement in statements:
+        # Skip the comments (including the ones left after the last statement)
+        sql = '\n'.join(line for line in statement.splitlines() if line.strip() and not line.startswith('---'))
+        if sql != '' and (indexes or not sql.upper().startswith('CREATE INDEX')):
+            con.execute(sqlalchemy.text(sql))
+
+
+## Add the rides of an id range to the rollups
+def refresh_rollups(con, first_id, last_id, first_date_key=0, last_date_key=99991231, table='rides'):
+    """
+    Run in the same transaction as the insert of the rides, so the rollups always match `rides`.
+
+    Parameters:
+        con (Connection): sqlalchemy connection to the "Citi Bike Rental" database
+        first_id (int): id of the first new ride
+        last_id (int): id of the last new ride
+        first_date_key (int): first date of the new rides (e.g. the first day of the month loaded)
+        last_date_key (int): last date of the new rides
+        table (str): table the new rides were written to (see `partitions.month_partition`)
+
+    Returns:
+        None
+    """
+
+    params = {'first_id': int(first_id), 'last_id': int(last_id),
+              'first_date_key': int(first_date_key), 'last_date_key': int(last_date_key)}
+    start_hour = START_HOUR[con.dialect.name]
+
+    con.execute(sqlalchemy.text(DAILY_REFRESH.format(table=table)), params)
+    con.execute(sqlalchemy.text(HOURLY_REFRESH.format(table=table, start_hour=start_hour)), params)
+    con.execute(sqlalchemy.text(DEMOGRAPHIC_REFRESH.format(table=table)), params)
+
+
+## Remove the rides of a date range from the rollups
+def remove_rollups(con, first_date_key, last_date_key):
+    """
+    Run before the rides of the range are deleted (e.g. when a month is reloaded), in the same transaction.
+
+    Parameters:
+        con (Connection): sqlalchemy connection to the "Citi Bike Rental" database
+        first_date_key (int): first date of the range
+        last_date_key (int): last date of the range
+
+    Returns:
+        None
+    """
+
+    params = {'first_date_key': int(first_date_key), 'last_date_key': int(last_date_key)}
+
+    con.execute(sqlalchemy.text(DEMOGRAPHIC_REMOVE), params)
+    con.execute(sqlalchemy.text('DELETE FROM demographic_rollup WHERE ride_totals = 0'))
+    con.execute(sqlalchemy.text('DELETE FROM daily_rollup WHERE date_key BETWEEN :first_date_key AND :last_date_key'), params)
+    con.execute(sqlalchemy.text('DELETE FROM hourly_rollup WHERE date_key BETWEEN :first_date_key AND :last_date_key'), params)
+
+
+## Rebuild the rollups from the whole `rides` table
+def rebuild_rollups(con):
+    """
+    Parameters:
+        con (Connection): sqlalchemy connection to the "Citi Bike Rental" database
+
+    Returns:
+        None
+    """
+
+    create_rollups(con)
+    for table in ROLLUP_TABLES:
+        con.execute(sqlalchemy.text('DELETE FROM ' + table))
+
+    ids = con.execute(sqlalchemy.text('SELECT min(id), max(id) FROM rides')).fetchone()
+    if ids[0] is not None:
+        refresh_rollups(con, ids[0], ids[1])
+
+
+""" Benchmark """
+# Previous definitions of the views, scanning `rides` on every query
+RAW_QUERIES = {
+    'daily_counts': """
+        SELECT date_dim.date_key, date_dim.full_date, date_dim.month_name, date_dim.day, date_dim.day_name,
+            date_dim.weekend,
+            count(rides.id) AS ride_totals,
+            count(trip_demo.user_type) filter (where trip_demo.user_type = 'Subscriber') as subscriber_rides,
+            count(trip_demo.user_type) filter (where trip_demo.user_type = 'Customer') AS customer_rides,
+            count(trip_demo.user_type) filter (where trip_demo.user_type = 'Unknown')  unknown_rides,
+            count(rides.valid_duration) filter (where not rides.valid_duration) AS late_return
+          FROM rides
+            RIGHT JOIN date_dim ON rides.date_key = date_dim.date_key
+            LEFT JOIN trip_demo ON rides.trip_demo = trip_demo.id
+         GROUP BY date_dim.date_key
+         ORDER BY date_dim.date_key""",
+    'hourly_summary': """
+        SELECT EXTRACT(hour FROM rides.start_time) AS start_hour,
+            count(*) AS ride_totals
+          FROM rides
+         GROUP BY (EXTRACT(hour FROM rides.start_time))
+         ORDER BY (count(*)) DESC""",
+    'trip_demographics': """
+        SELECT count(rides.id) AS total_rides, trip_demo.age, trip_demo.gender, trip_demo.user_type
+          FROM rides
+            JOIN trip_demo ON rides.trip_demo = trip_demo.id
+         GROUP BY trip_demo.age, trip_demo.gender, trip_demo.user_type
+         ORDER BY trip_demo.user_type, trip_demo.gender, trip_demo.age""",
+}
+
+
+## Compare the latency of the views (reading the rollups) with the previous raw queries
+def benchmark(engine, repeat=5):
+    """
+    Run against the Postgres database, once `create_views.sql` has been applied.
+
+    Parameters:
+        engine (Engine): sqlalchemy engine of the "Citi Bike Rental" database
+        repeat (int): number of runs per query (the median is kept)
+
+    Returns:
+        results (DataFrame): median latency (ms) of each view, before and after
+    """
+
+    results = []
+    with engine.connect() as con:
+        for view, raw_query in RAW_QUERIES.items():
+            timings = {}
+            for label, query in [('raw_ms', raw_query), ('rollup_ms', 'SELECT * FROM ' + view)]:
+                runs = []
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    con.execute(sqlalchemy.text(query)).fetchall()
+                    runs.append((time.perf_counter() - start) * 1000)
+                timings[label] = round(pd.Series(runs).median(), 2)
+
+            results.append({'view': view, **timings, 'speedup': round(timings['raw_ms'] / timings['rollup_ms'], 1)})
+
+    return(pd.DataFrame(results))
+
+
+if __name__ == "__main__":
+
+    from load_data_into_db import DB_URL
+
+    parser = argparse.ArgumentParser(description='Maintain and benchmark the rollups of the rides table')
+    parser.add_argument('--db-url', default=DB_URL, help='sqlalchemy url of the database')
+    parser.add_argument('--rebuild', action='store_true', help='rebuild the rollups from the whole rides table')
+    parser.add_argument('--benchmark', action='store_true', help='compare the views with the previous raw queries')
+    args = parser.parse_args()
+
+    engine = sqlalchemy.create_engine(args.db_url)
+    if args.rebuild:
+        with engine.begin() as con:
+            rebuild_rollups(con)
+    if args.benchmark:
+        print(benchmark(engine).to_string(index=False))
@@ -0,0 +1,261 @@
+'''  CITI BIKE RENTAL - Parquet staging '''
+
+# Cleaned and typed copies of the raw files, so they are parsed only once. Each monthly trip file
+# is staged as month-partitioned parquet files (cleaned trips, plus the stations and demographics
+# seen that month), and the weather file as one parquet file. A staged file is rebuilt only when
+# the content hash of its source file changes (hashes are kept in `manifest.json`).
+#
+# Staged columns can be memory-mapped, e.g. from the exploration notebook:
+#     from staging import read_staged
+#     df_trips = read_staged('trips', columns=['start_time','trip_duration_min'])
+
+
+## Import libraries
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import os
+import json
+import hashlib
+import argparse
+
+from read_data import list_trip_files, month_of, read_clean_trip_chunks, build_weather, DATA_DIR, WEATHER_FILE, CHUNKSIZE
+
+
+## Parameters
+STAGING_DIR = 'staging'
+TRIP_TABLES = ['trips','stations','demographics']
+
+
+""" Manifest """
+## Content hash of a source file
+def file_hash(path, block_size=1024*1024):
+    """
+    Parameters:
+        path (str): path of the source file
+        block_size (int): number of bytes read at a time
+
+    Returns:
+        digest (str): sha256 of the file content
+    """
+
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha.update(block)
+
+    return(sha.hexdigest())
+
+
+## Read the manifest of the staged files
+def read_manifest(staging_dir=STAGING_DIR):
+    """
+    Parameters:
+        staging_dir (str): folder of the staged files
+
+    Returns:
+        manifest (dict): source file name -> {'sha256': hash of the source, 'files': staged files}
+    """
+
+    path = os.path.join(staging_dir, 'manifest.json')
+    if not os.path.exists(path):
+        return({})
+    with open(path) as f:
+        return(json.load(f))
+
+
+## Write the manifest of the staged files
+def write_manifest(manifest, staging_dir=STAGING_DIR):
+    """
+    Parameters:
+        manifest (dict): source file name -> {'sha256': hash of the source, 'files': staged files}
+        staging_dir (str): folder of the staged files
+
+    Returns:
+        None
+    """
+
+    path = os.path.join(staging_dir, 'manifest.json')
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+""" Staging """
+## Path of a staged file
+def staged_path(table, partition, staging_dir=STAGING_DIR):
+    """
+    Parameters:
+        table (str): staged table (`trips`, `stations`, `demographics` or `weather`)
+        partition (str): month (YYYYMM) of a trip table, or name of the weather file
+        staging_dir (str): folder of the staged files
+
+    Returns:
+        path (str): path of the parquet file
+    """
+
+    return(os.path.join(staging_dir, table, partition + '.parquet'))
+
+
+## Write a DataFrame to parquet (temporary file first, so a staged file is never left half written)
+def write_parquet(df, path):
+    """
+    Parameters:
+        df (DataFrame): table to write
+        path (str): path of the parquet file
+
+    Returns:
+        None
+    """
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    df.to_parquet(path + '.tmp', index=False)
+    os.replace(path + '.tmp', path)
+
+
+## Stage a monthly trip file
+def stage_trip_file(path, staging_dir=STAGING_DIR, chunksize=CHUNKSIZE):
+    """
+    The trips are cleaned and written chunk by chunk, so staging a file stays bounded in memory.
+
+    Parameters:
+        path (str): path of a monthly trip file
+        staging_dir (str): folder of the staged files
+        chunksize (int): number of rows per chunk
+
+    Returns:
+        files (list): paths of the staged files
+    """
+
+    month = month_of(path)
+    trips_path = staged_path('trips', month, staging_dir)
+    os.makedirs(os.path.dirname(trips_path), exist_ok=True)
+
+    writer, stations, demographics = None, [], []
+    for chunk in read_clean_trip_chunks(path, chunksize):
+        table = pa.Table.from_pandas(chunk, preserve_index=False, schema=None if writer is None else writer.schema)
+        if writer is None:
+            writer = pq.ParquetWriter(trips_path + '.tmp', table.schema)
+        writer.write_table(table)
+
+        starts = chunk[['start_station_id','start_station_name','start_station_latitude','start_station_longitude']]
+        ends = chunk[['end_station_id','end_station_name','end_station_latitude','end_station_longitude']]
+        starts.columns = ['id','station_name','latitude','longitude']
+        ends.columns = ['id','station_name','latitude','longitude']
+        stations.append(pd.concat([starts,ends]).drop_duplicates())
+        demographics.append(chunk[['user_type','birth_year','gender','age']].drop_duplicates())
+
+    if writer is None:
+        raise ValueError('No trips found in ' + path)
+    writer.close()
+    os.replace(trips_path + '.tmp', trips_path)
+
+    write_parquet(pd.concat(stations).drop_duplicates(), staged_path('stations', month, staging_dir))
+    write_parquet(pd.concat(demographics).drop_duplicates(), staged_path('demographics', month, staging_dir))
+
+    return([staged_path(table, month, staging_dir) for table in TRIP_TABLES])
+
+
+## Stage the weather file
+def stage_weather_file(path, staging_dir=STAGING_DIR):
+    """
+    Parameters:
+        path (str): path of the weather file
+        staging_dir (str): folder of the staged files
+
+    Returns:
+        files (list): path of the staged file
+    """
+
+    weather_path = staged_path('weather', os.path.splitext(os.path.basename(path))[0], staging_dir)
+    write_parquet(build_weather(path), weather_path)
+
+    return([weather_path])
+
+
+## Stage a source file, unless it's already staged with the same content
+def ensure_staged(path, staging_dir=STAGING_DIR, chunksize=CHUNKSIZE):
+    """
+    Parameters:
+        path (str): path of a monthly trip file or of the weather file
+        staging_dir (str): folder of the staged files
+        chunksize (int): number of rows per chunk
+
+    Returns:
+        staged (str): path of the staged trips (trip file) or weather (weather file)
+    """
+
+    os.makedirs(staging_dir, exist_ok=True)
+    manifest = read_manifest(staging_dir)
+    name = os.path.basename(path)
+    digest = file_hash(path)
+
+    entry = manifest.get(name)
+    if entry is None or entry['sha256'] != digest or not all(os.path.exists(f) for f in entry['files']):
+        if name.startswith('JC'):
+            files = stage_trip_file(path, staging_dir, chunksize)
+        else:
+            files = stage_weather_file(path, staging_dir)
+
+        # Re-read, in case another file was staged in the meantime
+        manifest = read_manifest(staging_dir)
+        manifest[name] = {'sha256': digest, 'files': files}
+        write_manifest(manifest, staging_dir)
+        entry = manifest[name]
+
+    return(entry['files'][0])
+
+
+""" Reading the staged files """
+## Read staged trips in chunks
+def read_staged_chunks(path, chunksize=CHUNKSIZE):
+    """
+    Parameters:
+        path (str): path of the staged trips of a month
+        chunksize (int): number of rows per chunk
+
+    Returns:
+        chunks (generator): cleaned DataFrames of at most `chunksize` rows
+    """
+
+    parquet_file = pq.ParquetFile(path, memory_map=True)
+    for batch in parquet_file.iter_batches(batch_size=chunksize):
+        yield batch.to_pandas()
+
+
+## Read a staged table (memory-mapped)
+def read_staged(table, staging_dir=STAGING_DIR, months=None, columns=None):
+    """
+    Parameters:
+        table (str): staged table (`trips`, `stations`, `demographics` or `weather`)
+        staging_dir (str): folder of the staged files
+        months (list): YYYYMM partitions to read (all of them if None)
+        columns (list): columns to read (all of them if None)
+
+    Returns:
+        df (DataFrame): staged rows, in partition order
+    """
+
+    table_dir = os.path.join(staging_dir, table)
+    partitions = sorted(file[:-len('.parquet')] for file in os.listdir(table_dir) if file.endswith('.parquet'))
+    if months is not None:
+        partitions = [partition for partition in partitions if partition in [str(month) for month in months]]
+
+    tables = [pq.read_table(staged_path(table, partition, staging_dir), columns=columns, memory_map=True)
+              for partition in partitions]
+    if len(tables) == 0:
+        return(pd.DataFrame(columns=columns))
+
+    return(pa.concat_tables(tables).to_pandas())
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Stage the raw trip and weather files as parquet')
+    parser.add_argument('--data-dir', default=DATA_DIR, help='folder containing the trip and weather files')
+    parser.add_argument('--staging-dir', default=STAGING_DIR, help='folder of the staged files')
+    parser.add_argument('--chunksize', type=int, default=CHUNKSIZE, help='number of trip rows processed at a time')
+    args = parser.parse_args()
+
+    for path in list_trip_files(args.data_dir) + [os.path.join(args.data_dir, WEATHER_FILE)]:
+        print('Staged ' + ensure_staged(path, args.staging_dir, args.chunksize))
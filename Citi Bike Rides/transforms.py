@@ -0,0 +1,204 @@
+'''  CITI BIKE RENTAL - Transforms '''
+
+# Column transforms of the trip, weather and date tables, written as whole-column (vectorised)
+# operations instead of row-by-row `.apply(lambda ...)` calls. The output schema is the same:
+# run `python transforms.py` to check the parity with the previous lambdas and time each transform.
+
+
+## Import libraries
+import pandas as pd
+import time
+import argparse
+
+
+""" Transforms """
+## Integer date key (YYYYMMDD), computed arithmetically from the datetime column
+def date_key(dates):
+    """
+    Parameters:
+        dates (Series): datetime64 column
+
+    Returns:
+        keys (Series): int64 date keys, e.g. 20160101
+    """
+
+    return((dates.dt.year * 10000 + dates.dt.month * 100 + dates.dt.day).astype('int64'))
+
+
+## Trip chunk cleaning
+def transform_trips(df):
+    """
+    Parameters:
+        df (DataFrame): chunk of trips, with formatted column names and parsed start/stop times
+
+    Returns:
+        df (DataFrame): chunk with the `age`, duration, `valid_duration` and `date_key` columns added
+    """
+
+    # Add `age` column
+    df['age'] = 2016 - df['birth_year'].values
+
+    # We'll replace replace the NaN by "unknown" in `user_type` category
+    df.fillna({'user_type':'Unknown'},inplace=True)
+
+    # Add min & hrs duration columns to the df for ease of interpretation
+    df['trip_duration_min'] = (df['trip_duration'] / 60).round(1)
+    df['trip_duration_hrs'] = (df['trip_duration'] / (60*60)).round(1)
+
+    # Add `valid_duration` flag (negated comparison, so a missing duration is still valid as before)
+    df['valid_duration'] = ~(df['trip_duration_hrs'] > 24)
+
+    # Add the date key
+    df['date_key'] = date_key(df['start_time'])
+
+    return(df)
+
+
+## Weather flags
+def add_weather_flags(df):
+    """
+    Parameters:
+        df (DataFrame): weather table, with renamed columns and a datetime `rec_date`
+
+    Returns:
+        df (DataFrame): weather table with the `rain`, `snow` and `date_key` columns added
+    """
+
+    df['rain'] = df['prcp'] > 0
+    df['snow'] = df['snowfall'] > 0
+    df['date_key'] = date_key(df['rec_date'])
+
+    return(df)
+
+
+## Date Dimension table
+def build_date_dim(start='2016-01-01', periods=366):
+    """
+    Parameters:
+        start (str): first day of the table
+        periods (int): number of days (2016 is a leap year)
+
+    Returns:
+        df_date (DataFrame): one row per day
+    """
+
+    df_date = pd.DataFrame({'full_date': pd.date_range(start, periods=periods, freq='D')})
+
+    # Create month and day columns
+    df_date['month'] = df_date['full_date'].dt.month.astype('int64')
+    df_date['day'] = df_date['full_date'].dt.day.astype('int64')
+    df_date['month_name'] = df_date['full_date'].dt.month_name()
+    df_date['day_name'] = df_date['full_date'].dt.day_name()
+    df_date['weekend'] = df_date['full_date'].dt.dayofweek >= 5
+
+    # Let's add a date key
+    df_date['date_key'] = date_key(df_date['full_date'])
+
+    return(df_date)
+
+
+""" Parity check and benchmark """
+## Previous row-by-row implementations, kept as the reference output
+LEGACY = {
+    'trip_duration_min': lambda df: round(df.trip_duration.apply(lambda x: x/60),1),
+    'trip_duration_hrs': lambda df: round(df.trip_duration.apply(lambda x: x/(60*60)),1),
+    'valid_duration': lambda df: df.trip_duration_hrs.apply(lambda x: 0 if x > 24 else 1).astype(bool),
+    'date_key': lambda df: df['start_time'].apply(lambda x: int(x.strftime('%Y%m%d').strip('-'))),
+    'rain': lambda df: df.prcp.apply(lambda x: 1 if x > 0 else 0).astype(bool),
+    'snow': lambda df: df.snowfall.apply(lambda x: 1 if x > 0 else 0).astype(bool),
+    'month': lambda df: df['full_date'].apply(lambda x: x.month),
+    'day': lambda df: df['full_date'].apply(lambda x: x.day),
+    'month_name': lambda df: df['full_date'].apply(lambda x: x.strftime('%B')),
+    'day_name': lambda df: df['full_date'].apply(lambda x: x.strftime('%A')),
+    'weekend': lambda df: df['full_date'].apply(lambda x: x.strftime('%A')) \
+        .apply(lambda x: 1 if (x == 'Saturday' or x=='Sunday') else 0).astype(bool),
+}
+
+## Vectorised implementations, one column at a time
+VECTORISED = {
+    'trip_duration_min': lambda df: (df['trip_duration'] / 60).round(1),
+    'trip_duration_hrs': lambda df: (df['trip_duration'] / (60*60)).round(1),
+    'valid_duration': lambda df: ~(df['trip_duration_hrs'] > 24),
+    'date_key': lambda df: date_key(df['start_time']),
+    'rain': lambda df: df['prcp'] > 0,
+    'snow': lambda df: df['snowfall'] > 0,
+    'month': lambda df: df['full_date'].dt.month.astype('int64'),
+    'day': lambda df: df['full_date'].dt.day.astype('int64'),
+    'month_name': lambda df: df['full_date'].dt.month_name(),
+    'day_name': lambda df: df['full_date'].dt.day_name(),
+    'weekend': lambda df: df['full_date'].dt.dayofweek >= 5,
+}
+
+
+## Synthetic input covering the columns used by every transform
+def make_sample(n_rows, seed=0):
+    """
+    Parameters:
+        n_rows (int): number of rows
+        seed (int): seed of the random generator
+
+    Returns:
+        df (DataFrame): sample with trip, weather and date columns (including a few missing values)
+    """
+
+    df = pd.DataFrame({'trip_duration': pd.Series(range(n_rows)).sample(frac=1, random_state=seed).values * 7,
+                       'start_time': pd.Timestamp('2016-01-01') + pd.to_timedelta(range(0, n_rows*97, 97), unit='s'),
+                       'prcp': pd.Series(range(n_rows)) % 5 / 10,
+                       'snowfall': pd.Series(range(n_rows)) % 7 / 10})
+    df['full_date'] = df['start_time'].dt.normalize()
+    df.loc[::1000, ['prcp','snowfall']] = float('nan')
+    df['trip_duration_hrs'] = (df['trip_duration'] / (60*60)).round(1)
+
+    return(df)
+
+
+## Check each vectorised transform against the previous lambda and time both
+def benchmark(n_rows=1000000, repeat=3):
+    """
+    Parameters:
+        n_rows (int): number of rows of the sample
+        repeat (int): number of timings per transform (the best is kept)
+
+    Returns:
+        results (DataFrame): parity and timings per transform
+    """
+
+    df = make_sample(n_rows)
+    results = []
+
+    for name in VECTORISED:
+        timings = {}
+        for label, transform in [('legacy', LEGACY[name]), ('vectorised', VECTORISED[name])]:
+            best = None
+            for _ in range(repeat):
+                start = time.perf_counter()
+                output = transform(df)
+                seconds = time.perf_counter() - start
+                best = seconds if best is None else min(best, seconds)
+            timings[label] = (output, best)
+
+        expected, actual = timings['legacy'][0], timings['vectorised'][0]
+        identical = expected.dtype == actual.dtype and expected.equals(actual)
+
+        results.append({'transform': name,
+                        'identical': identical,
+                        'legacy_sec': round(timings['legacy'][1], 4),
+                        'vectorised_sec': round(timings['vectorised'][1], 4),
+                        'speedup': round(timings['legacy'][1] / timings['vectorised'][1], 1)})
+
+    return(pd.DataFrame(results))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Check and time the vectorised transforms against the previous lambdas')
+    parser.add_argument('--rows', type=int, default=1000000, help='number of rows of the sample')
+    parser.add_argument('--repeat', type=int, default=3, help='number of timings per transform')
+    args = parser.parse_args()
+
+    results = benchmark(args.rows, args.repeat)
+    print(results.to_string(index=False))
+
+    if not results['identical'].all():
+        raise SystemExit('Some transforms differ from the previous implementation: '
+                         + str(list(results.loc[~results['identical'], 'transform'])))
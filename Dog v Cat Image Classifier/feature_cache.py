@@ -0,0 +1,550 @@
+'''  Dogs vs Cats - VGG16 bottleneck features '''
+
+# Trains the model of `dogs_vs_cats_cnn_vgg16_fine_tuning.ipynb` without recomputing its frozen layers.
+# The first 15 layers of VGG16 (up to `block4_pool`, the input of `block5`) are frozen, so their output
+# for an image never changes: it is computed once per image and stored in a memory-mapped array
+# (`features.npy`, one row per image, `index.json` maps each filename to its row). The trainable part
+# (the `block5` convolutions, with the VGG16 weights, and the notebook's head) is then trained on the
+# cached features. Images are read by a `tf.data` pipeline (parallel decoding, batches prefetched while
+# the model runs) in place of `ImageDataGenerator.flow_from_dataframe`.
+#
+#     from feature_cache import make_dataframes, build_models, train_cached
+#     train_df, valid_df = make_dataframes()
+#     prefix, head, model = build_models()
+#     history = train_cached(prefix, head, train_df, valid_df)   # `model` (images in) shares the trained weights
+#
+#     python feature_cache.py                    # cache the features and train the head on them
+#     python feature_cache.py --mode images      # train the full model on the tf.data pipeline (with augmentation)
+#     python feature_cache.py --benchmark        # images/sec of each input pipeline and training step
+#     python feature_cache.py --check            # compare the pipeline and the cache with the notebook's path
+#
+# The cached features are of the un-augmented images (the notebook's validation preprocessing): the
+# random augmentation of the training generator can't be cached, use `--mode images` to keep it.
+
+
+## Import libraries
+import numpy as np
+import pandas as pd
+import os
+import json
+import time
+import hashlib
+import argparse
+
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2' # to stop tf false warning
+
+import tensorflow as tf
+from keras import layers
+from keras.models import Model, Sequential
+from keras.layers import Input, Dropout, Dense, GlobalMaxPooling2D
+from keras.optimizers import SGD
+from keras.applications import VGG16
+from keras.callbacks import EarlyStopping
+from keras.utils import load_img, img_to_array
+from sklearn.model_selection import train_test_split
+
+
+## Parameters (as in the notebook)
+TRAIN_PATH = '../Dogs_Cats/train/'
+TEST_PATH = '../Dogs_Cats/test1/'
+CACHE_DIR = '../Dogs_Cats/features/'
+MODEL_FILE = '../Dogs_Cats/best_model.h5'
+
+TEST_VALID_SPLIT = 0.15
+IMAGE_SIZE = 128
+EPOCHS = 20
+BATCH_SIZE = 16
+
+# Layers of VGG16 frozen by the notebook (`pre_trained_model.layers[:15]`, i.e. up to `block4_pool`)
+FROZEN_LAYERS = 15
+AUTOTUNE = tf.data.AUTOTUNE
+
+
+""" Datasets """
+## Training and validation dataframes (filenames and labels), as in the notebook
+def make_dataframes(train_path=TRAIN_PATH, test_valid_split=TEST_VALID_SPLIT, fast_run=False, random_state=None):
+    """
+    Parameters:
+        train_path (str): folder of the training images (`dog.*.jpg` and `cat.*.jpg`)
+        test_valid_split (float): share of the images kept for validation
+        fast_run (bool): only keep 2000 training and 100 validation images
+        random_state (int): seed of the split (None for a random split)
+
+    Returns:
+        train_df (DataFrame): `filename` and `category` (1 for dogs, 0 for cats) of the training images
+        valid_df (DataFrame): same for the validation images
+    """
+
+    filenames = sorted(os.listdir(train_path))
+    categories = [1 if filename.split('.')[0] == 'dog' else 0 for filename in filenames]
+    df = pd.DataFrame({'filename': filenames, 'category': categories})
+
+    train_df, valid_df = train_test_split(df, test_size=test_valid_split, random_state=random_state)
+    if fast_run:
+        train_df = train_df.sample(n=min(2000, len(train_df)), random_state=random_state)
+        valid_df = valid_df.sample(n=min(100, len(valid_df)), random_state=random_state)
+
+    return(train_df.reset_index(), valid_df.reset_index())
+
+
+""" Input pipeline """
+## Read, decode and resize an image (as `flow_from_dataframe`: nearest neighbour resize, rescaled by 1/255)
+def decode_image(path, image_size=IMAGE_SIZE):
+    """
+    Parameters:
+        path (tf.string): path of a JPEG image
+        image_size (int): height and width of the resized image
+
+    Returns:
+        image (tf.Tensor): float32 image of shape (image_size, image_size, 3), values between 0 and 1
+    """
+
+    # Accurate IDCT, as PIL decodes (tf's default fast IDCT changes pixel values by a few levels)
+    image = tf.io.decode_jpeg(tf.io.read_file(path), channels=3, dct_method='INTEGER_ACCURATE')
+    image = tf.image.resize(image, (image_size, image_size), method='nearest')
+
+    return(tf.cast(image, tf.float32) / 255.)
+
+
+## Random augmentation of the notebook's training generator (shear aside, no Keras layer for it)
+def make_augmenter(seed=None):
+    """
+    Parameters:
+        seed (int): seed of the random transformations
+
+    Returns:
+        augmenter (Sequential): augments a batch of images
+    """
+
+    return(Sequential([
+        layers.RandomRotation(15 / 360, fill_mode='nearest', seed=seed),
+        layers.RandomZoom(0.2, fill_mode='nearest', seed=seed),
+        layers.RandomTranslation(0.1, 0.1, fill_mode='nearest', seed=seed),
+        layers.RandomFlip('horizontal', seed=seed)
+    ]))
+
+
+## Batches of images (and labels) decoded in parallel and prefetched
+def image_dataset(filenames, image_dir, labels=None, batch_size=BATCH_SIZE, shuffle=False, augment=False,
+                  image_size=IMAGE_SIZE):
+    """
+    Parameters:
+        filenames (list): images to read
+        image_dir (str): folder of the images
+        labels (list): label of each image (None for images only)
+        batch_size (int): images per batch
+        shuffle (bool): shuffle the images at each epoch (the batches are then yielded as soon as ready)
+        augment (bool): apply the training augmentation
+        image_size (int): height and width of the resized images
+
+    Returns:
+        dataset (tf.data.Dataset): batches of images, or of (images, labels)
+    """
+
+    paths = [os.path.join(image_dir, filename) for filename in filenames]
+    dataset = tf.data.Dataset.from_tensor_slices(paths if labels is None else (paths, np.asarray(labels)))
+    if shuffle:
+        dataset = dataset.shuffle(len(paths), reshuffle_each_iteration=True)
+
+    if labels is None:
+        dataset = dataset.map(lambda path: decode_image(path, image_size),
+                              num_parallel_calls=AUTOTUNE, deterministic=not shuffle)
+    else:
+        dataset = dataset.map(lambda path, label: (decode_image(path, image_size), label),
+                              num_parallel_calls=AUTOTUNE, deterministic=not shuffle)
+    dataset = dataset.batch(batch_size)
+
+    if augment:
+        augmenter = make_augmenter()
+        if labels is None:
+            dataset = dataset.map(lambda images: augmenter(images, training=True), num_parallel_calls=AUTOTUNE)
+        else:
+            dataset = dataset.map(lambda images, labels: (augmenter(images, training=True), labels),
+                                  num_parallel_calls=AUTOTUNE)
+
+    return(dataset.prefetch(AUTOTUNE))
+
+
+""" Models """
+## Frozen prefix, trainable head and full model (the notebook's model, split at `block4_pool`)
+def build_models(weights='imagenet', image_size=IMAGE_SIZE):
+    """
+    The head applies the same `block5` layers as the full model, so the weights trained on the cached
+    features are the weights of `model`.
+
+    Parameters:
+        weights (str): VGG16 weights (`imagenet`, or None for random weights)
+        image_size (int): height and width of the input images
+
+    Returns:
+        prefix (Model): frozen VGG16 layers (images to `block4_pool` features)
+        head (Model): `block5` and the added layers (features to prediction)
+        model (Model): prefix then head (images to prediction), as the notebook's model
+    """
+
+    pre_trained_model = VGG16(input_shape=(image_size, image_size, 3), include_top=False, weights=weights)
+    for layer in pre_trained_model.layers[:FROZEN_LAYERS]:
+        layer.trainable = False
+
+    prefix = Model(pre_trained_model.input, pre_trained_model.layers[FROZEN_LAYERS - 1].output)
+    prefix.trainable = False
+
+    features = Input(shape=prefix.output.shape[1:])
+    x = features
+    for layer in pre_trained_model.layers[FROZEN_LAYERS:]:
+        x = layer(x)
+    x = GlobalMaxPooling2D()(x)
+    x = Dense(512, activation='relu')(x) # Add a fully connected layer
+    x = Dropout(0.5)(x) # Add a dropout layer
+    x = Dense(1, activation='sigmoid')(x) # Sigmoid for classification
+    head = Model(features, x)
+
+    model = Model(prefix.input, head(prefix.output))
+    for m in [head, model]:
+        m.compile(loss='binary_crossentropy', optimizer=SGD(learning_rate=1e-4, momentum=0.9), metrics=['accuracy'])
+
+    return(prefix, head, model)
+
+
+""" Feature cache """
+## Hash of the weights of the frozen layers (the cached features are only valid for these weights)
+def weights_hash(prefix):
+    """
+    Parameters:
+        prefix (Model): frozen layers
+
+    Returns:
+        hash (str): sha256 of the weights
+    """
+
+    sha = hashlib.sha256()
+    for weight in prefix.get_weights():
+        sha.update(np.ascontiguousarray(weight).tobytes())
+
+    return(sha.hexdigest())
+
+
+## Read the index of a feature cache
+def read_index(cache_dir):
+    """
+    Parameters:
+        cache_dir (str): folder of the cache (`features.npy` and `index.json`)
+
+    Returns:
+        index (dict): `filenames` (in row order) and the settings of the cached features (None if no cache)
+    """
+
+    path = os.path.join(cache_dir, 'index.json')
+    if not os.path.exists(path):
+        return(None)
+    with open(path) as f:
+        return(json.load(f))
+
+
+## Compute the features of the missing images and add them to the cache
+def update_cache(prefix, filenames, image_dir, cache_dir, dtype=None, batch_size=64):
+    """
+    The new cache is written next to the current one and renamed over it (features first, index last),
+    so an interrupted update leaves the previous cache usable.
+
+    Parameters:
+        prefix (Model): frozen layers
+        filenames (list): images that must be in the cache
+        image_dir (str): folder of the images
+        cache_dir (str): folder of the cache
+        dtype (str): dtype of the stored features (`float16` halves the size of the cache, None to keep the
+            cache's dtype, `float32` for a new cache)
+        batch_size (int): images per forward pass
+
+    Returns:
+        n_new (int): number of images added to the cache
+    """
+
+    index = read_index(cache_dir)
+    if dtype is None:
+        dtype = 'float32' if index is None else index['settings']['dtype']
+    settings = {'image_size': int(prefix.input.shape[1]), 'layer': prefix.layers[-1].name,
+                'weights': weights_hash(prefix), 'dtype': dtype}
+    if index is None or index['settings'] != settings:
+        index = {'settings': settings, 'filenames': []}
+
+    cached = set(index['filenames'])
+    missing = [filename for filename in dict.fromkeys(filenames) if filename not in cached]
+    if len(missing) == 0:
+        return(0)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    features_path = os.path.join(cache_dir, 'features.npy')
+    n_old = len(index['filenames'])
+    features = np.lib.format.open_memmap(features_path + '.tmp', mode='w+', dtype=dtype,
+                                         shape=(n_old + len(missing),) + tuple(prefix.output.shape[1:]))
+
+    # Rows already cached are copied over in blocks, then the missing images are run through the prefix
+    if n_old > 0:
+        old = np.load(features_path, mmap_mode='r')
+        for start in range(0, n_old, 1024):
+            features[start:min(start + 1024, n_old)] = old[start:start + 1024]
+        del old
+
+    row = n_old
+    for images in image_dataset(missing, image_dir, batch_size=batch_size, image_size=settings['image_size']):
+        batch = prefix(images, training=False).numpy()
+        features[row:row + len(batch)] = batch
+        row += len(batch)
+    features.flush()
+    del features
+
+    os.replace(features_path + '.tmp', features_path)
+    index['filenames'] = index['filenames'] + missing
+    with open(os.path.join(cache_dir, 'index.json.tmp'), 'w') as f:
+        json.dump(index, f)
+    os.replace(os.path.join(cache_dir, 'index.json.tmp'), os.path.join(cache_dir, 'index.json'))
+
+    return(len(missing))
+
+
+## Batches of cached features (and labels), read from the memory-mapped cache and prefetched
+def feature_dataset(filenames, cache_dir, labels=None, batch_size=BATCH_SIZE, shuffle=False):
+    """
+    Parameters:
+        filenames (list): images whose features are read (all in the cache)
+        cache_dir (str): folder of the cache
+        labels (list): label of each image (None for features only)
+        batch_size (int): images per batch
+        shuffle (bool): shuffle the images at each epoch
+
+    Returns:
+        dataset (tf.data.Dataset): batches of features, or of (features, labels)
+    """
+
+    row_of = {filename: row for row, filename in enumerate(read_index(cache_dir)['filenames'])}
+    rows = np.array([row_of[filename] for filename in filenames], dtype=np.int64)
+    targets = np.zeros(len(rows), dtype=np.int64) if labels is None else np.asarray(labels, dtype=np.int64)
+    features = np.load(os.path.join(cache_dir, 'features.npy'), mmap_mode='r')
+    shape = (None,) + features.shape[1:]
+
+    # A shuffled batch is read in file order (the order within a batch doesn't matter to the training)
+    def read_rows(positions):
+        if shuffle:
+            positions = positions[np.argsort(rows[positions])]
+        return(features[rows[positions]].astype(np.float32), targets[positions])
+
+    def read_batch(positions):
+        x, y = tf.numpy_function(read_rows, [positions], (tf.float32, tf.int64))
+        x, y = tf.ensure_shape(x, shape), tf.ensure_shape(y, (None,))
+        return(x if labels is None else (x, y))
+
+    dataset = tf.data.Dataset.range(len(rows))
+    if shuffle:
+        dataset = dataset.shuffle(len(rows), reshuffle_each_iteration=True)
+    dataset = dataset.batch(batch_size).map(read_batch, num_parallel_calls=AUTOTUNE, deterministic=not shuffle)
+
+    return(dataset.prefetch(AUTOTUNE))
+
+
+""" Training """
+## Train the head on the cached features (the features of the missing images are cached first)
+def train_cached(prefix, head, train_df, valid_df, train_path=TRAIN_PATH, cache_dir=CACHE_DIR, epochs=EPOCHS,
+                 batch_size=BATCH_SIZE, dtype=None):
+    """
+    Parameters:
+        prefix (Model): frozen layers
+        head (Model): compiled head (trained in place)
+        train_df (DataFrame): `filename` and `category` of the training images
+        valid_df (DataFrame): same for the validation images
+        train_path (str): folder of the images
+        cache_dir (str): folder of the cache
+        epochs (int): maximum number of epochs (stopped early on the validation accuracy)
+        batch_size (int): images per batch
+        dtype (str): dtype of the stored features (None to keep the cache's dtype)
+
+    Returns:
+        history (History): losses and accuracies of each epoch
+    """
+
+    update_cache(prefix, list(train_df['filename']) + list(valid_df['filename']), train_path, cache_dir, dtype)
+
+    early_stopping_callback = EarlyStopping(monitor='val_accuracy', patience=3, restore_best_weights=True)
+    return(head.fit(feature_dataset(train_df['filename'], cache_dir, train_df['category'], batch_size, shuffle=True),
+                    epochs=epochs,
+                    validation_data=feature_dataset(valid_df['filename'], cache_dir, valid_df['category'], batch_size),
+                    callbacks=[early_stopping_callback]))
+
+
+## Train the full model on the images (with the training augmentation), as the notebook does
+def train_images(model, train_df, valid_df, train_path=TRAIN_PATH, epochs=EPOCHS, batch_size=BATCH_SIZE):
+    """
+    Parameters:
+        model (Model): compiled full model (trained in place)
+        train_df (DataFrame): `filename` and `category` of the training images
+        valid_df (DataFrame): same for the validation images
+        train_path (str): folder of the images
+        epochs (int): maximum number of epochs (stopped early on the validation accuracy)
+        batch_size (int): images per batch
+
+    Returns:
+        history (History): losses and accuracies of each epoch
+    """
+
+    early_stopping_callback = EarlyStopping(monitor='val_accuracy', patience=3, restore_best_weights=True)
+    return(model.fit(image_dataset(train_df['filename'], train_path, train_df['category'], batch_size,
+                                   shuffle=True, augment=True),
+                     epochs=epochs,
+                     validation_data=image_dataset(valid_df['filename'], train_path, valid_df['category'], batch_size),
+                     callbacks=[early_stopping_callback]))
+
+
+""" Benchmark and parity """
+## Batches of images read one by one, as `flow_from_dataframe` reads them (kept as the reference)
+def legacy_batches(filenames, image_dir, batch_size=BATCH_SIZE, image_size=IMAGE_SIZE):
+    """
+    Parameters:
+        filenames (list): images to read
+        image_dir (str): folder of the images
+        batch_size (int): images per batch
+        image_size (int): height and width of the resized images
+
+    Returns:
+        batches (generator): float32 arrays of shape (batch_size, image_size, image_size, 3)
+    """
+
+    filenames = list(filenames)
+    for start in range(0, len(filenames), batch_size):
+        yield(np.stack([img_to_array(load_img(os.path.join(image_dir, filename), target_size=(image_size, image_size),
+                                              interpolation='nearest')) / 255.
+                        for filename in filenames[start:start + batch_size]]).astype(np.float32))
+
+
+## Images per second of a loop over batches (after a first, untimed batch)
+def images_per_sec(batches, step=None, n_batches=50):
+    """
+    Parameters:
+        batches (iterable): batches (arrays, or tuples whose first item is the batch)
+        step (function): run on each batch (None to only read the batches)
+        n_batches (int): number of batches timed
+
+    Returns:
+        rate (float): images per second
+    """
+
+    iterator = iter(batches)
+    batch = next(iterator)
+    if step is not None:
+        step(batch)
+
+    n_images, start = 0, time.perf_counter()
+    for _, batch in zip(range(n_batches), iterator):
+        if step is not None:
+            step(batch)
+        n_images += len(batch[0] if isinstance(batch, tuple) else batch)
+
+    return(n_images / (time.perf_counter() - start))
+
+
+## Throughput of the notebook's input path, the tf.data pipeline, and the training steps with and without the cache
+def benchmark(prefix, head, model, train_df, train_path=TRAIN_PATH, cache_dir=CACHE_DIR, batch_size=BATCH_SIZE,
+              n_batches=50):
+    """
+    The models are trained by the benchmark, use models built for it.
+
+    Parameters:
+        prefix (Model): frozen layers
+        head (Model): compiled head
+        model (Model): compiled full model
+        train_df (DataFrame): `filename` and `category` of the training images (the first ones are used)
+        train_path (str): folder of the images
+        cache_dir (str): folder of the cache
+        batch_size (int): images per batch
+        n_batches (int): number of batches timed
+
+    Returns:
+        results (DataFrame): images per second of each step
+    """
+
+    df = train_df.iloc[:(n_batches + 1) * batch_size]
+    filenames, labels = list(df['filename']), df['category'].to_numpy()
+    update_cache(prefix, filenames, train_path, cache_dir)
+
+    images = lambda: image_dataset(filenames, train_path, labels, batch_size)
+    steps = [('read images (flow_from_dataframe)', legacy_batches(filenames, train_path, batch_size), None),
+             ('read images (tf.data)', images(), None),
+             ('read cached features', feature_dataset(filenames, cache_dir, labels, batch_size), None),
+             ('frozen layers (cache build)', images(), lambda batch: prefix(batch[0], training=False)),
+             ('train step on images', images(), lambda batch: model.train_on_batch(*batch)),
+             ('train step on cached features', feature_dataset(filenames, cache_dir, labels, batch_size),
+              lambda batch: head.train_on_batch(*batch))]
+
+    return(pd.DataFrame([{'step': name, 'images_per_sec': round(images_per_sec(batches, step, n_batches), 1)}
+                         for name, batches, step in steps]))
+
+
+## Compare the tf.data images and the cached features with the notebook's path (`flow_from_dataframe` images)
+def check_parity(prefix, head, model, filenames, image_dir=TRAIN_PATH, cache_dir=CACHE_DIR, batch_size=BATCH_SIZE):
+    """
+    Parameters:
+        prefix (Model): frozen layers
+        head (Model): compiled head
+        model (Model): compiled full model
+        filenames (list): images compared
+        image_dir (str): folder of the images
+        cache_dir (str): folder of the cache
+        batch_size (int): images per batch
+
+    Returns:
+        results (DataFrame): share of identical pixels, largest pixel, feature and prediction differences
+    """
+
+    filenames = list(filenames)
+    update_cache(prefix, filenames, image_dir, cache_dir)
+
+    legacy = np.concatenate(list(legacy_batches(filenames, image_dir, batch_size)))
+    images = np.concatenate([batch.numpy() for batch in image_dataset(filenames, image_dir, batch_size=batch_size)])
+    cached = np.concatenate([batch.numpy() for batch in feature_dataset(filenames, cache_dir, batch_size=batch_size)])
+    features = prefix.predict(legacy, batch_size=batch_size, verbose=0)
+
+    return(pd.DataFrame([{'images': len(filenames),
+                          'same_pixels': round(float(np.mean(images == legacy)), 4),
+                          'max_pixel_diff': float(np.abs(images - legacy).max()),
+                          'max_feature_diff': float(np.abs(cached - features).max()),
+                          'max_prediction_diff': float(np.abs(head.predict(cached, batch_size=batch_size, verbose=0)
+                                                              - model.predict(legacy, batch_size=batch_size, verbose=0)).max())}]))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Train the Dogs vs Cats VGG16 model on cached bottleneck features')
+    parser.add_argument('--train-path', default=TRAIN_PATH, help='folder of the training images')
+    parser.add_argument('--cache-dir', default=CACHE_DIR, help='folder of the feature cache')
+    parser.add_argument('--model-file', default=MODEL_FILE, help='path of the saved model')
+    parser.add_argument('--mode', choices=['cached', 'images'], default='cached',
+                        help='train the head on the cached features, or the full model on the images')
+    parser.add_argument('--epochs', type=int, default=EPOCHS, help='maximum number of epochs')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='images per batch')
+    parser.add_argument('--dtype', choices=['float32', 'float16'], default=None,
+                        help="dtype of the cached features (the cache's by default, float32 for a new cache)")
+    parser.add_argument('--fast-run', action='store_true', help='only use 2000 training and 100 validation images')
+    parser.add_argument('--random-weights', action='store_true', help="don't load the imagenet weights of VGG16")
+    parser.add_argument('--benchmark', action='store_true', help='only report the images/sec of each step')
+    parser.add_argument('--batches', type=int, default=50, help='number of batches timed by the benchmark')
+    parser.add_argument('--check', action='store_true', help="only compare with the notebook's input path")
+    args = parser.parse_args()
+
+    train_df, valid_df = make_dataframes(args.train_path, fast_run=args.fast_run)
+    prefix, head, model = build_models(None if args.random_weights else 'imagenet')
+
+    if args.benchmark:
+        print(benchmark(prefix, head, model, train_df, args.train_path, args.cache_dir, args.batch_size,
+                        args.batches).to_string(index=False))
+    elif args.check:
+        print(check_parity(prefix, head, model, valid_df['filename'][:64], args.train_path, args.cache_dir,
+                           args.batch_size).to_string(index=False))
+    else:
+        start = time.perf_counter()
+        if args.mode == 'cached':
+            history = train_cached(prefix, head, train_df, valid_df, args.train_path, args.cache_dir, args.epochs,
+                                   args.batch_size, args.dtype)
+        else:
+            history = train_images(model, train_df, valid_df, args.train_path, args.epochs, args.batch_size)
+        model.save(args.model_file)
+        print('Best validation accuracy: ' + str(round(max(history.history['val_accuracy']), 4)) + ' after '
+              + str(len(history.history['val_accuracy'])) + ' epochs in ' + str(round(time.perf_counter() - start, 1)) + ' s')
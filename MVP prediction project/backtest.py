@@ -0,0 +1,523 @@
+'''  NBA MVP - Backtesting '''
+
+# Backtests MVP vote share models like `backtest()` of `NBA_MVP_predictions.ipynb`: each season from
+# the start year is predicted by a model trained on the seasons before it (expanding window), and
+# scored with the average precision of the predicted top X. The folds of every model configuration
+# run in a process pool, the ranks and the metric are computed with array operations (same results
+# as `add_ranks` / `find_avg_precision_top_X`, ties included), and the predictions of each
+# (fold, configuration) are cached, so a sweep only fits the folds it hasn't seen yet.
+#
+#     from backtest import backtest, sweep, ridge_grid
+#     mean_avg_precision, avg_precisions, all_predictions = backtest(stats, predictors, model=reg)
+#     results = sweep(stats, ridge_grid([0.01, 0.1, 1, 10], {'base': predictors, 'with ratios': predictors_2}))
+#
+#     python backtest.py --alphas 0.01 0.1 1 10 100     # Ridge alpha sweep on stats_clean.csv
+#     python backtest.py --check                        # compare with the notebook backtest and time both
+
+
+## Import libraries
+import pandas as pd
+import numpy as np
+import os
+import json
+import time
+import hashlib
+import argparse
+import concurrent.futures
+
+from sklearn.base import clone
+from sklearn.linear_model import Ridge
+
+
+## Parameters
+STATS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stats_clean.csv')
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backtest_cache')
+
+# Predictors of the notebook's first model
+PREDICTORS = ['Age', 'G', 'GS', 'MP', 'FG',
+              'FGA', 'FG%', '3P', '3PA', '3P%', '2P', '2PA', '2P%', 'eFG%', 'FT',
+              'FTA', 'FT%', 'ORB', 'DRB', 'TRB', 'AST', 'STL', 'BLK', 'TOV', 'PF',
+              'PTS', 'Year', 'W', 'L', 'W/L%',
+              'GB', 'PS/G', 'PA/G', 'SRS']
+
+
+## Read the cleaned stats (as in the notebook)
+def load_stats(path=STATS_FILE):
+    """
+    Parameters:
+        path (str): path of `stats_clean.csv`
+
+    Returns:
+        stats (DataFrame): one row per player and season
+    """
+
+    stats = pd.read_csv(path)
+    del stats['Unnamed: 0']
+
+    return(stats)
+
+
+""" Ranks and error metric """
+## Positions of the values in descending order, ordered as `sort_values(ascending=False)` orders ties
+def descending_order(values):
+    """
+    Parameters:
+        values (ndarray): values to sort (without NaNs)
+
+    Returns:
+        order (ndarray): positions of the values, largest first
+    """
+
+    return((len(values) - 1 - values[::-1].argsort(kind='quicksort'))[::-1])
+
+
+## Actual and predicted ranks of a season, as `add_ranks` computes them
+def rank_season(share, predictions, rows=None):
+    """
+    Parameters:
+        share (ndarray): actual vote share of each player
+        predictions (ndarray): predicted vote share of each player
+        rows (ndarray): positions of the players in the order of the ranked rows (None for row order)
+
+    Returns:
+        order (ndarray): positions of the players by predicted share (the row order of `add_ranks`)
+        rank (ndarray): actual rank of each player (by position)
+        predicted_rank (ndarray): predicted rank of each player (by position)
+    """
+
+    # The predictions are sorted from the actual share order (as the notebook does), which decides the ties
+    rows = np.arange(len(share)) if rows is None else rows
+    share_order = rows[descending_order(share[rows])]
+    order = share_order[descending_order(predictions[share_order])]
+
+    rank = np.empty(len(share), dtype=np.int64)
+    rank[share_order] = np.arange(1, len(share) + 1)
+    predicted_rank = np.empty(len(share), dtype=np.int64)
+    predicted_rank[order] = np.arange(1, len(share) + 1)
+
+    return(order, rank, predicted_rank)
+
+
+## Average precision of the predicted top X, as `find_avg_precision_top_X` computes it
+def avg_precision_top_x(share, predictions, top_x=5):
+    """
+    Each of the predicted top X scores 1 if its actual rank is the predicted one, 0.7 to 1 if it's in
+    the actual top X (closer is better) and 0.3 to 1 otherwise.
+
+    Parameters:
+        share (ndarray): actual vote share of each player
+        predictions (ndarray): predicted vote share of each player
+        top_x (int): number of predicted players scored
+
+    Returns:
+        avg_precision (float): between 0.3 and 1 (1 if the top X is predicted in the right order)
+    """
+
+    # The notebook ranks the season again from the rows already ranked by `backtest`, which can
+    # change the actual ranks of the players with the same share (e.g. no votes)
+    order, rank, predicted_rank = rank_season(share, predictions, rank_season(share, predictions)[0])
+
+    top = order[:top_x]
+    distance = np.abs(rank[top] - predicted_rank[top])
+    metric = np.where(rank[top] <= top_x,
+                      np.where(distance == 0, 1, 0.7 + 0.3 * 1 / (distance + 1)),
+                      0.3 + 0.7 * 1 / (distance + 1))
+
+    return(sum(metric.tolist()) / len(metric))
+
+
+""" Folds """
+# Data of the backtest in the worker processes (set once per worker by `init_worker`)
+worker_data = {}
+
+
+## Keep the data of the backtest in a worker process
+def init_worker(data):
+    """
+    Parameters:
+        data (dict): `X` (predictors of every column used), `y` (share), `years` and `columns`
+
+    Returns:
+        None
+    """
+
+    worker_data.update(data)
+
+
+## Fit a model on the seasons before a year and predict that year
+def run_fold(model, predictors, year):
+    """
+    Parameters:
+        model (estimator): unfitted scikit-learn model
+        predictors (list): columns used by the model
+        year (int): season predicted
+
+    Returns:
+        predictions (ndarray): predicted share of the players of `year`, in row order
+    """
+
+    columns = [worker_data['columns'].index(predictor) for predictor in predictors]
+    X, y, years = worker_data['X'], worker_data['y'], worker_data['years']
+
+    # Column-major, as pandas passes a DataFrame to scikit-learn (so the fits match the notebook's to the bit)
+    model = clone(model)
+    model.fit(np.asfortranarray(X[years < year][:, columns]), y[years < year])
+
+    return(model.predict(np.asfortranarray(X[years == year][:, columns])))
+
+
+## Hash of the stats used by a configuration (its predictors, the target and the seasons)
+def predictors_hash(data, predictors):
+    """
+    Only the predictors of the configuration are hashed, so adding or removing another
+    configuration of a sweep doesn't invalidate its cached folds.
+
+    Parameters:
+        data (dict): `X`, `y`, `years` and `columns` of the stats (see `run_configs`)
+        predictors (list): columns used by the configuration
+
+    Returns:
+        data_hash (str): sha256 of the predictor columns, target and seasons
+    """
+
+    columns = [data['columns'].index(predictor) for predictor in predictors]
+    arrays = [data['X'][:, columns], data['y'], data['years']]
+
+    return(hashlib.sha256(b''.join(np.ascontiguousarray(array).tobytes() for array in arrays)
+                          + json.dumps(list(predictors)).encode()).hexdigest())
+
+
+## Cache key of a fold of a configuration
+def fold_key(model, predictors, year, data_hash):
+    """
+    Parameters:
+        model (estimator): unfitted scikit-learn model
+        predictors (list): columns used by the model
+        year (int): season predicted
+        data_hash (str): hash of the stats used by the configuration (see `predictors_hash`)
+
+    Returns:
+        key (str): sha256 of the model class and parameters, predictors, year and data
+    """
+
+    config = json.dumps([type(model).__name__, sorted((k, repr(v)) for k, v in model.get_params().items()),
+                         list(predictors), int(year), data_hash])
+
+    return(hashlib.sha256(config.encode()).hexdigest())
+
+
+""" Backtests """
+## Backtest configurations over the same folds (in a process pool, with the cached folds reused)
+def run_configs(stats, configs, top_x=5, start_year=1996, workers=None, cache_dir=CACHE_DIR):
+    """
+    Parameters:
+        stats (DataFrame): one row per player and season (`Player`, `Year`, `Share` and the predictors)
+        configs (list): dicts with a `name`, a `model` (unfitted scikit-learn model) and its `predictors`
+        top_x (int): number of predicted players scored each season
+        start_year (int): first season predicted (at least 5 seasons after the first one)
+        workers (int): number of worker processes (None for the number of cpus, 0 to run in this process)
+        cache_dir (str): folder of the cached predictions (None to disable the cache)
+
+    Returns:
+        results (list): per configuration, its dict with the predicted `years`, `avg_precisions` and
+            `predictions` (per season, in row order), number of `cached` folds and `seconds`
+    """
+
+    if start_year < stats.Year.min() + 5:
+        raise ValueError('The start year needs to be above or equal to ' + str(stats.Year.min() + 5) +
+                         ' in order to train the model with at least 5 years worth of data for the first iteration.')
+
+    start = time.perf_counter()
+    years = list(range(start_year, stats.Year.max() + 1))
+    columns = sorted(set(predictor for config in configs for predictor in config['predictors']))
+    data = {'X': stats[columns].to_numpy(dtype=np.float64), 'y': stats['Share'].to_numpy(dtype=np.float64),
+            'years': stats['Year'].to_numpy(), 'columns': columns}
+
+    # Predictions of every (configuration, year), from the cache or to compute
+    predictions, tasks = {}, []
+    for i, config in enumerate(configs):
+        data_hash = None if cache_dir is None else predictors_hash(data, config['predictors'])
+        for year in years:
+            path = None if cache_dir is None else os.path.join(cache_dir, fold_key(config['model'], config['predictors'], year, data_hash) + '.npy')
+            if path is not None and os.path.exists(path):
+                predictions[i, year] = np.load(path)
+            else:
+                tasks.append((i, year, path))
+
+    if workers == 0 or len(tasks) <= 1:
+        init_worker(data)
+        outputs = [run_fold(configs[i]['model'], configs[i]['predictors'], year) for i, year, _ in tasks]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=min(workers or os.cpu_count(), len(tasks)),
+                                                    initializer=init_worker, initargs=(data,)) as executor:
+            outputs = list(executor.map(run_fold, [configs[i]['model'] for i, _, _ in tasks],
+                                        [configs[i]['predictors'] for i, _, _ in tasks], [year for _, year, _ in tasks]))
+
+    for (i, year, path), output in zip(tasks, outputs):
+        predictions[i, year] = output
+        if path is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            np.save(path + '.tmp.npy', output)
+            os.replace(path + '.tmp.npy', path)
+
+    # Score every fold
+    results = []
+    for i, config in enumerate(configs):
+        avg_precisions = []
+        for year in years:
+            share = data['y'][data['years'] == year]
+            avg_precisions.append(avg_precision_top_x(share, predictions[i, year], top_x))
+        results.append({**config, 'avg_precisions': avg_precisions, 'predictions': [predictions[i, year] for year in years],
+                        'cached': len(years) - sum(1 for task in tasks if task[0] == i), 'years': years})
+
+    seconds = round(time.perf_counter() - start, 2)
+    for result in results:
+        result['seconds'] = seconds
+
+    return(results)
+
+
+## Backtest a model (drop-in replacement of the notebook's `backtest`)
+def backtest(stats, predictors=PREDICTORS, model=Ridge(alpha=0.1), topX=5, startYear=1996, workers=None, cache_dir=CACHE_DIR):
+    """
+    Parameters:
+        stats (DataFrame): one row per player and season
+        predictors (list): columns used by the model
+        model (estimator): scikit-learn model (not fitted: each fold fits a copy)
+        topX (int): number of predicted players scored each season
+        startYear (int): first season predicted
+        workers (int): number of worker processes (None for the number of cpus, 0 to run in this process)
+        cache_dir (str): folder of the cached predictions (None to disable the cache)
+
+    Returns:
+        mean_avg_precision (float): mean of the average precisions
+        avg_precisions (list): average precision of each season
+        all_predictions (DataFrame): `Player`, `Share`, `Predictions`, `Rank`, `Predicted_Rank`,
+            `Difference` and `Year` of every player predicted (each season by predicted rank)
+    """
+
+    result = run_configs(stats, [{'name': type(model).__name__, 'model': model, 'predictors': predictors}],
+                         topX, startYear, workers, cache_dir)[0]
+
+    all_predictions = []
+    for year, predictions in zip(result['years'], result['predictions']):
+        test = stats[stats['Year'] == year]
+        order, rank, predicted_rank = rank_season(test['Share'].to_numpy(dtype=np.float64), predictions)
+
+        combination = test[['Player', 'Share']].iloc[order]
+        combination['Predictions'] = predictions[order]
+        combination['Rank'] = rank[order]
+        combination['Predicted_Rank'] = predicted_rank[order]
+        combination['Difference'] = combination['Rank'] - combination['Predicted_Rank']
+        combination['Year'] = year
+        all_predictions.append(combination)
+
+    avg_precisions = result['avg_precisions']
+
+    return(sum(avg_precisions) / len(avg_precisions), avg_precisions, pd.concat(all_predictions))
+
+
+## Backtest a grid of configurations
+def sweep(stats, configs, top_x=5, start_year=1996, workers=None, cache_dir=CACHE_DIR):
+    """
+    Parameters:
+        stats (DataFrame): one row per player and season
+        configs (list): dicts with a `name`, a `model` (unfitted scikit-learn model) and its `predictors`
+            (e.g. from `ridge_grid` or `model_grid`)
+        top_x (int): number of predicted players scored each season
+        start_year (int): first season predicted
+        workers (int): number of worker processes (None for the number of cpus, 0 to run in this process)
+        cache_dir (str): folder of the cached predictions (None to disable the cache)
+
+    Returns:
+        results (DataFrame): mean, min and standard deviation of the average precision of each
+            configuration (best first), with its number of predictors and cached folds
+    """
+
+    results = run_configs(stats, configs, top_x, start_year, workers, cache_dir)
+
+    return(pd.DataFrame([{'name': result['name'],
+                          'predictors': len(result['predictors']),
+                          'mean_avg_precision': np.mean(result['avg_precisions']),
+                          'min_avg_precision': np.min(result['avg_precisions']),
+                          'std_avg_precision': np.std(result['avg_precisions']),
+                          'cached_folds': result['cached']} for result in results])
+            .sort_values('mean_avg_precision', ascending=False, kind='stable'))
+
+
+## Configurations of a model over a grid of hyperparameters and predictor sets
+def model_grid(model, param_grid, predictor_sets):
+    """
+    Parameters:
+        model (estimator): scikit-learn model (its other parameters are kept)
+        param_grid (dict): parameter -> values, e.g. {'max_depth': [5, 10], 'min_samples_split': [2, 5]}
+        predictor_sets (dict): name -> list of predictors
+
+    Returns:
+        configs (list): one configuration per combination, named e.g. `RandomForestRegressor(max_depth=5) / base`
+    """
+
+    from sklearn.model_selection import ParameterGrid
+
+    configs = []
+    for params in ParameterGrid(param_grid):
+        for set_name, predictors in predictor_sets.items():
+            name = type(model).__name__ + '(' + ', '.join(k + '=' + str(v) for k, v in params.items()) + ') / ' + set_name
+            configs.append({'name': name, 'model': clone(model).set_params(**params), 'predictors': predictors})
+
+    return(configs)
+
+
+## Ridge configurations over alphas and predictor sets
+def ridge_grid(alphas, predictor_sets):
+    """
+    Parameters:
+        alphas (list): regularisation strengths
+        predictor_sets (dict): name -> list of predictors
+
+    Returns:
+        configs (list): one configuration per (alpha, predictor set)
+    """
+
+    return(model_grid(Ridge(), {'alpha': alphas}, predictor_sets))
+
+
+""" Check against the notebook backtest """
+## Notebook ranks (two full sorts), kept as the reference
+def add_ranks_legacy(combination):
+    """
+    Parameters:
+        combination (DataFrame): `Player`, `Share` and `Predictions` of a season
+
+    Returns:
+        combination (DataFrame): with the `Rank`, `Predicted_Rank` and `Difference`, by predicted rank
+    """
+
+    combination = combination.sort_values(["Share"], ascending=False)
+    combination["Rank"] = list(range(1, combination.shape[0] + 1))
+    combination = combination.sort_values(["Predictions"], ascending=False)
+    combination["Predicted_Rank"] = list(range(1, combination.shape[0] + 1))
+    combination["Difference"] = combination.Rank - combination.Predicted_Rank
+    return(combination)
+
+
+## Notebook error metric (row by row), kept as the reference
+def find_avg_precision_top_X_legacy(combination, topX=5):
+    """
+    Parameters:
+        combination (DataFrame): `Player`, `Share` and `Predictions` of a season
+        topX (int): number of predicted players scored
+
+    Returns:
+        avg_precision (float): average precision of the predicted top X
+    """
+
+    combination = add_ranks_legacy(combination)
+    metric = []
+    for i in range(topX):
+        if combination.Rank.iloc[i] <= topX:
+            if combination.Rank.iloc[i] == combination.Predicted_Rank.iloc[i]:
+                m = 1
+            else:
+                m = 0.7 + 0.3 * 1/(abs(combination.Rank.iloc[i] - combination.Predicted_Rank.iloc[i])+1)
+        else:
+            m = 0.3 + 0.7 * 1/(abs(combination.Rank.iloc[i] - combination.Predicted_Rank.iloc[i])+1)
+        metric.append(m)
+    return(sum(metric)/len(metric))
+
+
+## Notebook backtest (serial), kept as the reference
+def backtest_legacy(stats, predictors, model, topX=5, startYear=1996):
+    """
+    Parameters:
+        stats (DataFrame): one row per player and season
+        predictors (list): columns used by the model
+        model (estimator): scikit-learn model (fitted in place)
+        topX (int): number of predicted players scored each season
+        startYear (int): first season predicted
+
+    Returns:
+        mean_avg_precision (float), avg_precisions (list) and all_predictions (DataFrame), as `backtest`
+    """
+
+    years = list(range(min(stats.Year), max(stats.Year)+1))
+    aps = []
+    all_predictions = []
+    for year in years[years.index(startYear):]:
+        train = stats[stats["Year"] < year]
+        test = stats[stats["Year"] == year]
+        model.fit(train[predictors], train["Share"])
+        predictions = model.predict(test[predictors])
+        predictions = pd.DataFrame(predictions, columns=["Predictions"], index=test.index)
+        combination = pd.concat([test[["Player", "Share"]], predictions], axis=1)
+        combination = add_ranks_legacy(combination)
+        combination["Year"] = year
+        all_predictions.append(combination)
+        aps.append(find_avg_precision_top_X_legacy(combination, topX))
+    return(sum(aps)/len(aps), aps, pd.concat(all_predictions))
+
+
+## Compare a backtest with the notebook backtest, and time both
+def check_parity(stats, predictors=PREDICTORS, model=Ridge(alpha=0.1), topX=5, startYear=1996, workers=None):
+    """
+    Parameters:
+        stats (DataFrame): one row per player and season
+        predictors (list): columns used by the model
+        model (estimator): scikit-learn model
+        topX (int): number of predicted players scored each season
+        startYear (int): first season predicted
+        workers (int): number of worker processes
+
+    Returns:
+        results (DataFrame): parity of the average precisions and predictions, and time of each backtest
+            (the new one without, then with the cache)
+    """
+
+    timings, outputs = {}, {}
+    for label, run in [('legacy', lambda: backtest_legacy(stats, predictors, clone(model), topX, startYear)),
+                       ('new', lambda: backtest(stats, predictors, model, topX, startYear, workers, cache_dir=None))]:
+        start = time.perf_counter()
+        outputs[label] = run()
+        timings[label] = time.perf_counter() - start
+
+    # Metric only (the folds' predictions are given), to time the ranks and metric alone
+    legacy_predictions, new_predictions = outputs['legacy'][2], outputs['new'][2]
+    start = time.perf_counter()
+    for year, df in legacy_predictions.groupby('Year', sort=False):
+        find_avg_precision_top_X_legacy(df[['Player', 'Share', 'Predictions']], topX)
+    timings['legacy_metric'] = time.perf_counter() - start
+    start = time.perf_counter()
+    for year, df in legacy_predictions.groupby('Year', sort=False):
+        avg_precision_top_x(df['Share'].to_numpy(), df['Predictions'].to_numpy(), topX)
+    timings['new_metric'] = time.perf_counter() - start
+
+    return(pd.DataFrame([{'seasons': len(outputs['legacy'][1]),
+                          'same_avg_precisions': outputs['legacy'][1] == outputs['new'][1],
+                          'same_predictions': legacy_predictions.equals(new_predictions),
+                          'legacy_sec': round(timings['legacy'], 3),
+                          'new_sec': round(timings['new'], 3),
+                          'legacy_metric_ms': round(timings['legacy_metric'] * 1000, 1),
+                          'new_metric_ms': round(timings['new_metric'] * 1000, 1)}]))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Backtest MVP vote share models')
+    parser.add_argument('--stats', default=STATS_FILE, help='path of stats_clean.csv')
+    parser.add_argument('--alphas', nargs='+', type=float, default=[0.01, 0.1, 1, 10, 100], help='Ridge alphas swept')
+    parser.add_argument('--top-x', type=int, default=5, help='number of predicted players scored each season')
+    parser.add_argument('--start-year', type=int, default=1996, help='first season predicted')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes (0 to run in this process)')
+    parser.add_argument('--no-cache', action='store_true', help="don't read or write the cached predictions")
+    parser.add_argument('--check', action='store_true', help='only compare with the notebook backtest and time both')
+    args = parser.parse_args()
+
+    stats = load_stats(args.stats)
+    if args.check:
+        print(check_parity(stats, topX=args.top_x, startYear=args.start_year, workers=args.workers).to_string(index=False))
+    else:
+        start = time.perf_counter()
+        results = sweep(stats, ridge_grid(args.alphas, {'base': PREDICTORS}), args.top_x, args.start_year,
+                        args.workers, None if args.no_cache else CACHE_DIR)
+        print(results.to_string(index=False))
+        print('Swept ' + str(len(results)) + ' configurations in ' + str(round(time.perf_counter() - start, 2)) + ' s')
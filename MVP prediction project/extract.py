@@ -0,0 +1,443 @@
+'''  NBA MVP - Table extraction '''
+
+# Rebuilds `mvps.csv`, `players.csv` and `teams.csv` from the pages saved in `mvp/`, `player/` and
+# `team/`. Each page is parsed once with lxml (C parser), only its target tables are read (straight
+# from the parsed rows, with the type inference of `pd.read_html`), and the pages are extracted in a
+# process pool. The typed table of each page is cached per (file, content hash) in `extract_cache/`,
+# so a rebuild only extracts the pages that changed.
+#
+# The output is the same as the BeautifulSoup (`html.parser`) + `pd.read_html` extraction of
+# `NBA_MVP_web_scraping.ipynb`, including its quirks that `NBA_MVP_clean_up.ipynb` relies on (the
+# first header row of the page is removed, the repeated header and division rows are kept):
+#
+#     python extract.py            # rebuild the 3 csv files
+#     python extract.py --check    # compare every page with the notebook extraction (needs bs4) and time both
+#
+# The check fails for a kind with no page compared (e.g. saved pages that are rate-limit error pages),
+# and the standings extraction is also checked on a minimal standings page (`STANDINGS_SNIPPET`).
+
+
+## Import libraries
+import pandas as pd
+import os
+import re
+import glob
+import time
+import hashlib
+import argparse
+import concurrent.futures
+import lxml.html
+
+from pandas.io.parsers import TextParser
+
+
+## Parameters
+PAGES_DIR = os.path.dirname(os.path.abspath(__file__))
+CACHE_DIR = os.path.join(PAGES_DIR, 'extract_cache')
+YEARS = list(range(1991, 2024))
+
+# For each kind of page: class of the header row removed from the page, ids of the tables (with the
+# conference column renamed to `Team` for the standings) and csv file rebuilt
+TABLES = {'mvp': {'drop_row': 'over_header', 'tables': {'mvp': None}, 'csv': 'mvps.csv'},
+          'player': {'drop_row': 'thead', 'tables': {'per_game_stats': None}, 'csv': 'players.csv'},
+          'team': {'drop_row': 'thead', 'tables': {'divs_standings_E': 'Eastern Conference',
+                                                   'divs_standings_W': 'Western Conference'}, 'csv': 'teams.csv'}}
+
+# Whitespace collapsed in the cell texts (as `pd.read_html` does)
+WHITESPACE = re.compile(r'[\r\n]+|\s{2,}')
+
+# Minimal standings page (start of the 1991 standings, with the structure of the Basketball Reference
+# tables: division rows of class `thead` in the body), and the rows expected in `teams.csv`
+STANDINGS_SNIPPET = """<html><body>
+<table id="divs_standings_E">
+<thead><tr><th>Eastern Conference</th><th>W</th><th>L</th><th>W/L%</th><th>GB</th><th>PS/G</th><th>PA/G</th><th>SRS</th></tr></thead>
+<tbody>
+<tr class="thead onecell"><td colspan="8">Atlantic Division</td></tr>
+<tr class="full_table"><th scope="row"><a href="/teams/BOS/1991.html">Boston Celtics</a>*</th><td>56</td><td>26</td><td>.683</td><td>&mdash;</td><td>111.5</td><td>105.7</td><td>5.22</td></tr>
+<tr class="full_table"><th scope="row"><a href="/teams/PHI/1991.html">Philadelphia 76ers</a>*</th><td>44</td><td>38</td><td>.537</td><td>12.0</td><td>105.4</td><td>105.6</td><td>-0.39</td></tr>
+<tr class="thead onecell"><td colspan="8">Central Division</td></tr>
+<tr class="full_table"><th scope="row"><a href="/teams/CHI/1991.html">Chicago Bulls</a>*</th><td>61</td><td>21</td><td>.744</td><td>&mdash;</td><td>110.0</td><td>101.0</td><td>8.57</td></tr>
+</tbody>
+</table>
+<table id="divs_standings_W">
+<thead><tr><th>Western Conference</th><th>W</th><th>L</th><th>W/L%</th><th>GB</th><th>PS/G</th><th>PA/G</th><th>SRS</th></tr></thead>
+<tbody>
+<tr class="thead onecell"><td colspan="8">Midwest Division</td></tr>
+<tr class="full_table"><th scope="row"><a href="/teams/SAS/1991.html">San Antonio Spurs</a>*</th><td>55</td><td>27</td><td>.671</td><td>&mdash;</td><td>107.1</td><td>102.6</td><td>4.30</td></tr>
+</tbody>
+</table>
+</body></html>"""
+
+STANDINGS_EXPECTED = pd.DataFrame(
+    [['56', '26', '.683', '—', '111.5', '105.7', '5.22', 1991, 'Boston Celtics*'],
+     ['44', '38', '.537', '12.0', '105.4', '105.6', '-0.39', 1991, 'Philadelphia 76ers*'],
+     ['Central Division'] * 7 + [1991, 'Central Division'],
+     ['61', '21', '.744', '—', '110.0', '101.0', '8.57', 1991, 'Chicago Bulls*'],
+     ['Midwest Division'] * 7 + [1991, 'Midwest Division'],
+     ['55', '27', '.671', '—', '107.1', '102.6', '4.30', 1991, 'San Antonio Spurs*']],
+    columns=['W', 'L', 'W/L%', 'GB', 'PS/G', 'PA/G', 'SRS', 'Year', 'Team'], index=[0, 1, 2, 3, 0, 1])
+
+
+""" Extraction """
+## Texts of the cells of a row (a cell spanning several columns is repeated, as in `pd.read_html`)
+def row_cells(tr):
+    """
+    Parameters:
+        tr (HtmlElement): `tr` element
+
+    Returns:
+        cells (list): text of each column
+    """
+
+    cells = []
+    for cell in tr:
+        if cell.tag in ('td', 'th'):
+            cells += [WHITESPACE.sub(' ', cell.text_content().strip())] * int(cell.get('colspan') or 1)
+
+    return(cells)
+
+
+## Read a table element into a DataFrame
+def read_table(table):
+    """
+    The `thead` rows are the header, the `tbody` and `tfoot` rows the data, and the columns are typed
+    by pandas' `TextParser` (as with `pd.read_html`, without serialising and parsing the table again).
+
+    Parameters:
+        table (HtmlElement): `table` element
+
+    Returns:
+        df (DataFrame): content of the table
+    """
+
+    head = [row_cells(tr) for tr in table.xpath('./thead/tr')]
+    rows = head + [row_cells(tr) for tr in table.xpath('./tbody/tr | ./tfoot/tr')]
+
+    # Ragged rows are padded with empty cells
+    width = max(len(row) for row in rows)
+    rows = [row + [''] * (width - len(row)) for row in rows]
+    header = 0 if len(head) == 1 else [i for i, row in enumerate(head) if any(row)]
+
+    with TextParser(rows, header=header) as parser:
+        return(parser.read())
+
+
+## Find a table by id (in the page, or in a commented-out block as Basketball Reference does for some tables)
+def find_table(tree, table_id):
+    """
+    Parameters:
+        tree (HtmlElement): parsed page
+        table_id (str): id of the table
+
+    Returns:
+        table (HtmlElement): `table` element
+    """
+
+    table = tree.get_element_by_id(table_id, None)
+    if table is not None:
+        return(table)
+
+    for comment in tree.xpath('//comment()[contains(., $id)]', id='id="' + table_id + '"'):
+        table = lxml.html.fromstring(comment.text).get_element_by_id(table_id, None)
+        if table is not None:
+            return(table)
+
+    raise ValueError('No table ' + table_id)
+
+
+## Extract the tables of a page
+def extract_page(page, kind, year):
+    """
+    Parameters:
+        page (str): html of the page
+        kind (str): `mvp`, `player` or `team`
+        year (int): season of the page
+
+    Returns:
+        df (DataFrame): rows of the tables of the page, with their `Year` (and `Team` for the standings)
+    """
+
+    tree = lxml.html.fromstring(page)
+
+    # The notebook removes the first row of this class in the page (before looking for the tables)
+    drop_row = tree.xpath('//tr[contains(concat(" ", normalize-space(@class), " "), $cls)]', cls=' ' + TABLES[kind]['drop_row'] + ' ')
+    if len(drop_row) > 0:
+        drop_row[0].getparent().remove(drop_row[0])
+
+    dfs = []
+    for table_id, team_column in TABLES[kind]['tables'].items():
+        df = read_table(find_table(tree, table_id))
+        df['Year'] = year
+        if team_column is not None:
+            df['Team'] = df[team_column]
+            del df[team_column]
+        dfs.append(df)
+
+    return(pd.concat(dfs))
+
+
+## Extract a saved page (run in the worker processes)
+def extract_file(path, kind, year):
+    """
+    Parameters:
+        path (str): path of the saved page
+        kind (str): `mvp`, `player` or `team`
+        year (int): season of the page
+
+    Returns:
+        df (DataFrame): tables of the page (None if the page doesn't have them)
+        error (str): reason the page couldn't be extracted ('' otherwise)
+    """
+
+    with open(path) as f:
+        page = f.read()
+    try:
+        return(extract_page(page, kind, year), '')
+    except ValueError as error:
+        return(None, str(error))
+
+
+""" Cache """
+## Path of the cached table of a page
+def cache_path(kind, year, digest, cache_dir=CACHE_DIR):
+    """
+    Parameters:
+        kind (str): `mvp`, `player` or `team`
+        year (int): season of the page
+        digest (str): sha256 of the page content
+        cache_dir (str): folder of the cached tables
+
+    Returns:
+        path (str): e.g. `extract_cache/mvp_1991_<hash>.pkl`
+    """
+
+    return(os.path.join(cache_dir, kind + '_' + str(year) + '_' + digest[:16] + '.pkl'))
+
+
+## Save the table of a page (replacing the tables of its previous contents)
+def write_cached(df, kind, year, digest, cache_dir=CACHE_DIR):
+    """
+    Parameters:
+        df (DataFrame): tables of the page
+        kind (str): `mvp`, `player` or `team`
+        year (int): season of the page
+        digest (str): sha256 of the page content
+        cache_dir (str): folder of the cached tables
+
+    Returns:
+        None
+    """
+
+    os.makedirs(cache_dir, exist_ok=True)
+    for old_path in glob.glob(os.path.join(cache_dir, kind + '_' + str(year) + '_*.pkl')):
+        os.remove(old_path)
+
+    path = cache_path(kind, year, digest, cache_dir)
+    df.to_pickle(path + '.tmp')
+    os.replace(path + '.tmp', path)
+
+
+""" Rebuilding the csv files """
+## Extract the tables of every year of a kind of page (from the cache, or in a process pool)
+def extract_tables(kind, years=YEARS, pages_dir=PAGES_DIR, cache_dir=CACHE_DIR, workers=None):
+    """
+    Parameters:
+        kind (str): `mvp`, `player` or `team`
+        years (list): seasons
+        pages_dir (str): folder containing the `mvp`, `player` and `team` folders
+        cache_dir (str): folder of the cached tables
+        workers (int): number of worker processes (None for the number of cpus)
+
+    Returns:
+        df (DataFrame): tables of every page, in year order (None if a page couldn't be extracted)
+        report (dict): number of `pages`, `cached` and `extracted`, `errors` (page -> reason) and `seconds`
+    """
+
+    start = time.perf_counter()
+    tables, misses, errors, n_cached = {}, [], {}, 0
+
+    for year in years:
+        path = os.path.join(pages_dir, kind, str(year) + '.html')
+        if not os.path.exists(path):
+            errors[kind + '/' + str(year)] = 'No page'
+            continue
+        with open(path, 'rb') as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        if os.path.exists(cache_path(kind, year, digest, cache_dir)):
+            tables[year] = pd.read_pickle(cache_path(kind, year, digest, cache_dir))
+            n_cached += 1
+        else:
+            misses.append((path, year, digest))
+
+    if len(misses) > 0:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=min(workers or os.cpu_count(), len(misses))) as executor:
+            results = executor.map(extract_file, [miss[0] for miss in misses], [kind] * len(misses), [miss[1] for miss in misses])
+            for (path, year, digest), (df, error) in zip(misses, results):
+                if df is None:
+                    errors[kind + '/' + str(year)] = error
+                else:
+                    write_cached(df, kind, year, digest, cache_dir)
+                    tables[year] = df
+
+    report = {'kind': kind, 'pages': len(years), 'cached': n_cached, 'extracted': len(misses),
+              'errors': errors, 'seconds': round(time.perf_counter() - start, 2)}
+
+    if len(errors) > 0:
+        return(None, report)
+
+    return(pd.concat([tables[year] for year in years]), report)
+
+
+## Rebuild the csv files of the saved pages
+def build_csvs(kinds=list(TABLES), years=YEARS, pages_dir=PAGES_DIR, cache_dir=CACHE_DIR, workers=None):
+    """
+    A csv file is only rewritten if every page of its kind could be extracted.
+
+    Parameters:
+        kinds (list): kinds of pages (`mvp`, `player`, `team`)
+        years (list): seasons
+        pages_dir (str): folder containing the `mvp`, `player` and `team` folders (and the csv files)
+        cache_dir (str): folder of the cached tables
+        workers (int): number of worker processes (None for the number of cpus)
+
+    Returns:
+        report (DataFrame): pages, cached and extracted pages, rows written (None if the csv
+            wasn't rewritten), errors and duration of each kind
+    """
+
+    reports = []
+    for kind in kinds:
+        df, report = extract_tables(kind, years, pages_dir, cache_dir, workers)
+        report['rows'] = None
+        if df is not None:
+            path = os.path.join(pages_dir, TABLES[kind]['csv'])
+            df.to_csv(path + '.tmp')
+            os.replace(path + '.tmp', path)
+            report['rows'] = len(df)
+        reports.append(report)
+
+    return(pd.DataFrame(reports))
+
+
+""" Check against the notebook extraction """
+## Previous extraction of a page (BeautifulSoup `html.parser`, then `pd.read_html` of the table), kept as the reference output
+def extract_page_legacy(page, kind, year):
+    """
+    Parameters:
+        page (str): html of the page
+        kind (str): `mvp`, `player` or `team`
+        year (int): season of the page
+
+    Returns:
+        df (DataFrame): rows of the tables of the page, with their `Year` (and `Team` for the standings)
+    """
+
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(page, 'html.parser')
+    soup.find('tr', class_=TABLES[kind]['drop_row']).decompose()
+
+    dfs = []
+    for table_id, team_column in TABLES[kind]['tables'].items():
+        df = pd.read_html(str(soup.find_all(id=table_id)[0]))[0]
+        df['Year'] = year
+        if team_column is not None:
+            df['Team'] = df[team_column]
+            del df[team_column]
+        dfs.append(df)
+
+    return(pd.concat(dfs))
+
+
+## Compare the extraction of every page with the notebook extraction, and time both (one process)
+def check_parity(kinds=list(TABLES), years=YEARS, pages_dir=PAGES_DIR):
+    """
+    Parameters:
+        kinds (list): kinds of pages
+        years (list): seasons
+        pages_dir (str): folder containing the `mvp`, `player` and `team` folders
+
+    Returns:
+        results (DataFrame): pages compared, identical tables (values, columns and dtypes), pages
+            without their tables and time of each extraction, per kind
+    """
+
+    results = []
+    for kind in kinds:
+        result = {'kind': kind, 'pages': 0, 'identical': 0, 'no_table': 0, 'legacy_sec': 0.0, 'lxml_sec': 0.0}
+        for year in years:
+            with open(os.path.join(pages_dir, kind, str(year) + '.html')) as f:
+                page = f.read()
+
+            start = time.perf_counter()
+            try:
+                df = extract_page(page, kind, year)
+            except ValueError:
+                result['no_table'] += 1
+                continue
+            result['lxml_sec'] += time.perf_counter() - start
+
+            start = time.perf_counter()
+            df_legacy = extract_page_legacy(page, kind, year)
+            result['legacy_sec'] += time.perf_counter() - start
+
+            result['pages'] += 1
+            result['identical'] += int(df.equals(df_legacy) and list(df.columns) == list(df_legacy.columns)
+                                       and (df.dtypes == df_legacy.dtypes).all())
+
+        result['legacy_sec'], result['lxml_sec'] = round(result['legacy_sec'], 2), round(result['lxml_sec'], 2)
+        # A kind passes only if some pages were compared, and all of them are identical
+        result['ok'] = result['pages'] > 0 and result['identical'] == result['pages']
+        results.append(result)
+
+    if 'team' in kinds:
+        results.append(check_standings_snippet())
+
+    return(pd.DataFrame(results))
+
+
+## Compare the extraction of the minimal standings page with the expected rows and with the notebook extraction
+def check_standings_snippet():
+    """
+    Returns:
+        result (dict): same fields as the rows of `check_parity` (kind `team snippet`)
+    """
+
+    start = time.perf_counter()
+    df = extract_page(STANDINGS_SNIPPET, 'team', 1991)
+    lxml_sec = time.perf_counter() - start
+
+    start = time.perf_counter()
+    df_legacy = extract_page_legacy(STANDINGS_SNIPPET, 'team', 1991)
+    legacy_sec = time.perf_counter() - start
+
+    identical = (df.equals(df_legacy) and list(df.columns) == list(df_legacy.columns) and (df.dtypes == df_legacy.dtypes).all()
+                 and df.astype(str).equals(STANDINGS_EXPECTED.astype(str)) and list(df.index) == list(STANDINGS_EXPECTED.index))
+
+    return({'kind': 'team snippet', 'pages': 1, 'identical': int(identical), 'no_table': 0,
+            'legacy_sec': round(legacy_sec, 4), 'lxml_sec': round(lxml_sec, 4), 'ok': bool(identical)})
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Rebuild mvps.csv, players.csv and teams.csv from the saved pages')
+    parser.add_argument('--kinds', nargs='+', default=list(TABLES), choices=list(TABLES), help='kinds of pages')
+    parser.add_argument('--years', nargs='+', type=int, default=YEARS, help='seasons (1991 to 2023 by default)')
+    parser.add_argument('--pages-dir', default=PAGES_DIR, help='folder containing the mvp, player and team folders')
+    parser.add_argument('--cache-dir', default=CACHE_DIR, help='folder of the cached tables')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes')
+    parser.add_argument('--check', action='store_true', help='only compare with the notebook extraction (needs bs4)')
+    args = parser.parse_args()
+
+    if args.check:
+        results = check_parity(args.kinds, args.years, args.pages_dir)
+        print(results.to_string(index=False))
+        if not results['ok'].all():
+            raise SystemExit(1)
+    else:
+        report = build_csvs(args.kinds, args.years, args.pages_dir, args.cache_dir, args.workers)
+        print(report.drop(columns='errors').to_string(index=False))
+        for row in report.itertuples():
+            if len(row.errors) > 0:
+                print(TABLES[row.kind]['csv'] + ' not rewritten, ' + str(len(row.errors)) + ' page(s) without their tables, e.g. '
+                      + ', '.join(page + ' (' + error + ')' for page, error in list(row.errors.items())[:3]))
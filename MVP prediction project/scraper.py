@@ -0,0 +1,473 @@
+'''  NBA MVP - Basketball Reference scraper '''
+
+# Downloads the MVP award, per-game stats and standings pages of each season into `mvp/`, `player/`
+# and `team/` (the folders read by `NBA_MVP_web_scraping.ipynb`). The pages are fetched concurrently
+# over one connection pool, paced by a token bucket (Basketball Reference allows about 20 requests
+# a minute), and retried with exponential backoff on errors and rate limiting. The saved pages are
+# an on-disk cache: their ETag / Last-Modified are kept in `scrape_cache.json`, and each page is
+# revalidated with a conditional request, so unchanged seasons are answered with a 304 and not rewritten.
+#
+# The per-game table is part of the served HTML, so the player pages are fetched like the others
+# (no browser session); a page without its expected table is reported as an error and not saved.
+#
+#     python scraper.py                       # refresh every season
+#     python scraper.py --kinds mvp --years 2023
+#     python scraper.py --self-test           # run against a local stand-in server of the saved pages
+#
+# From a notebook (which already runs an event loop): `results = await fetch_pages(years=[2023])`
+
+
+## Import libraries
+import pandas as pd
+import os
+import re
+import json
+import time
+import random
+import shutil
+import asyncio
+import hashlib
+import argparse
+import tempfile
+import threading
+import email.utils
+import http.server
+import aiohttp
+
+
+## Parameters
+BASE_URL = 'https://www.basketball-reference.com'
+PAGES_DIR = os.path.dirname(os.path.abspath(__file__))
+CACHE_FILE = 'scrape_cache.json'
+YEARS = list(range(1991, 2024))
+
+# Path of each kind of page on the site, and ids of the tables it must contain
+PAGES = {'mvp': '/awards/awards_{}.html',
+         'player': '/leagues/NBA_{}_per_game.html',
+         'team': '/leagues/NBA_{}_standings.html'}
+TABLE_IDS = {'mvp': ['mvp'],
+             'player': ['per_game_stats'],
+             'team': ['divs_standings_E', 'divs_standings_W']}
+
+RATE = 20 / 60            # requests per second
+BURST = 2                 # requests allowed at once after an idle period
+CONCURRENCY = 4           # open connections
+MAX_RETRIES = 4
+BACKOFF = 2.0             # seconds, doubled at each retry
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+""" Rate limiting """
+## Token bucket shared by the requests: `rate` tokens a second, up to `capacity` saved up
+class TokenBucket:
+
+    def __init__(self, rate=RATE, capacity=BURST):
+        """
+        Parameters:
+            rate (float): tokens added per second
+            capacity (int): maximum number of tokens
+        """
+
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    ## Wait for a token
+    async def acquire(self):
+        """
+        Parameters:
+            None
+
+        Returns:
+            None
+        """
+
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    ## Hold every request for a while (e.g. after a 429 with a `Retry-After`)
+    async def pause(self, seconds):
+        """
+        Parameters:
+            seconds (float): time before the next token
+
+        Returns:
+            None
+        """
+
+        async with self.lock:
+            self.tokens = min(self.tokens, 0) - seconds * self.rate
+            self.updated = time.monotonic()
+
+
+""" Cache """
+## Path of a saved page
+def page_path(kind, year, pages_dir=PAGES_DIR):
+    """
+    Parameters:
+        kind (str): `mvp`, `player` or `team`
+        year (int): season
+        pages_dir (str): folder containing the `mvp`, `player` and `team` folders
+
+    Returns:
+        path (str): e.g. `mvp/1991.html`
+    """
+
+    return(os.path.join(pages_dir, kind, str(year) + '.html'))
+
+
+## Read the validators of the saved pages
+def read_cache(pages_dir=PAGES_DIR):
+    """
+    Parameters:
+        pages_dir (str): folder containing the saved pages
+
+    Returns:
+        cache (dict): `kind/year.html` -> {'url', 'etag', 'last_modified', 'sha256'}
+    """
+
+    path = os.path.join(pages_dir, CACHE_FILE)
+    if not os.path.exists(path):
+        return({})
+    with open(path) as f:
+        return(json.load(f))
+
+
+## Write the validators of the saved pages
+def write_cache(cache, pages_dir=PAGES_DIR):
+    """
+    Parameters:
+        cache (dict): `kind/year.html` -> {'url', 'etag', 'last_modified', 'sha256'}
+        pages_dir (str): folder containing the saved pages
+
+    Returns:
+        None
+    """
+
+    path = os.path.join(pages_dir, CACHE_FILE)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(cache, f, indent=2, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+## Whether a page contains the tables of its kind
+def has_tables(page, kind):
+    """
+    Parameters:
+        page (str): html of the page
+        kind (str): `mvp`, `player` or `team`
+
+    Returns:
+        valid (bool): True if every table of `TABLE_IDS[kind]` is in the page (False for e.g. a 429 error page)
+    """
+
+    return(all('id="' + table_id + '"' in page for table_id in TABLE_IDS[kind]))
+
+
+## Conditional request headers of a saved page
+def conditional_headers(path, entry, kind):
+    """
+    Parameters:
+        path (str): path of the saved page
+        entry (dict): validators of the page (None if it was saved before the cache existed)
+        kind (str): `mvp`, `player` or `team`
+
+    Returns:
+        headers (dict): `If-None-Match` / `If-Modified-Since` (empty if the page isn't saved)
+    """
+
+    if not os.path.exists(path):
+        return({})
+
+    headers = {}
+    if entry is not None and entry.get('etag'):
+        headers['If-None-Match'] = entry['etag']
+    if entry is not None and entry.get('last_modified'):
+        headers['If-Modified-Since'] = entry['last_modified']
+    elif entry is None:
+        # Pages saved by the notebook: the file date stands in for the Last-Modified, unless the
+        # page is an error page saved instead of the data (it's then fetched again)
+        with open(path) as f:
+            if has_tables(f.read(), kind):
+                headers['If-Modified-Since'] = email.utils.formatdate(os.path.getmtime(path), usegmt=True)
+
+    return(headers)
+
+
+""" Fetching """
+## Fetch a page (with retries) and save it if it changed
+async def fetch_page(session, bucket, kind, year, cache, base_url=BASE_URL, pages_dir=PAGES_DIR, revalidate=True):
+    """
+    Parameters:
+        session (ClientSession): aiohttp session (shared connection pool)
+        bucket (TokenBucket): rate limiter shared by the requests
+        kind (str): `mvp`, `player` or `team`
+        year (int): season
+        cache (dict): validators of the saved pages (updated in place)
+        base_url (str): site (or stand-in server) url
+        pages_dir (str): folder containing the `mvp`, `player` and `team` folders
+        revalidate (bool): revalidate the saved pages (False to only fetch the missing ones)
+
+    Returns:
+        result (dict): `kind`, `year`, `status` (fetched, not modified, cached or error), HTTP
+            `code`, `bytes` saved, number of `attempts`, `seconds` and error `detail`
+    """
+
+    path = page_path(kind, year, pages_dir)
+    key = kind + '/' + str(year) + '.html'
+    url = base_url + PAGES[kind].format(year)
+    result = {'kind': kind, 'year': year, 'status': 'error', 'code': None, 'bytes': 0, 'attempts': 0, 'detail': ''}
+    start = time.perf_counter()
+
+    if not revalidate and os.path.exists(path):
+        result.update({'status': 'cached', 'seconds': 0.0})
+        return(result)
+
+    for attempt in range(MAX_RETRIES + 1):
+        await bucket.acquire()
+        result['attempts'] = attempt + 1
+        try:
+            async with session.get(url, headers=conditional_headers(path, cache.get(key), kind)) as response:
+                result['code'] = response.status
+                if response.status == 304:
+                    result['status'] = 'not modified'
+                    break
+
+                if response.status in RETRY_STATUS:
+                    result['detail'] = 'HTTP ' + str(response.status)
+                    retry_after = response.headers.get('Retry-After', '')
+                    if retry_after.isdigit():
+                        await bucket.pause(int(retry_after))
+                    raise aiohttp.ClientResponseError(response.request_info, (), status=response.status)
+
+                if response.status != 200:
+                    result['detail'] = 'HTTP ' + str(response.status)
+                    break
+
+                page = await response.text()
+                validators = {'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified')}
+
+        except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+            result['detail'] = result['detail'] or type(error).__name__
+            if attempt < MAX_RETRIES:
+                await asyncio.sleep(BACKOFF * 2 ** attempt * (1 + random.random() / 2))
+            continue
+
+        # A page without its table (e.g. an error page) isn't saved
+        if not has_tables(page, kind):
+            result['detail'] = 'no table ' + ', '.join(TABLE_IDS[kind])
+            break
+
+        digest = hashlib.sha256(page.encode()).hexdigest()
+        if cache.get(key, {}).get('sha256') == digest and os.path.exists(path):
+            result['status'] = 'not modified'
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + '.tmp', 'w') as f:
+                f.write(page)
+            os.replace(path + '.tmp', path)
+            result.update({'status': 'fetched', 'bytes': len(page)})
+        cache[key] = {'url': url, 'sha256': digest, **validators}
+        break
+
+    result['seconds'] = round(time.perf_counter() - start, 3)
+    return(result)
+
+
+## Fetch the pages of every kind and year
+async def fetch_pages(kinds=list(PAGES), years=YEARS, base_url=BASE_URL, pages_dir=PAGES_DIR,
+                      rate=RATE, burst=BURST, concurrency=CONCURRENCY, revalidate=True):
+    """
+    Parameters:
+        kinds (list): kinds of pages (`mvp`, `player`, `team`)
+        years (list): seasons
+        base_url (str): site (or stand-in server) url
+        pages_dir (str): folder containing the `mvp`, `player` and `team` folders
+        rate (float): requests per second
+        burst (int): requests allowed at once after an idle period
+        concurrency (int): open connections
+        revalidate (bool): revalidate the saved pages (False to only fetch the missing ones)
+
+    Returns:
+        results (DataFrame): one row per page (see `fetch_page`)
+    """
+
+    cache = read_cache(pages_dir)
+    bucket = TokenBucket(rate, burst)
+    connector = aiohttp.TCPConnector(limit=concurrency, limit_per_host=concurrency)
+    headers = {'User-Agent': 'Mozilla/5.0 (NBA MVP project scraper)'}
+
+    async with aiohttp.ClientSession(connector=connector, headers=headers,
+                                     timeout=aiohttp.ClientTimeout(total=60)) as session:
+        results = await asyncio.gather(*[fetch_page(session, bucket, kind, year, cache, base_url, pages_dir, revalidate)
+                                         for kind in kinds for year in years])
+
+    write_cache(cache, pages_dir)
+
+    return(pd.DataFrame(results))
+
+
+## Fetch the pages from a script (outside of a running event loop)
+def scrape(**kwargs):
+    """
+    Parameters:
+        kwargs (dict): arguments of `fetch_pages`
+
+    Returns:
+        results (DataFrame): one row per page (see `fetch_page`)
+    """
+
+    return(asyncio.run(fetch_pages(**kwargs)))
+
+
+""" Stand-in server """
+## Serves the saved pages at their Basketball Reference paths, with ETag / Last-Modified revalidation
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+
+    pages_dir = PAGES_DIR
+    # Paths answered with a 503 on their first request (to exercise the retries)
+    flaky = set()
+
+    def do_GET(self):
+        for kind, pattern in PAGES.items():
+            match = re.fullmatch(re.escape(pattern).replace(r'\{\}', r'(\d{4})'), self.path)
+            if match is not None:
+                break
+        else:
+            return(self.send_error(404))
+
+        path = page_path(kind, match.group(1), self.pages_dir)
+        if not os.path.exists(path):
+            return(self.send_error(404))
+        if self.path in self.flaky:
+            self.flaky.discard(self.path)
+            return(self.send_error(503))
+
+        with open(path, 'rb') as f:
+            body = f.read()
+        etag = '"' + hashlib.sha256(body).hexdigest()[:16] + '"'
+        mtime = int(os.path.getmtime(path))
+        since = email.utils.parsedate_to_datetime(self.headers['If-Modified-Since']).timestamp() \
+            if self.headers['If-Modified-Since'] else None
+
+        if self.headers['If-None-Match'] == etag or (self.headers['If-None-Match'] is None and since is not None and mtime <= since):
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', email.utils.formatdate(mtime, usegmt=True))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+## Start a stand-in server of saved pages in a background thread
+def start_stand_in_server(pages_dir=PAGES_DIR, port=0, flaky=()):
+    """
+    Stop it with `server.shutdown()`.
+
+    Parameters:
+        pages_dir (str): folder containing the `mvp`, `player` and `team` folders served
+        port (int): port (0 for any free port)
+        flaky (list): paths answered with a 503 on their first request
+
+    Returns:
+        server (ThreadingHTTPServer): running server
+        base_url (str): url to pass as `base_url`
+    """
+
+    handler = type('Handler', (StandInHandler,), {'pages_dir': pages_dir, 'flaky': set(flaky)})
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return(server, 'http://127.0.0.1:' + str(server.server_address[1]))
+
+
+## Scrape the stand-in server of the saved pages twice, into a scratch folder
+def self_test(kinds=list(PAGES), years=YEARS, pages_dir=PAGES_DIR):
+    """
+    The first run fetches every page (one of them after a 503 and a retry) and must save copies
+    identical to the served ones; the second run must only get 304s. Saved pages without their
+    table (e.g. the 429 error pages saved instead of some standings) must be reported and not saved.
+
+    Parameters:
+        kinds (list): kinds of pages
+        years (list): seasons
+        pages_dir (str): folder containing the saved pages served
+
+    Returns:
+        summary (DataFrame): number of pages per run and status, with the total time of each run
+    """
+
+    global BACKOFF
+    server, base_url = start_stand_in_server(pages_dir, flaky=[PAGES[kinds[0]].format(years[0])])
+    scratch_dir = tempfile.mkdtemp()
+    backoff, BACKOFF = BACKOFF, 0.01
+
+    try:
+        runs = []
+        for run in ['first', 'second']:
+            start = time.perf_counter()
+            results = scrape(kinds=kinds, years=years, base_url=base_url, pages_dir=scratch_dir, rate=1000, burst=50)
+            results['run'], results['run_seconds'] = run, round(time.perf_counter() - start, 2)
+            runs.append(results)
+
+        for row in runs[0].itertuples():
+            with open(page_path(row.kind, row.year, pages_dir)) as f:
+                page = f.read()
+            valid = has_tables(page, row.kind)
+            assert row.status == ('fetched' if valid else 'error'), row.kind + '/' + str(row.year) + ': ' + row.status
+            if valid:
+                with open(page_path(row.kind, row.year, scratch_dir)) as g:
+                    assert g.read() == page, 'different copy of ' + row.kind + '/' + str(row.year)
+            else:
+                assert not os.path.exists(page_path(row.kind, row.year, scratch_dir)), 'invalid page saved'
+        assert runs[0]['attempts'].max() == 2, 'the 503 should be retried once'
+        assert (runs[1]['status'] == runs[0]['status'].replace('fetched', 'not modified')).all(), \
+            'second run: ' + str(runs[1]['status'].value_counts().to_dict())
+    finally:
+        BACKOFF = backoff
+        server.shutdown()
+        shutil.rmtree(scratch_dir)
+
+    results = pd.concat(runs)
+    return(results.groupby(['run', 'status', 'run_seconds']).size().rename('pages').reset_index())
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Download the Basketball Reference pages of each season')
+    parser.add_argument('--kinds', nargs='+', default=list(PAGES), choices=list(PAGES), help='kinds of pages')
+    parser.add_argument('--years', nargs='+', type=int, default=YEARS, help='seasons (1991 to 2023 by default)')
+    parser.add_argument('--base-url', default=BASE_URL, help='site url (e.g. a stand-in server)')
+    parser.add_argument('--pages-dir', default=PAGES_DIR, help='folder containing the mvp, player and team folders')
+    parser.add_argument('--rate', type=float, default=RATE * 60, help='requests per minute')
+    parser.add_argument('--concurrency', type=int, default=CONCURRENCY, help='open connections')
+    parser.add_argument('--no-revalidate', action='store_true', help='only fetch the pages that are not saved yet')
+    parser.add_argument('--self-test', action='store_true', help='scrape a local stand-in server of the saved pages')
+    args = parser.parse_args()
+
+    if args.self_test:
+        print(self_test(args.kinds, args.years, args.pages_dir).to_string(index=False))
+    else:
+        results = scrape(kinds=args.kinds, years=args.years, base_url=args.base_url, pages_dir=args.pages_dir,
+                         rate=args.rate / 60, concurrency=args.concurrency, revalidate=not args.no_revalidate)
+        print(results.groupby(['kind', 'status']).size().rename('pages').reset_index().to_string(index=False))
+        errors = results[results['status'] == 'error']
+        if len(errors) > 0:
+            print(errors.to_string(index=False))
@@ -6,32 +6,222 @@
 # Project aim: Create a data ingestion pipeline in Python to automatically clean and update a customer information databse. 
 # In addition to cleaning and updating the data, we’ll automate the updatong process using error logging and bash scripting.
 
-# This script cleanse the data, uploads it to the new dataframe and runs some unit tests
+# This script cleanse the data, validates it and uploads it to the new dataframe
 
 
 ## Import libraries 
 import sqlite3
 import pandas as pd
 import ast
+import os
+import json
+import time
 import numpy as np
 import logging
+import argparse
+import itertools
+import contextlib
+import sys
+import cProfile
+import pstats
+
+# The changelog versions are read and incremented as `promote.py` (one folder up) orders them
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from promote import read_version, next_version
 
 
 ## Configure logger
 logging.basicConfig(filename="./dev/cleanse_db.log",
                     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-                    filemode='w',
+                    filemode='a',
                     level=logging.DEBUG,
                     force=True)
 logger = logging.getLogger(__name__)
 
 
+## Columns extracted from `contact_info`
+CONTACT_COLS = ['email', 'street', 'city', 'state', 'zipcode']
+
+
+""" Run metrics """
+# Every stage of a run (reads, cleaning, validation checks, writes, CSV export) appends one JSON line
+# to the metrics file, with its wall time, rows in and out and peak memory, so the runs can be
+# compared as the data grows, e.g. `pd.read_json('./dev/run_metrics.jsonl', lines=True)`.
+
+## Metrics file, and fields added to every line of the current run (set by `main`)
+METRICS_FILE = './dev/run_metrics.jsonl'
+run_info = {}
+
+# Records of the stages being timed (a stage can run inside another one, e.g. a write inside a chunk)
+open_stages = []
+
+
+## Peak resident memory (MB) since the last reset
+def peak_rss_mb():
+    """
+    Parameters:
+        None
+
+    Returns:
+        peak (float): high-water mark of the resident memory (`VmHWM` on Linux, `ru_maxrss` of the whole process elsewhere)
+    """
+
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return(round(int(line.split()[1]) / 1024, 1))
+    except OSError:
+        pass
+
+    import resource
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return(round(maxrss / (1024 * 1024 if maxrss > 1024 * 1024 * 1024 else 1024), 1))
+
+
+## Reset the peak resident memory, so the next reading covers a single stage (Linux only)
+def reset_peak_rss():
+    """
+    Parameters:
+        None
+
+    Returns:
+        None
+    """
+
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+## Append a metric line to the metrics file
+def write_metric(record):
+    """
+    Parameters:
+        record (dict): stage metrics (the fields of `run_info` are added)
+
+    Returns:
+        None
+    """
+
+    with open(METRICS_FILE, 'a') as f:
+        f.write(json.dumps({**run_info, **record}, default=str) + '\n')
+
+
+## Time a stage and record its metrics
+@contextlib.contextmanager
+def stage(name, rows_in=None, **fields):
+    """
+    Use around the code of a stage, setting the rows it produced on the yielded record:
+        with stage('cleanse_student_table', rows_in=len(students)) as metrics:
+            students_clean, missing_data = cleanse_student_table(students)
+            metrics['rows_out'] = len(students_clean) + len(missing_data)
+
+    The line is written even if the stage fails (with `status` failed).
+
+    Parameters:
+        name (str): name of the stage
+        rows_in (int): number of rows read by the stage
+        fields (dict): other fields of the line (e.g. `chunk`, `table`)
+
+    Returns:
+        record (dict): metrics of the stage
+    """
+
+    # Fields of the enclosing stages (e.g. the chunk a write belongs to) are kept, unless they're given
+    inherited = {key: parent[key] for parent in open_stages for key in ['chunk'] if key in parent}
+    record = {'stage': name, 'rows_in': rows_in, 'rows_out': None, **inherited, **fields}
+
+    # The peak of the enclosing stages so far is kept before resetting it for this one
+    peak = peak_rss_mb()
+    for parent in open_stages:
+        parent['peak_rss_mb'] = max(parent['peak_rss_mb'], peak)
+    reset_peak_rss()
+    record['peak_rss_mb'] = peak_rss_mb()
+    open_stages.append(record)
+
+    start = time.perf_counter()
+    status = 'failed'
+    try:
+        yield record
+        status = 'ok'
+    finally:
+        record['seconds'] = round(time.perf_counter() - start, 4)
+        record['peak_rss_mb'] = max(record['peak_rss_mb'], peak_rss_mb())
+        record['status'] = status
+        open_stages.remove(record)
+        write_metric(record)
+
+
 """ Data Cleaning """
+## Parse the `contact_info` JSON of every student in one batch
+def parse_contact_info(contact_info):
+    """
+    The whole column is decoded with a single `json.loads` of a JSON array. If that fails, the records
+    are decoded one by one, so a malformed record only flags its own row instead of raising.
+
+    Parameters:
+        contact_info (Series): `contact_info` column of the `students` table (JSON strings)
+
+    Returns:
+        contacts (DataFrame): `email`, `street`, `city`, `state` and `zipcode` of each row (same index)
+        malformed (ndarray): True for the rows whose contact info can't be parsed
+    """
+
+    values = [str(x) for x in contact_info]
+    try:
+        records = json.loads('[' + ','.join(values) + ']')
+        if len(records) != len(values):
+            raise ValueError('Records and rows are misaligned')
+    except ValueError:
+        records = []
+        for value in values:
+            try:
+                records.append(json.loads(value))
+            except ValueError:
+                records.append(None)
+
+    # Records that aren't objects, and values that aren't strings, count as missing
+    records = [record if isinstance(record, dict) else {} for record in records]
+    contacts = pd.DataFrame({key: [record.get(key) if isinstance(record.get(key), str) else None for record in records]
+                             for key in ['email', 'mailing_address']},
+                            index=contact_info.index, dtype=object)
+
+    # Split the Address line (street, city, state, zipcode)
+    split_address = [address.split(',') if address is not None else [] for address in contacts['mailing_address']]
+    malformed = contacts['email'].isna().values | np.array([len(address) != 4 for address in split_address], dtype=bool)
+    split_address = pd.DataFrame([[None] * 4 if bad else address for address, bad in zip(split_address, malformed)],
+                                 index=contacts.index, columns=CONTACT_COLS[1:])
+
+    contacts = pd.concat([contacts[['email']], split_address], axis=1)
+    contacts.loc[malformed, 'email'] = np.nan
+
+    return(contacts, malformed)
+
+
+## Age of each student (in whole years) on a date
+def compute_age(dob, today_date):
+    """
+    Parameters:
+        dob (Series): dates of birth
+        today_date (Timestamp): date the age is computed on (UTC)
+
+    Returns:
+        age (Series): age in whole years
+    """
+
+    return((today_date - pd.to_datetime(dob,utc=True)).astype('<m8[Y]'))
+
+
 ## Student table cleaning
-def cleanse_student_table(df):
+def cleanse_student_table(df, today_date=None):
     """
     Parameters:
         df (DataFrame): `students` table from `cademycode.db`
+        today_date (Timestamp): date the ages are computed on (None for now)
 
     Returns:
         df (DataFrame): cleaned version of the input table
@@ -39,21 +229,14 @@ def cleanse_student_table(df):
     """
     
     # Calculate Age (more usefule than date of birth)
-    today_date = pd.to_datetime('now',utc=True)
-    df['age'] = (today_date - pd.to_datetime(df['dob'],utc=True)).astype('<m8[Y]')
+    if today_date is None:
+        today_date = pd.to_datetime('now',utc=True)
+    df['age'] = compute_age(df['dob'], today_date)
     df['age_group'] = df['age'].apply(lambda x: np.floor(x / 10) * 10)
 
-    # Sort Contact Info formatting
-    df['contact_info'] = df["contact_info"].apply(lambda x: ast.literal_eval(str(x)))
-    explode_contact = pd.json_normalize(df['contact_info'])
-    df = pd.concat([df, explode_contact], axis=1)
-    df = df.drop('contact_info', axis=1).reset_index(drop=True)
-
-    # Split the Address line
-    split_address = df['mailing_address'].str.split(',', expand=True)
-    split_address.columns = ['street', 'city', 'state', 'zipcode']
-    df = pd.concat([df,split_address], axis=1)
-    df = df.drop('mailing_address', axis=1).reset_index(drop=True)
+    # Sort Contact Info formatting (email and split address line)
+    contacts, malformed_contact = parse_contact_info(df['contact_info'])
+    df = pd.concat([df.drop('contact_info', axis=1), contacts], axis=1).reset_index(drop=True)
 
     # Ensure data types are appropriate
     df[['job_id', 'num_course_taken','current_career_path_id', 'time_spent_hrs']] = \
@@ -62,6 +245,12 @@ def cleanse_student_table(df):
     # Missing data
     missing_data = pd.DataFrame()
 
+    # Contact Info that couldn't be parsed
+    if malformed_contact.any():
+        logger.warning("Malformed contact_info for uuid(s): " + str(list(df.loc[malformed_contact, 'uuid'])))
+    missing_data = pd.concat([missing_data, df[malformed_contact]])
+    df = df[~malformed_contact]
+
     # Job ID
     missing_job_id = df[df['job_id'].isna()] 
     missing_data = pd.concat([missing_data,missing_job_id])
@@ -118,236 +307,622 @@ def cleanse_student_jobs_table(df):
     return(df.drop_duplicates())
 
 
-""" Unit Testing """
-## Unit Test: Ensure that all `current_career_path_id` in the *students* df are referenced in the *career_paths* df
-def test_for_path_id(students, career_paths):
+""" Incremental Load """
+## Content hash of each source student row, and of its age on the run date
+def hash_students(df, today_date=None):
     """
+    The age (and age group) of a student changes without its source row changing, so the age on
+    the run date is hashed with the row: a student is cleaned again once its age changes.
+
     Parameters:
-        students (DataFrame): `cademycode_students` table from `cademycode.db`
-        career_paths (DataFrame): `cademycode_courses` table from `cademycode.db`
+        df (DataFrame): `cademycode_students` table (or some of its rows) from `cademycode.db`
+        today_date (Timestamp): date the ages are computed on (None for now)
 
     Returns:
-        None
+        hashes (DataFrame): `uuid` and `row_hash` (int64 hash of all the columns and of the age) of each student
     """
 
-    student_table = students.current_career_path_id.unique()
-    is_subset = np.isin(student_table, career_paths.career_path_id.unique())
-    missing_id = student_table[~is_subset]
-    try:
-        assert len(missing_id) == 0, "Missing career_path_id(s): " + str(list(missing_id)) + " in `career_paths` table"
-     # Raise and log error if the *career_path* table is missing a key present in *students*
-    except AssertionError as ae:
-        logger.exception(ae)
-        raise ae
+    if today_date is None:
+        today_date = pd.to_datetime('now',utc=True)
+    row_hash = pd.util.hash_pandas_object(df.assign(age=compute_age(df['dob'], today_date)), index=False).values.view('int64')
+
+    return(pd.DataFrame({'uuid': df['uuid'].values, 'row_hash': row_hash}))
+
+
+## Read the source students in chunks, in `uuid` order
+def read_student_chunks(con, chunksize=None):
+    """
+    With a chunk size, the rows are fetched from the cursor `chunksize` at a time, so memory is
+    bounded by the chunk rather than by the table.
+
+    Parameters:
+        con (Connection): sqlite3 connection to `cademycode.db`
+        chunksize (int): number of students per chunk (None to read the whole table as one chunk)
+
+    Returns:
+        chunks (generator): DataFrames of at most `chunksize` students
+    """
+
+    query = "SELECT * FROM cademycode_students ORDER BY uuid"
+    if chunksize is None:
+        yield pd.read_sql_query(query, con)
     else:
-        print('All career_path_ids are present.')
+        yield from pd.read_sql_query(query, con, chunksize=chunksize)
+
+
+## Hashes of the students already loaded in the cleansed database
+def read_student_hashes(con, first_uuid=None, last_uuid=None):
+    """
+    Parameters:
+        con (Connection): sqlite3 connection to `cademycode_cleansed.db`
+        first_uuid (int): first uuid of the range to read (None to read all the hashes)
+        last_uuid (int): last uuid of the range to read
+
+    Returns:
+        hashes (DataFrame): `uuid` and `row_hash` of the students loaded by previous runs (empty on the first run)
+    """
+
+    exists = con.execute("SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name = 'student_hashes'").fetchone()[0]
+    if not exists:
+        return(pd.DataFrame({'uuid': pd.Series(dtype='int64'), 'row_hash': pd.Series(dtype='int64')}))
+
+    if first_uuid is None:
+        return(pd.read_sql_query("SELECT uuid, row_hash FROM student_hashes", con))
+
+    # Range scan of the unique index on `uuid`
+    return(pd.read_sql_query("SELECT uuid, row_hash FROM student_hashes WHERE uuid BETWEEN ? AND ?", con,
+                             params=(int(first_uuid), int(last_uuid))))
 
 
-## Unit Test: Ensure that all `job_id` in the *students* df are referenced in the *student_jobs* df
-def test_for_job_id(students, student_jobs):
+## Students that are new or have changed since the last run
+def find_changed_students(students, known_hashes, today_date=None):
     """
     Parameters:
         students (DataFrame): `cademycode_students` table from `cademycode.db`
-        student_jobs (DataFrame): `cademycode_student_jobs` table from `cademycode.db`
+        known_hashes (DataFrame): `uuid` and `row_hash` of the students already loaded
+        today_date (Timestamp): date the ages are computed on (None for now)
+
+    Returns:
+        changed_students (DataFrame): new or changed students (only these need to be cleaned)
+        changed_hashes (DataFrame): `uuid` and `row_hash` of the changed students
+    """
+
+    hashes = hash_students(students, today_date)
+    known = hashes.merge(known_hashes, on=['uuid', 'row_hash'], how='left', indicator=True)['_merge'] == 'both'
+
+    changed_students = students.loc[~known.values].reset_index(drop=True)
+    changed_hashes = hashes.loc[~known.values].reset_index(drop=True)
+
+    return(changed_students, changed_hashes)
+
+
+## `to_sql` insertion method upserting the rows on `uuid`
+def upsert_on_uuid(table, conn, keys, data_iter):
+    """
+    Used as the `method` of `DataFrame.to_sql` (see the pandas documentation on insertion methods),
+    on a table with a unique index on `uuid`.
+
+    Parameters:
+        table (SQLiteTable): pandas table being written
+        conn (Cursor): sqlite3 cursor
+        keys (list): column names
+        data_iter (iterable): rows to write
 
     Returns:
         None
     """
 
-    student_table = students.job_id.unique()
-    is_subset = np.isin(student_table, student_jobs.job_id.unique())
-    missing_id = student_table[~is_subset]
-    try:
-        assert len(missing_id) == 0, "Missing job_id(s): " + str(list(missing_id)) + " in `student_jobs` table"
-    # Raise and log error if the *student_jobs* table is missing a key present in *students*
-    except AssertionError as ae:
-        logger.exception(ae)
-        raise ae
-    else:
-        print('All job_ids are present.')
+    columns = ', '.join('"' + key + '"' for key in keys)
+    updates = ', '.join('"' + key + '" = excluded."' + key + '"' for key in keys if key != 'uuid')
+    query = 'INSERT INTO "' + table.name + '" (' + columns + ') VALUES (' + ', '.join('?' * len(keys)) + ') ' + \
+            'ON CONFLICT(uuid) DO UPDATE SET ' + updates
 
+    conn.executemany(query, data_iter)
 
-## Unit Test: Ensure that no rows in the cleaned table are NaN
-def test_nans(df):
+
+## Ensure a table exists with a unique index on `uuid` (keeping the last copy of any duplicated uuid)
+def ensure_uuid_index(con, df, table):
     """
     Parameters:
-        df (DataFrame): DataFrame of the cleansed table
+        con (Connection): sqlite3 connection to `cademycode_cleansed.db`
+        df (DataFrame): rows to be written (gives the schema of a new table)
+        table (str): name of the table
 
     Returns:
         None
     """
 
-    cnt_missing = df.isna().sum().sum()
+    df.head(0).to_sql(table, con, if_exists='append', index=False)
 
-    try:
-        assert cnt_missing == 0, "There are " + str(cnt_missing) + " nulls in the table."
-    # Raise and log error if NaNs are found in the cleansed df
-    except AssertionError as ae:
-        logger.exception(ae)
-        raise ae
-    else:
-        print('No null rows found.')
+    index = con.execute("SELECT count(*) FROM sqlite_master WHERE type = 'index' AND name = ?", (table + '_uuid',)).fetchone()[0]
+    if not index:
+        # Previous versions of the pipeline appended every student on each run
+        con.execute('DELETE FROM "' + table + '" WHERE rowid NOT IN (SELECT max(rowid) FROM "' + table + '" GROUP BY uuid)')
+        con.execute('CREATE UNIQUE INDEX "' + table + '_uuid" ON "' + table + '" (uuid)')
 
 
-## Unit Test: Ensure that the number of columns in the cleaned DataFrame match the number of columns in the SQLite3 database table.
-def test_num_cols(local_df, db_df):
+## Write the cleaned and incomplete rows of the changed students, and their hashes
+def upsert_students(con, students_clean, missing_data, changed_hashes):
     """
+    The rows of each changed student replace its previous ones, in `students_clean` or `missing_data`
+    (a student can move from one to the other when its source row changes).
+
     Parameters:
-        local_df (DataFrame): DataFrame of the cleansed table
-        db_df (DataFrame): `cademycode_aggregated` table from `cademycode_cleansed.db`
+        con (Connection): sqlite3 connection to `cademycode_cleansed.db`
+        students_clean (DataFrame): cleaned changed students
+        missing_data (DataFrame): incomplete changed students
+        changed_hashes (DataFrame): `uuid` and `row_hash` of the changed students
 
     Returns:
         None
     """
-    try: 
-        assert len(local_df.columns) == len(db_df.columns), "Number of columns in cleaned table does not match production database." 
-    # Raise and log error if number of columns not the same  
-    except AssertionError as ae:
-        logger.exception(ae)
-        raise ae
+
+    ensure_uuid_index(con, changed_hashes, 'student_hashes')
+    if len(students_clean) > 0:
+        ensure_uuid_index(con, students_clean, 'students_clean')
+        with stage('to_sql', rows_in=len(students_clean), table='students_clean') as metrics:
+            students_clean.to_sql('students_clean', con, if_exists='append', index=False, method=upsert_on_uuid)
+            metrics['rows_out'] = len(students_clean)
+
+    # Incomplete rows are kept as they come (no unique index), so the previous ones are deleted first
+    tables = [row[0] for row in con.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+    uuids = [(int(uuid),) for uuid in changed_hashes['uuid']]
+    with stage('to_sql', rows_in=len(missing_data), table='missing_data') as metrics:
+        if 'missing_data' in tables:
+            con.execute('CREATE INDEX IF NOT EXISTS missing_data_uuid ON missing_data (uuid)')
+            con.executemany('DELETE FROM missing_data WHERE uuid = ?', uuids)
+        if len(missing_data) > 0:
+            if 'students_clean' in tables:
+                con.executemany('DELETE FROM students_clean WHERE uuid = ?', [(int(uuid),) for uuid in missing_data['uuid']])
+            missing_data.to_sql('missing_data', con, if_exists='append', index=False)
+        metrics['rows_out'] = len(missing_data)
+
+    with stage('to_sql', rows_in=len(changed_hashes), table='student_hashes') as metrics:
+        changed_hashes.to_sql('student_hashes', con, if_exists='append', index=False, method=upsert_on_uuid)
+        metrics['rows_out'] = len(changed_hashes)
+
+
+## Write every cleaned student, with its career path and job, to the csv file
+def export_students_csv(con, career_paths_clean, student_jobs_clean, path, chunksize=None):
+    """
+    The whole `students_clean` table is exported (not only the changed students of the run), in
+    `uuid` order, so the csv always matches the cleansed database.
+
+    Parameters:
+        con (Connection): sqlite3 connection to `cademycode_cleansed.db`
+        career_paths_clean (DataFrame): cleaned career path lookup table
+        student_jobs_clean (DataFrame): cleaned student jobs lookup table
+        path (str): path of the csv file
+        chunksize (int): number of students read and written at a time (None to export the whole table at once)
+
+    Returns:
+        n_rows (int): number of students written
+    """
+
+    tables = [row[0] for row in con.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+    query = "SELECT * FROM students_clean ORDER BY uuid"
+    if 'students_clean' not in tables:
+        chunks = []
+    elif chunksize is None:
+        chunks = [pd.read_sql_query(query, con)]
     else:
-        print("Number of columns are the same.")
+        chunks = pd.read_sql_query(query, con, chunksize=chunksize)
+
+    n_rows = 0
+    for students_clean in chunks:
+        students_clean['job_id'] = students_clean['job_id'].astype(int)
+        students_clean['current_career_path_id'] = students_clean['current_career_path_id'].astype(int)
+
+        df_clean = students_clean.merge(career_paths_clean, left_on='current_career_path_id', right_on='career_path_id', how='left')
+        df_clean = df_clean.merge(student_jobs_clean, on='job_id', how='left')
+        df_clean.index = range(n_rows, n_rows + len(df_clean))
+
+        df_clean.to_csv(path, mode='w' if n_rows == 0 else 'a', header=n_rows == 0)
+        n_rows += len(df_clean)
+
+    return(n_rows)
+
+
+""" Validation """
+# Declarative checks of the cleaned tables, run before they're written. Every check runs and is
+# timed, and all the violations are reported together (instead of stopping at the first one).
+
+## Reference checks: (table, column) -> (lookup table, column) that must contain every value
+REFERENCES = {('students_clean', 'current_career_path_id'): ('career_paths_clean', 'career_path_id'),
+              ('students_clean', 'job_id'): ('student_jobs_clean', 'job_id')}
+
+## SQLite column type written by `DataFrame.to_sql` for each kind of dtype
+SQLITE_TYPES = {'i': 'INTEGER', 'u': 'INTEGER', 'b': 'INTEGER', 'f': 'REAL', 'M': 'TIMESTAMP', 'O': 'TEXT'}
+
+
+## Column types of a database table, read with `PRAGMA table_info` (no rows are read)
+def read_table_schema(con, table):
+    """
+    Parameters:
+        con (Connection): sqlite3 connection to the database
+        table (str): name of the table
+
+    Returns:
+        schema (dict): column name -> declared type, in column order (empty if the table doesn't exist)
+    """
+
+    return({row[1]: row[2] for row in con.execute('PRAGMA table_info("' + table + '")')})
 
 
-## Unit Test: Ensure that the column dtypes in the cleaned DataFrame match the column dtypes in the SQLite3 database table.
-def test_schema(local_df, db_df):
+## Validation: every referenced id exists in its lookup table
+def check_references(tables):
     """
     Parameters:
-        local_df (DataFrame): DataFrame of the cleansed table
-        db_df (DataFrame): `cademycode_aggregated` table from `cademycode_cleansed.db`
+        tables (dict): table name -> cleaned DataFrame
+
+    Returns:
+        results (list): one result per reference check
+    """
+
+    results = []
+    for (table, column), (lookup_table, lookup_column) in REFERENCES.items():
+        if table not in tables or lookup_table not in tables:
+            continue
+        start = time.perf_counter()
+        is_missing = ~np.isin(tables[table][column].values, tables[lookup_table][lookup_column].unique())
+        missing_ids = sorted(set(tables[table][column].values[is_missing]))
+        results.append({'check': 'references', 'table': table, 'column': column,
+                        'status': 'failed' if len(missing_ids) > 0 else 'passed',
+                        'violations': int(is_missing.sum()),
+                        'detail': 'missing in `' + lookup_table + '`: ' + str(missing_ids[:10]) if len(missing_ids) > 0 else '',
+                        'ms': (time.perf_counter() - start) * 1000})
+
+    return(results)
+
+
+## Validation: no nulls in the cleaned tables (one pass per table, all columns at once)
+def check_not_null(tables):
+    """
+    Parameters:
+        tables (dict): table name -> cleaned DataFrame
+
+    Returns:
+        results (list): one result per table
+    """
+
+    results = []
+    for table, df in tables.items():
+        start = time.perf_counter()
+        nulls = df.isna().sum()
+        nulls = nulls[nulls > 0]
+        results.append({'check': 'not_null', 'table': table, 'column': '',
+                        'status': 'failed' if len(nulls) > 0 else 'passed',
+                        'violations': int(nulls.sum()),
+                        'detail': ', '.join(col + ': ' + str(n) for col, n in nulls.items()),
+                        'ms': (time.perf_counter() - start) * 1000})
+
+    return(results)
+
+
+## Validation: the columns and types of the cleaned tables match the production tables
+def check_schema(tables, prod_con):
+    """
+    Parameters:
+        tables (dict): table name -> cleaned DataFrame
+        prod_con (Connection): sqlite3 connection to the production database (None if there isn't any yet)
+
+    Returns:
+        results (list): one result per table
+    """
+
+    results = []
+    for table, df in tables.items():
+        start = time.perf_counter()
+        prod_schema = {} if prod_con is None else read_table_schema(prod_con, table)
+        if len(prod_schema) == 0:
+            results.append({'check': 'schema', 'table': table, 'column': '', 'status': 'skipped', 'violations': 0,
+                            'detail': 'no production table yet', 'ms': (time.perf_counter() - start) * 1000})
+            continue
+
+        local_schema = {col: SQLITE_TYPES.get(dtype.kind, 'TEXT') for col, dtype in df.dtypes.items()}
+        issues = ['missing column ' + col for col in prod_schema if col not in local_schema] + \
+                 ['extra column ' + col for col in local_schema if col not in prod_schema] + \
+                 [col + ' is ' + local_schema[col] + ' (' + prod_schema[col] + ' in production)'
+                  for col in prod_schema if col in local_schema and local_schema[col] != prod_schema[col]]
+
+        results.append({'check': 'schema', 'table': table, 'column': '',
+                        'status': 'failed' if len(issues) > 0 else 'passed',
+                        'violations': len(issues), 'detail': ', '.join(issues),
+                        'ms': (time.perf_counter() - start) * 1000})
+
+    return(results)
+
+
+## Run every check on the cleaned tables
+def validate_tables(tables, prod_con=None):
+    """
+    Parameters:
+        tables (dict): table name -> cleaned DataFrame (with the lookup tables of the reference checks)
+        prod_con (Connection): sqlite3 connection to the production database (None if there isn't any yet)
+
+    Returns:
+        report (DataFrame): `check`, `table`, `column`, `status` (passed, failed or skipped),
+            number of `violations`, `detail` and duration (`ms`) of each check
+    """
+
+    results = check_references(tables) + check_not_null(tables) + check_schema(tables, prod_con)
+    report = pd.DataFrame(results, columns=['check', 'table', 'column', 'status', 'violations', 'detail', 'ms'])
+    report['ms'] = report['ms'].round(2)
+
+    return(report)
+
+
+## Append a metric line per check of a validation report
+def write_check_metrics(report, tables, **fields):
+    """
+    Parameters:
+        report (DataFrame): validation report from `validate_tables`
+        tables (dict): table name -> cleaned DataFrame checked
+        fields (dict): other fields of the lines (e.g. `chunk`)
 
     Returns:
         None
     """
-    errors = 0
-    for col in db_df:
-        try:
-            if local_df[col].dtypes != db_df[col].dtypes:
-                errors += 1
-        # Raise and log error if a column doesn't exist
-        except NameError as ne:
-            logger.exception(ne)
-            raise ne
-
-        # Log if dtypes don't match
-
-    if errors > 0:
-        assert_err_msg = str(errors) + " columns have different dtypes."
-        logger.exception(assert_err_msg)
-        assert errors == 0, assert_err_msg
-    else:
-        print("dtypes columns are the same")
 
+    for row in report.itertuples():
+        write_metric({'stage': 'check_' + row.check, 'rows_in': len(tables[row.table]), 'rows_out': None, **fields,
+                      'table': row.table, 'column': row.column, 'violations': int(row.violations),
+                      'seconds': round(row.ms / 1000, 4), 'status': row.status})
 
-""" Main Method (driver to execute all the functions defined above) """
-def main():
 
-    ## Initialize log
-    logger.info("Start Log")
-    # Check for current version and calculate next version for changelog
-    with open('./dev/changelog.md') as f:
-        lines = f.readlines()
-    next_ver = int(lines[0].split('.')[2][0])+1
-
-
-    ## Connect to the dev database and read in the three tables
-    con = sqlite3.connect('./dev/cademycode.db')
-    #con = sqlite3.connect('./dev/cademycode_updated.db')
-    students = pd.read_sql_query("SELECT * FROM cademycode_students", con)
-    career_paths = pd.read_sql_query("SELECT * FROM cademycode_courses", con)
-    student_jobs = pd.read_sql_query("SELECT * FROM cademycode_student_jobs", con)
+## Log and print the validation report, and raise if any check failed (before anything is written)
+def assert_valid(report):
+    """
+    Parameters:
+        report (DataFrame): validation report from `validate_tables`
+
+    Returns:
+        None
+    """
+
+    print(report.to_string(index=False))
+    logger.info("Validation report:\n" + report.to_string(index=False))
+
+    failed = report[report['status'] == 'failed']
+    if len(failed) > 0:
+        message = str(len(failed)) + " validation check(s) failed: " + \
+            '; '.join(row.check + ' ' + row.table + (' ' + row.column if row.column else '') + ' (' + row.detail + ')'
+                      for row in failed.itertuples())
+        logger.error(message)
+        raise AssertionError(message)
+
+
+""" Benchmark """
+## Previous parsing of `contact_info` (one `literal_eval` per row, `json_normalize`, address split), kept as the reference output
+def parse_contact_info_legacy(contact_info):
+    """
+    Parameters:
+        contact_info (Series): `contact_info` column of the `students` table (JSON strings)
+
+    Returns:
+        contacts (DataFrame): `email`, `street`, `city`, `state` and `zipcode` of each row
+    """
+
+    explode_contact = pd.json_normalize(contact_info.apply(lambda x: ast.literal_eval(str(x))))
+    split_address = explode_contact['mailing_address'].str.split(',', expand=True)
+    split_address.columns = ['street', 'city', 'state', 'zipcode']
+
+    return(pd.concat([explode_contact[['email']], split_address], axis=1))
+
+
+## Check the batch parsing of `contact_info` against the previous path and time both
+def benchmark_contact_info(source_db='./dev/cademycode.db', n_rows=500000, repeat=3):
+    """
+    Parameters:
+        source_db (str): path of the raw database (its `contact_info` values are repeated up to `n_rows`)
+        n_rows (int): number of rows parsed
+        repeat (int): number of timings per parser (the best is kept)
+
+    Returns:
+        results (DataFrame): parity and timings of each parser
+    """
+
+    con = sqlite3.connect(source_db)
+    contact_info = pd.read_sql_query("SELECT contact_info FROM cademycode_students", con)['contact_info']
     con.close()
+    contact_info = pd.Series(np.resize(contact_info.values, n_rows))
+
+    timings = {}
+    for label, parser in [('legacy', parse_contact_info_legacy), ('batch', lambda x: parse_contact_info(x)[0])]:
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            output = parser(contact_info)
+            seconds = time.perf_counter() - start
+            best = seconds if best is None else min(best, seconds)
+        timings[label] = (output, best)
+
+    identical = timings['legacy'][0].equals(timings['batch'][0])
+
+    return(pd.DataFrame([{'rows': n_rows,
+                          'identical': identical,
+                          'legacy_sec': round(timings['legacy'][1], 3),
+                          'batch_sec': round(timings['batch'][1], 3),
+                          'speedup': round(timings['legacy'][1] / timings['batch'][1], 1)}]))
+
+
+""" Self-test """
+## Check that the students are cleaned again when their age changes (and only then)
+def check_age_refresh(source_db='./dev/cademycode.db', today_date=pd.Timestamp('2026-10-17', tz='UTC')):
+    """
+    Two students of the source database are given a date of birth such that one of them turns 30
+    the day after `today_date`, and the other one doesn't. Their hashes of `today_date` are the
+    known ones of the next day's run.
 
+    Parameters:
+        source_db (str): path of the raw database
+        today_date (Timestamp): date of the first run
 
-    ## Try to connect to prod databse (i.e., the cleased database) to check if they're any new students to add
-    try: 
-        con = sqlite3.connect('./prod/cademycode_cleansed.db')
-        students_prod_db = pd.read_sql_query("SELECT * FROM students_clean", con)
-        career_paths_prod_db = pd.read_sql_query("SELECT * FROM career_paths_clean", con)
-        student_jobs_prod_db = pd.read_sql_query("SELECT * FROM student_jobs_clean", con)
-        missing_prod_db = pd.read_sql_query("SELECT * FROM missing_data", con)
-        con.close()
+    Returns:
+        results (DataFrame): each check and whether it passed
+    """
 
-        # Filter for students that don't exist in the cleansed database
-        #new_students = students.loc[~students['uuid'].isin(students_prod_db['uuid'].unique())].copy()
-        new_students = students
+    con = sqlite3.connect(source_db)
+    students = pd.read_sql_query("SELECT * FROM cademycode_students ORDER BY uuid LIMIT 2", con)
+    con.close()
 
-    # If cleansed database doesn't exist
-    except:
-        new_students = students
+    next_date = today_date + pd.Timedelta(days=1)
+    students['dob'] = [(next_date - pd.Timedelta(days=30 * 365.2425)).strftime('%Y-%m-%d'),
+                       (next_date - pd.Timedelta(days=30 * 365.2425 + 180)).strftime('%Y-%m-%d')]
+    birthday_uuid = int(students['uuid'].iloc[0])
 
+    _, known_hashes = find_changed_students(students, pd.DataFrame({'uuid': [], 'row_hash': []}), today_date)
+    same_day, _ = find_changed_students(students, known_hashes, today_date)
+    next_day, _ = find_changed_students(students, known_hashes, next_date)
+    students_clean, _ = cleanse_student_table(students.copy(), today_date)
+    next_day_clean, _ = cleanse_student_table(next_day.copy(), next_date)
 
-    ## Clean `new_students` data 
-    new_students_clean, missing_data = cleanse_student_table(new_students)
+    return(pd.DataFrame([
+        {'check': 'no student changed on the same day', 'ok': len(same_day) == 0},
+        {'check': 'only the student turning 30 changed the next day', 'ok': list(next_day['uuid'].astype(int)) == [birthday_uuid]},
+        {'check': 'its age is 29 then 30', 'ok': list(students_clean['age'])[0] == 29 and list(next_day_clean['age']) == [30]},
+        {'check': 'its age group is 20 then 30', 'ok': list(students_clean['age_group'])[0] == 20 and list(next_day_clean['age_group']) == [30]}]))
 
 
-    ## Check for any new missing data not already in the cleansed database. Only add in that case
-    try:
-        # Filter for incomplete rows that don't exist in the missing data table
-        #new_missing_data = missing_data[~np.isin(missing_data.uuid.unique(), missing_prod_db.uuid.unique())]
-        new_missing_data = missing_data.loc[~missing_data['uuid'].isin(missing_prod_db['uuid'].unique())].copy()
-    except:
-        new_missing_data = missing_data
+""" Main Method (driver to execute all the functions defined above) """
+def main(source_db='./dev/cademycode.db', full=False, chunksize=None):
+    """
+    Only the students that are new or changed since the last run (by `uuid` and content hash) are
+    cleaned and upserted, so a run costs in proportion to the change rather than to the table.
+    With a chunk size, the students are streamed and each chunk is cleaned, tested and committed in
+    its own transaction, so memory stays bounded on large exports (an interrupted run resumes from
+    the hashes of the committed chunks). The metrics of every stage are appended to `METRICS_FILE`.
 
-    if len(new_missing_data) > 0:
-        con = sqlite3.connect('./dev/cademycode_cleansed.db')   # to dev folder, as the whole db will be transfer to prod at end of process
-        missing_data.to_sql('missing_data', con, if_exists='append', index=False)
-        con.close()
+    Parameters:
+        source_db (str): path of the raw database
+        full (bool): clean and upsert every student, ignoring the hashes of the previous runs
+        chunksize (int): number of students per chunk (None to process the whole table at once)
 
+    Returns:
+        None
+    """
 
-    ## Only if there are new students, clean the *career_path* and *student_jobs* df
-    if len(new_students_clean) > 0:
-        career_paths_clean = cleanse_career_path_table(career_paths)
-        student_jobs_clean = cleanse_student_jobs_table(student_jobs)
-
-
-        ## UNIT TESTING
-        # Ensure that all path_id and job_id in *students* respetively exist in the *career_paths* and *student_jobs* tables
-        test_for_path_id(new_students_clean, career_paths_clean)
-        test_for_job_id(new_students_clean, student_jobs_clean)
-
-        # Compare schema of cleaned data with prod databse (if it already exists)
-        # Ensure correct schema and complete data before upserting to database
-        
-        local_dfs = [new_students_clean, career_paths_clean, student_jobs_clean]
-        db_dfs = [students_prod_db, career_paths_prod_db, student_jobs_prod_db] 
-        table_names = ["Students:", "Career paths:", "Student jobs:"]
-
-        for t in range(len(local_dfs)):
-            # For user readability
-            print(table_names[t])
-            # Run unit tests to check the schema of the local dfs match the destination (i.e., the database schema)
-            test_num_cols(local_dfs[t], db_dfs[t])
-            test_schema(local_dfs[t], db_dfs[t])
-            # Check there's no NaNs before upserting to database
-            test_nans(local_dfs[t])
-    
-        #print("Schema unit tests couldn't be run because there isn't any production databse yet")
-        
-
-        ## Connect to the dev database to upsert the three tables
-        con = sqlite3.connect('./dev/cademycode_cleansed.db')
-        new_students_clean.to_sql('students_clean', con, if_exists='append', index=False)
-        career_paths_clean.to_sql('career_paths_clean', con, if_exists='append', index=False)
-        student_jobs_clean.to_sql('student_jobs_clean', con, if_exists='append', index=False)
-        con.close()
+    ## Initialize log and metrics (the ages are computed on the date of the start of the run)
+    logger.info("Start Log")
+    today_date = pd.to_datetime('now',utc=True)
+    run_info.clear()
+    run_info.update({'run_id': time.strftime('%Y-%m-%dT%H:%M:%S') + '-' + str(os.getpid()),
+                     'source_db': source_db, 'full': full, 'chunksize': chunksize})
+
+    with stage('run') as run_metrics:
+        # Check for current version and calculate next version for changelog (the whole version, e.g. 0.0.9 -> 0.0.10)
+        with open('./dev/changelog.md') as f:
+            lines = f.readlines()
+        next_ver = next_version(read_version('./dev/changelog.md'))
+
+
+        ## Connect to the dev database and clean the two small lookup tables (the students are read in chunks below)
+        source_con = sqlite3.connect(source_db)
+        with stage('read', table='cademycode_courses') as metrics:
+            career_paths = pd.read_sql_query("SELECT * FROM cademycode_courses", source_con)
+            metrics['rows_out'] = len(career_paths)
+        with stage('read', table='cademycode_student_jobs') as metrics:
+            student_jobs = pd.read_sql_query("SELECT * FROM cademycode_student_jobs", source_con)
+            metrics['rows_out'] = len(student_jobs)
+        with stage('cleanse_career_path_table', rows_in=len(career_paths)) as metrics:
+            career_paths_clean = cleanse_career_path_table(career_paths)
+            metrics['rows_out'] = len(career_paths_clean)
+        with stage('cleanse_student_jobs_table', rows_in=len(student_jobs)) as metrics:
+            student_jobs_clean = cleanse_student_jobs_table(student_jobs)
+            metrics['rows_out'] = len(student_jobs_clean)
+
+
+        ## Try to connect to prod databse (i.e., the cleased database) to compare the schemas (read-only, no rows are read)
+        try:
+            prod_con = sqlite3.connect('file:./prod/cademycode_cleansed.db?mode=ro', uri=True)
+        # If cleansed database doesn't exist
+        except sqlite3.OperationalError:
+            prod_con = None
 
-        ## Merge the 3 local dfs and write to .csv file
-        new_students_clean['job_id'] = new_students_clean['job_id'].astype(int)
-        new_students_clean['current_career_path_id'] = new_students_clean['current_career_path_id'].astype(int)
-        
-        df_clean = new_students_clean.merge(career_paths_clean, left_on='current_career_path_id', right_on='career_path_id', how='left')
-        df_clean = df_clean.merge(student_jobs_clean, on='job_id', how='left')
-        
-        df_clean.to_csv('./dev/cademycode_cleansed.csv')
+
+        ## Replace the two small lookup tables (on every run, so their changes are picked up even without changed students)
+        con = sqlite3.connect('./dev/cademycode_cleansed.db')   # to dev folder, as the whole db will be transfer to prod at end of process
+        with con:
+            for df, table in [(career_paths_clean, 'career_paths_clean'), (student_jobs_clean, 'student_jobs_clean')]:
+                with stage('to_sql', rows_in=len(df), table=table) as metrics:
+                    df.to_sql(table, con, if_exists='replace', index=False)
+                    metrics['rows_out'] = len(df)
+
+
+        ## Clean and upsert the new or changed students of each chunk, in one transaction per chunk
+        n_changed, n_clean, n_missing = 0, 0, 0
+        student_chunks = read_student_chunks(source_con, chunksize)
+
+        for chunk in itertools.count():
+            with stage('read', chunk=chunk, table='cademycode_students') as metrics:
+                students = next(student_chunks, None)
+                metrics['rows_out'] = 0 if students is None else len(students)
+            if students is None:
+                break
+
+            # Every stage of the chunk (including the writes) is recorded with its number
+            with stage('chunk', rows_in=len(students), chunk=chunk) as chunk_metrics:
+                with con:
+                    # Find the new or changed students, from the hashes of the same uuid range in the cleansed database
+                    with stage('find_changed_students', rows_in=len(students)) as metrics:
+                        known_hashes = read_student_hashes(con, students['uuid'].min(), students['uuid'].max())
+                        if full:
+                            known_hashes = known_hashes.head(0)
+                        new_students, new_hashes = find_changed_students(students, known_hashes, today_date)
+                        metrics['rows_out'] = len(new_students)
+                    chunk_metrics['rows_out'] = len(new_students)
+                    if len(new_students) == 0:
+                        continue
+
+                    ## Clean `new_students` data
+                    with stage('cleanse_student_table', rows_in=len(new_students)) as metrics:
+                        new_students_clean, new_missing_data = cleanse_student_table(new_students, today_date)
+                        metrics['rows_out'] = len(new_students_clean)
+                        metrics['rows_missing'] = len(new_missing_data)
+
+
+                    ## VALIDATION
+                    # References, nulls and schema (against prod, if it already exists) of the cleaned tables, before upserting
+                    if len(new_students_clean) > 0:
+                        tables = {'students_clean': new_students_clean,
+                                  'career_paths_clean': career_paths_clean,
+                                  'student_jobs_clean': student_jobs_clean}
+                        with stage('validate_tables', rows_in=len(new_students_clean)) as metrics:
+                            report = validate_tables(tables, prod_con)
+                            write_check_metrics(report, tables, chunk=chunk)
+                            assert_valid(report)
+                            metrics['rows_out'] = len(new_students_clean)
+
+
+                    ## Upsert the changed students
+                    upsert_students(con, new_students_clean, new_missing_data, new_hashes)
+
+            n_changed += len(new_students)
+            n_clean += len(new_students_clean)
+            n_missing += len(new_missing_data)
+
+
+        ## Merge the 3 tables and write every cleaned student (not only the changed ones) to the .csv file
+        with stage('to_csv') as metrics:
+            metrics['rows_out'] = export_students_csv(con, career_paths_clean, student_jobs_clean,
+                                                      './dev/cademycode_cleansed.csv', chunksize)
+
+        con.close()
+        source_con.close()
+        if prod_con is not None:
+            prod_con.close()
+        run_metrics['rows_in'] = n_changed
+        run_metrics['rows_out'] = n_clean
+        run_metrics['rows_missing'] = n_missing
 
 
-        ## Create new automatic changelog entry
+    ## Create new automatic changelog entry, if there were new or changed students
+    if n_changed > 0:
         new_lines = [
-            '## 0.0.' + str(next_ver) + '\n' +
+            '## ' + next_ver + '\n' +
             '### Added\n' +
-            '- ' + str(len(new_students_clean)) + ' more data to database of raw data\n' +
-            '- ' + str(len(new_missing_data)) + ' new missing data to incomplete_data table\n' +
+            '- ' + str(n_clean) + ' more data to database of raw data\n' +
+            '- ' + str(n_missing) + ' new missing data to incomplete_data table\n' +
             '\n'
         ]
         w_lines = ''.join(new_lines + lines)
@@ -362,9 +937,56 @@ def main():
     else:
         print("No new data")
         logger.info("No new data")
+    logger.info("Run " + run_info['run_id'] + ": " + str(n_changed) + " changed students in " +
+                str(run_metrics['seconds']) + " s (peak memory " + str(run_metrics['peak_rss_mb']) + " MB)")
     logger.info("End Log")
 
 
+## Run `main` under cProfile, and save and print the profile
+def profile_main(path, *args):
+    """
+    Parameters:
+        path (str): file the profile is saved to (readable with `pstats` or `snakeviz`)
+        args (tuple): arguments of `main`
+
+    Returns:
+        None
+    """
+
+    profiler = cProfile.Profile()
+    try:
+        profiler.runcall(main, *args)
+    finally:
+        profiler.dump_stats(path)
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(20)
+
+
 ## Run the main function in the driver
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+
+    parser = argparse.ArgumentParser(description='Clean the new or changed students and upsert them into the cleansed database')
+    parser.add_argument('--source-db', default='./dev/cademycode.db', help='raw database (e.g. ./dev/cademycode_updated.db)')
+    parser.add_argument('--full', action='store_true', help='clean and upsert every student, not only the new or changed ones')
+    parser.add_argument('--chunksize', type=int, default=None,
+                        help='stream the students in chunks of this size, one transaction per chunk (bounded memory)')
+    parser.add_argument('--benchmark', type=int, default=None, metavar='ROWS',
+                        help='only compare the contact_info parsing with the previous one, on ROWS rows')
+    parser.add_argument('--self-test', action='store_true',
+                        help='only check that the students are cleaned again when their age changes')
+    parser.add_argument('--metrics-file', default=METRICS_FILE, help='JSON lines file the stage metrics are appended to')
+    parser.add_argument('--profile', nargs='?', const='./dev/cleanse_data.prof', default=None, metavar='PATH',
+                        help='run under cProfile, save the profile to PATH and print the top functions')
+    args = parser.parse_args()
+    METRICS_FILE = args.metrics_file
+
+    if args.benchmark is not None:
+        print(benchmark_contact_info(args.source_db, args.benchmark).to_string(index=False))
+    elif args.self_test:
+        results = check_age_refresh(args.source_db)
+        print(results.to_string(index=False))
+        if not results['ok'].all():
+            raise SystemExit(1)
+    elif args.profile is not None:
+        profile_main(args.profile, args.source_db, args.full, args.chunksize)
+    else:
+        main(args.source_db, args.full, args.chunksize)
@@ -0,0 +1,462 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+""" Subscriber Cancellations Data Pipeline - Promotion """
+
+# Promotes the dev files (cleansed database, CSV and changelog) to prod, without prompts.
+# The prod database runs in WAL mode and is overwritten with the SQLite online backup API in a
+# single transaction, so readers keep reading the previous version (never a torn file) and are
+# never blocked. Each promoted version is kept as a snapshot named after its changelog version
+# (`prod/snapshots/0.0.N/`), and prod can be rolled back to any of the kept snapshots. The snapshots
+# are ordered by promotion time, not by version. A rollback pins the version rolled back from
+# (`prod/pinned_version`), so the next unattended run doesn't promote an already promoted dev
+# version again: only a new version (or `--force`) is promoted.
+# `python promote.py --self-test` runs promotions, prunes and rollbacks on a scratch folder.
+
+
+## Import libraries
+import os
+import re
+import time
+import shutil
+import sqlite3
+import argparse
+import tempfile
+
+
+## Parameters
+DEV_DIR = './dev'
+PROD_DIR = './prod'
+DB_FILE = 'cademycode_cleansed.db'
+CSV_FILE = 'cademycode_cleansed.csv'
+CHANGELOG_FILE = 'changelog.md'
+PIN_FILE = 'pinned_version'
+PROMOTED_FILE = 'promoted_at'
+KEEP = 5
+
+
+""" Versions """
+## Version in the first line of a changelog (e.g. `## 0.0.3`)
+def read_version(changelog_path):
+    """
+    Parameters:
+        changelog_path (str): path of the changelog
+
+    Returns:
+        version (str): version of the last changelog entry (None if the changelog doesn't exist)
+    """
+
+    if not os.path.exists(changelog_path):
+        return(None)
+    with open(changelog_path) as f:
+        match = re.match(r'##\s+(\S+)', f.readline())
+
+    return(None if match is None else match.group(1))
+
+
+## Sort key of a version
+def version_key(version):
+    """
+    Parameters:
+        version (str): e.g. `0.0.12`
+
+    Returns:
+        key (tuple): e.g. (0, 0, 12)
+    """
+
+    return(tuple(int(part) for part in version.split('.')))
+
+
+## Version of the next changelog entry (the last part is incremented, e.g. `0.0.9` -> `0.0.10`)
+def next_version(version):
+    """
+    Parameters:
+        version (str): current version, e.g. `0.0.9`
+
+    Returns:
+        version (str): next version, e.g. `0.0.10`
+    """
+
+    key = version_key(version)
+    return('.'.join(str(part) for part in key[:-1] + (key[-1] + 1,)))
+
+
+## Version rolled back from, whose dev files aren't promoted again without `--force`
+def read_pin(prod_dir=PROD_DIR):
+    """
+    Parameters:
+        prod_dir (str): prod folder
+
+    Returns:
+        version (str): pinned version (None if prod isn't pinned)
+    """
+
+    pin_path = os.path.join(prod_dir, PIN_FILE)
+    if not os.path.exists(pin_path):
+        return(None)
+    with open(pin_path) as f:
+        version = f.read().strip()
+
+    return(version if version != '' else None)
+
+
+## Pin a version (or remove the pin)
+def write_pin(version, prod_dir=PROD_DIR):
+    """
+    Parameters:
+        version (str): version to pin (None to remove the pin)
+        prod_dir (str): prod folder
+
+    Returns:
+        None
+    """
+
+    pin_path = os.path.join(prod_dir, PIN_FILE)
+    if version is None:
+        if os.path.exists(pin_path):
+            os.remove(pin_path)
+        return
+
+    with open(pin_path + '.tmp', 'w') as f:
+        f.write(version + '\n')
+    os.replace(pin_path + '.tmp', pin_path)
+
+
+""" Copies """
+## Overwrite a database with the content of another one, in a single transaction (online backup API)
+def backup_database(source_path, target_path, wal=False):
+    """
+    Parameters:
+        source_path (str): path of the database to copy
+        target_path (str): path of the database to overwrite (created if it doesn't exist)
+        wal (bool): keep the target in WAL mode, so its readers aren't blocked by the copy
+
+    Returns:
+        None
+    """
+
+    source = sqlite3.connect('file:' + source_path + '?mode=ro', uri=True)
+    target = sqlite3.connect(target_path)
+    try:
+        if wal:
+            target.execute('PRAGMA journal_mode=WAL')
+        # All the pages are copied in one step, i.e. one write transaction on the target
+        source.backup(target, pages=-1)
+    finally:
+        source.close()
+        target.close()
+
+
+## Copy a file to a temporary file next to the destination, then rename it over the destination
+def replace_file(source_path, target_path):
+    """
+    Parameters:
+        source_path (str): path of the file to copy
+        target_path (str): path of the file to replace
+
+    Returns:
+        None
+    """
+
+    shutil.copyfile(source_path, target_path + '.tmp')
+    os.replace(target_path + '.tmp', target_path)
+
+
+""" Snapshots """
+## Promotion time of a snapshot (ns since the epoch)
+def promotion_time(snapshot_dir):
+    """
+    Parameters:
+        snapshot_dir (str): folder of the snapshot
+
+    Returns:
+        promoted_at (int): time the snapshot was promoted (the time its database was written for the
+            snapshots saved before the promotion time was recorded)
+    """
+
+    promoted_path = os.path.join(snapshot_dir, PROMOTED_FILE)
+    if not os.path.exists(promoted_path):
+        return(os.stat(os.path.join(snapshot_dir, DB_FILE)).st_mtime_ns)
+    with open(promoted_path) as f:
+        return(int(f.read().strip()))
+
+
+## Versions of the kept snapshots, in promotion order (oldest first)
+def list_snapshots(prod_dir=PROD_DIR):
+    """
+    Parameters:
+        prod_dir (str): prod folder
+
+    Returns:
+        versions (list): versions of the snapshots in `prod_dir/snapshots`
+    """
+
+    snapshots_dir = os.path.join(prod_dir, 'snapshots')
+    if not os.path.isdir(snapshots_dir):
+        return([])
+
+    versions = [name for name in os.listdir(snapshots_dir) if re.fullmatch(r'\d+(\.\d+)*', name)]
+    return(sorted(versions, key=lambda version: (promotion_time(os.path.join(snapshots_dir, version)),
+                                                 version_key(version))))
+
+
+## Save the dev files as the snapshot of their version
+def create_snapshot(version, dev_dir=DEV_DIR, prod_dir=PROD_DIR):
+    """
+    The snapshot is written to a temporary folder first, so a snapshot is never left half written.
+
+    Parameters:
+        version (str): changelog version of the dev files
+        dev_dir (str): dev folder
+        prod_dir (str): prod folder
+
+    Returns:
+        snapshot_dir (str): folder of the snapshot
+    """
+
+    snapshot_dir = os.path.join(prod_dir, 'snapshots', version)
+    tmp_dir = snapshot_dir + '.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    backup_database(os.path.join(dev_dir, DB_FILE), os.path.join(tmp_dir, DB_FILE))
+    for file in [CSV_FILE, CHANGELOG_FILE]:
+        if os.path.exists(os.path.join(dev_dir, file)):
+            shutil.copyfile(os.path.join(dev_dir, file), os.path.join(tmp_dir, file))
+    with open(os.path.join(tmp_dir, PROMOTED_FILE), 'w') as f:
+        f.write(str(time.time_ns()) + '\n')
+
+    shutil.rmtree(snapshot_dir, ignore_errors=True)
+    os.replace(tmp_dir, snapshot_dir)
+
+    return(snapshot_dir)
+
+
+## Delete the oldest snapshots, keeping the `keep` most recently promoted ones (and the prod version)
+def prune_snapshots(keep=KEEP, prod_dir=PROD_DIR):
+    """
+    Parameters:
+        keep (int): number of snapshots to keep
+        prod_dir (str): prod folder
+
+    Returns:
+        deleted (list): versions of the deleted snapshots
+    """
+
+    versions = list_snapshots(prod_dir)
+    prod_version = read_version(os.path.join(prod_dir, CHANGELOG_FILE))
+    deleted = [version for version in versions[:max(len(versions) - keep, 0)] if version != prod_version]
+    for version in deleted:
+        shutil.rmtree(os.path.join(prod_dir, 'snapshots', version))
+
+    return(deleted)
+
+
+""" Promotion and rollback """
+## Make a snapshot the current prod version
+def restore_snapshot(snapshot_dir, prod_dir=PROD_DIR):
+    """
+    The database is restored first and the changelog last, so the prod changelog only shows a
+    version once its database is in place.
+
+    Parameters:
+        snapshot_dir (str): folder of the snapshot
+        prod_dir (str): prod folder
+
+    Returns:
+        None
+    """
+
+    backup_database(os.path.join(snapshot_dir, DB_FILE), os.path.join(prod_dir, DB_FILE), wal=True)
+    for file in [CSV_FILE, CHANGELOG_FILE]:
+        if os.path.exists(os.path.join(snapshot_dir, file)):
+            replace_file(os.path.join(snapshot_dir, file), os.path.join(prod_dir, file))
+
+
+## Promote the dev files to prod, if their version is new
+def promote(dev_dir=DEV_DIR, prod_dir=PROD_DIR, keep=KEEP, force=False):
+    """
+    While prod is pinned (see `rollback`), a dev version that was already promoted (it has a
+    snapshot, or is the pinned one) isn't promoted again unless forced. Promoting a new version,
+    or forcing, removes the pin.
+
+    Parameters:
+        dev_dir (str): dev folder
+        prod_dir (str): prod folder
+        keep (int): number of snapshots to keep
+        force (bool): promote even if dev and prod have the same version, or dev was rolled back
+
+    Returns:
+        version (str): promoted version (None if there was nothing to promote)
+    """
+
+    dev_version = read_version(os.path.join(dev_dir, CHANGELOG_FILE))
+    prod_version = read_version(os.path.join(prod_dir, CHANGELOG_FILE))
+
+    if not os.path.exists(os.path.join(dev_dir, DB_FILE)):
+        raise FileNotFoundError('No cleansed database to promote in ' + dev_dir)
+    if dev_version is None:
+        raise ValueError("Can't read the version of " + os.path.join(dev_dir, CHANGELOG_FILE))
+    if dev_version == prod_version and not force:
+        return(None)
+    pinned = read_pin(prod_dir)
+    if pinned is not None and (dev_version == pinned or dev_version in list_snapshots(prod_dir)) and not force:
+        return(None)
+
+    restore_snapshot(create_snapshot(dev_version, dev_dir, prod_dir), prod_dir)
+    write_pin(None, prod_dir)
+    prune_snapshots(keep, prod_dir)
+
+    return(dev_version)
+
+
+## Roll prod back to a snapshot
+def rollback(version=None, prod_dir=PROD_DIR):
+    """
+    The version rolled back from is pinned, so `promote` doesn't promote it (or any other version
+    already promoted) again.
+
+    Parameters:
+        version (str): version to restore (None for the snapshot promoted before the current prod version)
+        prod_dir (str): prod folder
+
+    Returns:
+        version (str): restored version
+    """
+
+    versions = list_snapshots(prod_dir)
+    prod_version = read_version(os.path.join(prod_dir, CHANGELOG_FILE))
+    if version is None:
+        older = versions[:versions.index(prod_version)] if prod_version in versions else versions
+        if len(older) == 0:
+            raise ValueError('No snapshot older than the prod version ' + str(prod_version))
+        version = older[-1]
+
+    if version not in versions:
+        raise ValueError('No snapshot of version ' + version + ', kept snapshots: ' + str(versions))
+
+    restore_snapshot(os.path.join(prod_dir, 'snapshots', version), prod_dir)
+
+    # The first version rolled back from stays pinned (e.g. after two rollbacks in a row)
+    if read_pin(prod_dir) is None and prod_version is not None and prod_version != version:
+        write_pin(prod_version, prod_dir)
+
+    return(version)
+
+
+""" Self-test """
+## Write dev files of the next version (a one-row database, and its changelog entry)
+def write_dev_version(dev_dir):
+    """
+    Parameters:
+        dev_dir (str): dev folder
+
+    Returns:
+        version (str): new dev version
+    """
+
+    changelog_path = os.path.join(dev_dir, CHANGELOG_FILE)
+    with open(changelog_path) as f:
+        lines = f.readlines()
+    version = next_version(read_version(changelog_path))
+
+    con = sqlite3.connect(os.path.join(dev_dir, DB_FILE))
+    with con:
+        con.execute('CREATE TABLE IF NOT EXISTS version (version text)')
+        con.execute('DELETE FROM version')
+        con.execute('INSERT INTO version VALUES (?)', (version,))
+    con.close()
+
+    with open(changelog_path, 'w') as f:
+        f.write('## ' + version + '\n' + ''.join(lines))
+
+    return(version)
+
+
+## Promote, prune and roll back across 0.0.9 -> 0.0.10 -> 0.0.11 (and a version going backwards) in a scratch folder
+def self_test(keep=2):
+    """
+    Parameters:
+        keep (int): number of snapshots kept by the promotions
+
+    Returns:
+        results (list): (check, passed) of each check
+    """
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        dev_dir, prod_dir = os.path.join(tmp_dir, 'dev'), os.path.join(tmp_dir, 'prod')
+        os.makedirs(dev_dir)
+        os.makedirs(prod_dir)
+        with open(os.path.join(dev_dir, CHANGELOG_FILE), 'w') as f:
+            f.write('## 0.0.8\n')
+
+        def prod_db_version():
+            con = sqlite3.connect(os.path.join(prod_dir, DB_FILE))
+            try:
+                return(con.execute('SELECT version FROM version').fetchone()[0])
+            finally:
+                con.close()
+
+        # The changelog versions cross 0.0.9 -> 0.0.10 -> 0.0.11
+        versions = []
+        for _ in range(3):
+            versions.append(write_dev_version(dev_dir))
+            promote(dev_dir, prod_dir, keep)
+        results.append(('next versions are 0.0.9, 0.0.10, 0.0.11', versions == ['0.0.9', '0.0.10', '0.0.11']))
+        results.append(('0.0.11 is in prod', prod_db_version() == '0.0.11'))
+        results.append(('the 2 last promoted snapshots are kept', list_snapshots(prod_dir) == ['0.0.10', '0.0.11']))
+
+        # A rollback restores the version promoted before, and pins the one rolled back from
+        rollback(prod_dir=prod_dir)
+        results.append(('rollback restores 0.0.10', prod_db_version() == '0.0.10'))
+        results.append(('0.0.11 is not promoted again', promote(dev_dir, prod_dir, keep) is None
+                        and prod_db_version() == '0.0.10'))
+
+        # A version going backwards (e.g. a restarted changelog) is still the most recent promotion
+        with open(os.path.join(dev_dir, CHANGELOG_FILE), 'w') as f:
+            f.write('## 0.0.2\n')
+        write_dev_version(dev_dir)
+        results.append(('0.0.3 is promoted after 0.0.11', promote(dev_dir, prod_dir, keep) == '0.0.3'
+                        and prod_db_version() == '0.0.3'))
+        results.append(('pruning keeps the prod version 0.0.3', list_snapshots(prod_dir) == ['0.0.11', '0.0.3']))
+        rollback(prod_dir=prod_dir)
+        results.append(('rollback restores 0.0.11, promoted before 0.0.3', prod_db_version() == '0.0.11'))
+
+    return(results)
+
+
+## Run the promotion (or the rollback) from the command line
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Promote the dev cleansed database, CSV and changelog to prod')
+    parser.add_argument('--dev-dir', default=DEV_DIR, help='dev folder')
+    parser.add_argument('--prod-dir', default=PROD_DIR, help='prod folder')
+    parser.add_argument('--keep', type=int, default=KEEP, help='number of versioned snapshots to keep')
+    parser.add_argument('--force', action='store_true', help='promote even if dev and prod have the same version, or dev was rolled back')
+    parser.add_argument('--rollback', nargs='?', const='previous', default=None, metavar='VERSION',
+                        help='restore a snapshot instead (the one before the current prod version by default)')
+    parser.add_argument('--list', action='store_true', help='list the kept snapshots')
+    parser.add_argument('--self-test', action='store_true', help='only run promotions and rollbacks on a scratch folder')
+    args = parser.parse_args()
+
+    if args.self_test:
+        results = self_test()
+        for check, passed in results:
+            print(('ok      ' if passed else 'FAILED  ') + check)
+        if not all(passed for _, passed in results):
+            raise SystemExit(1)
+    elif args.list:
+        print('Snapshots: ' + ', '.join(list_snapshots(args.prod_dir)))
+    elif args.rollback is not None:
+        version = rollback(None if args.rollback == 'previous' else args.rollback, args.prod_dir)
+        print('Rolled prod back to ' + version)
+    else:
+        pinned = read_pin(args.prod_dir)
+        version = promote(args.dev_dir, args.prod_dir, args.keep, args.force)
+        if version is not None:
+            print('Promoted ' + version + ' to prod')
+        elif pinned is not None and not args.force:
+            print('No new changes to promote (' + pinned + ' was rolled back: the versions already promoted need --force)')
+        else:
+            print('No new changes to promote')